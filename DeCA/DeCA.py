@@ -7,10 +7,10 @@ import fnmatch
 import  numpy as np
 import random
 import math
-from pathlib import Path
 import re
 import csv
 import vtk.util.numpy_support as vtk_np
+import DeCALib
 
 #
 # DeCA
@@ -275,9 +275,8 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     #
     self.CPDCheckBox = qt.QCheckBox()
     self.CPDCheckBox.checked = False
-    self.CPDCheckBox.enabled = False
-    self.CPDCheckBox.setToolTip("If checked, DeCA will use CPD for point correspondences.")
-    #DeCAWidgetLayout.addRow("Use CPD registration: ", self.CPDCheckBox)
+    self.CPDCheckBox.setToolTip("If checked, DeCA will use coherent point drift (CPD) registration of the base to each subject for point correspondences.")
+    DeCAWidgetLayout.addRow("Use CPD registration: ", self.CPDCheckBox)
 
     #
     # Write directory for error checking
@@ -288,12 +287,48 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     DeCAWidgetLayout.addRow("Create output for error checking: ", self.WriteErrorCheckBox)
 
     #
-    # Write directory for error checking
+    # Select closest point search
+    #
+    self.closestPointBackendBox = qt.QComboBox()
+    self.closestPointBackendBox.addItems(DeCALib.closestPointBackends)
+    self.closestPointBackendBox.setToolTip("Closest point search used for correspondences. 'locator' is exact. 'approximate' is about 3x faster, but about 1% of its points are up to a tenth of an edge length farther than the closest point.")
+    DeCAWidgetLayout.addRow("Closest point search: ", self.closestPointBackendBox)
+
+    #
+    # Set number of worker processes
+    #
+    self.workerNumberBox = qt.QSpinBox()
+    self.workerNumberBox.minimum = 1
+    self.workerNumberBox.maximum = os.cpu_count() or 1
+    self.workerNumberBox.value = 1
+    self.workerNumberBox.setToolTip("Number of processes used to find subject correspondences in parallel.")
+    DeCAWidgetLayout.addRow("Worker processes: ", self.workerNumberBox)
+
+    #
+    # Streaming mode
+    #
+    self.streamingCheckBox = qt.QCheckBox()
+    self.streamingCheckBox.checked = False
+    self.streamingCheckBox.setToolTip("If checked, shape analysis will load one subject at a time and write per-subject magnitudes to decaMagnitudes.npy, so memory use does not grow with the number of subjects.")
+    DeCAWidgetLayout.addRow("Low memory streaming mode: ", self.streamingCheckBox)
+
+    #
+    # Incremental mode
+    #
+    self.incrementalCheckBox = qt.QCheckBox()
+    self.incrementalCheckBox.checked = False
+    self.incrementalCheckBox.setToolTip("If checked, shape analysis adds the subjects of the mesh directory that are not yet in the results of the output directory, "
+      "using the base and mean shape stored with those results. Earlier subjects are not corresponded again.")
+    DeCAWidgetLayout.addRow("Add new subjects to existing results: ", self.incrementalCheckBox)
+
+    #
+    # Write correspondence tensor
     #
     self.WriteCorrPointsCheckBox= qt.QCheckBox()
     self.WriteCorrPointsCheckBox.checked = False
-    self.WriteCorrPointsCheckBox.setToolTip("If checked, DeCA will write out corresponding meshes.")
-    #DeCAWidgetLayout.addRow("Write out point correspondences: ", self.WriteCorrPointsCheckBox)
+    self.WriteCorrPointsCheckBox.setToolTip("If checked, DeCA will write the corresponding points of all subjects to decaCorrespondences.npy, "
+      "a memory-mapped float32 array with a JSON sidecar of subject IDs and run settings and the base mesh polygons in decaCorrespondencesPolygons.npy.")
+    DeCAWidgetLayout.addRow("Write out point correspondences: ", self.WriteCorrPointsCheckBox)
 
     #
     # Select Analysis Type
@@ -352,6 +387,15 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     visualizeWidget.text = "Visualize the output feature heat maps"
     visualizeTabLayout.addRow(visualizeWidget)
 
+    #
+    # Open result file
+    #
+    self.resultFileSelector = ctk.ctkPathLineEdit()
+    self.resultFileSelector.filters  = ctk.ctkPathLineEdit().Files
+    self.resultFileSelector.nameFilters=["Result model (*.vtp)"]
+    self.resultFileSelector.setToolTip( "Open a result model with the summary arrays only. Subject arrays are read from the file when selected." )
+    visualizeWidgetLayout.addRow("Result file: ", self.resultFileSelector)
+
     #
     # Select base mesh
     #
@@ -374,6 +418,8 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     visualizeWidgetLayout.addRow("Subject ID: ", self.subjectIDBox)
 
     # Connections
+    self.featureStores = {}
+    self.resultFileSelector.connect('validInputChanged(bool)', self.onVisualizeFileSelect)
     self.meshSelect.connect("currentNodeChanged(vtkMRMLNode*)", self.onVisualizeMeshSelect)
     self.subjectIDBox.connect("currentIndexChanged(int)", self.onSubjectIDSelect)
 
@@ -538,6 +584,51 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     self.spacingTolerance.setToolTip("Set tolerance of spacing as a percentage of the image diagonal")
     DeCALWidgetLayout.addRow("Spacing tolerance: ", self.spacingTolerance)
 
+    #
+    # Set target number of template points
+    #
+    self.templatePointNumberBox = qt.QSpinBox()
+    self.templatePointNumberBox.minimum = 0
+    self.templatePointNumberBox.maximum = 1000000
+    self.templatePointNumberBox.value = 0
+    self.templatePointNumberBox.specialValueText = "Use spacing tolerance"
+    self.templatePointNumberBox.setToolTip("Number of points to sample on the template shape, instead of the spacing tolerance.")
+    DeCALWidgetLayout.addRow("Template points: ", self.templatePointNumberBox)
+
+    #
+    # Select template sampling
+    #
+    self.templateSamplingBox = qt.QComboBox()
+    self.templateSamplingBox.addItems(DeCALib.templateSamplingMethods)
+    self.templateSamplingBox.setToolTip("Sampling of a target number of template points. 'voxel' is fast and close to the target, 'farthest' gives the exact number but is slow on large meshes.")
+    DeCALWidgetLayout.addRow("Template sampling: ", self.templateSamplingBox)
+
+    #
+    # Select closest point search
+    #
+    self.DCLClosestPointBackendBox = qt.QComboBox()
+    self.DCLClosestPointBackendBox.addItems(DeCALib.closestPointBackends)
+    self.DCLClosestPointBackendBox.setToolTip("Closest point search used for correspondences. 'locator' is exact. 'approximate' is about 3x faster, but about 1% of its points are up to a tenth of an edge length farther than the closest point.")
+    DeCALWidgetLayout.addRow("Closest point search: ", self.DCLClosestPointBackendBox)
+
+    #
+    # Set number of worker processes
+    #
+    self.DCLWorkerNumberBox = qt.QSpinBox()
+    self.DCLWorkerNumberBox.minimum = 1
+    self.DCLWorkerNumberBox.maximum = os.cpu_count() or 1
+    self.DCLWorkerNumberBox.value = 1
+    self.DCLWorkerNumberBox.setToolTip("Number of processes used to find subject correspondences and write landmark files in parallel.")
+    DeCALWidgetLayout.addRow("Worker processes: ", self.DCLWorkerNumberBox)
+
+    #
+    # Select landmark array output
+    #
+    self.DCLArrayOutputCheckBox = qt.QCheckBox()
+    self.DCLArrayOutputCheckBox.checked = False
+    self.DCLArrayOutputCheckBox.setToolTip("If checked, all landmarks are also saved as one array in decaLandmarks.npz.")
+    DeCALWidgetLayout.addRow("Write landmark array: ", self.DCLArrayOutputCheckBox)
+
     #
     # Get Subsample Rate Button
     #
@@ -570,6 +661,38 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     self.DCLOutputDirectory.connect('validInputChanged(bool)', self.onDCLSelect)
     self.DCLApplyButton.connect('clicked(bool)', self.onDCLApplyButton)
     self.getPointNumberButton.connect('clicked(bool)', self.onGetPointNumberButton)
+    self.DCLBaseModelSelector.connect('currentPathChanged(QString)', self.onDCLBaseModelChanged)
+    self.spacingTolerance.connect('valueChanged(double)', self.onTemplateSettingsChanged)
+    self.templatePointNumberBox.connect('valueChanged(int)', self.onTemplateSettingsChanged)
+    self.templateSamplingBox.connect('currentIndexChanged(int)', self.onTemplateSettingsChanged)
+    # base point indices of the previewed DeCAL template
+    self.templateIndex = None
+
+    ################################### Run Status ###################################
+    # Runs execute in the background, one at a time, reporting progress here
+    runStatusWidget = qt.QWidget()
+    runStatusLayout = qt.QHBoxLayout(runStatusWidget)
+    runStatusLayout.setContentsMargins(0, 0, 0, 0)
+    self.runProgressBar = qt.QProgressBar()
+    self.runProgressBar.setToolTip("Subjects finished by the run in progress")
+    runStatusLayout.addWidget(self.runProgressBar)
+    self.runCancelButton = qt.QPushButton("Cancel")
+    self.runCancelButton.toolTip = "Stop the run after the subject in progress. Finished subjects are kept, running again resumes from them."
+    self.runCancelButton.enabled = False
+    runStatusLayout.addWidget(self.runCancelButton)
+    self.layout.addWidget(runStatusWidget)
+    self.runStatusLabel = qt.QLabel()
+    self.runStatusLabel.wordWrap = True
+    self.layout.addWidget(self.runStatusLabel)
+    runStatusWidget.visible = False
+    self.runStatusWidget = runStatusWidget
+
+    self.job = None
+    self.runButtons = [self.applyButton, self.generateMeanButton, self.mirrorButton, self.DCApplyButton, self.DCLApplyButton]
+    self.jobTimer = qt.QTimer()
+    self.jobTimer.setInterval(200)
+    self.jobTimer.connect('timeout()', self.onJobTimer)
+    self.runCancelButton.connect('clicked(bool)', self.onRunCancelButton)
 
 ### GUI SUpport Functions
   def testConnect(self):
@@ -590,30 +713,117 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
   def onSubjectIDSelect(self):
     try:
       subjectID = self.subjectIDBox.currentText
+      featureStore = self.featureStores.get(self.resultNode.GetID())
+      if featureStore and subjectID in featureStore.subjectIndex:
+        # one array holds the subject on display, refilled from the store
+        self.setSubjectScalars(featureStore.values(subjectID))
+        subjectID = "Subject"
       self.resultNode.GetDisplayNode().SetActiveScalarName(subjectID)
       self.resultNode.GetDisplayNode().SetAndObserveColorNodeID('vtkMRMLColorTableNodeFilePlasma.txt')
-      print(subjectID)
+      print(self.subjectIDBox.currentText)
     except:
       print("Error: No array found")
 
+  def setSubjectScalars(self, values):
+    pointData = self.resultNode.GetPolyData().GetPointData()
+    subjectArray = pointData.GetArray("Subject")
+    if subjectArray is None:
+      subjectArray = vtk_np.numpy_to_vtk(values, deep=True)
+      subjectArray.SetName("Subject")
+      pointData.AddArray(subjectArray)
+    else:
+      vtk_np.vtk_to_numpy(subjectArray)[:] = values
+      subjectArray.Modified()
+    self.resultNode.GetPolyData().Modified()
+
+  def onVisualizeFileSelect(self):
+    resultPath = self.resultFileSelector.currentPath
+    if not os.path.isfile(resultPath):
+      return
+    resultNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', os.path.splitext(os.path.basename(resultPath))[0])
+    resultNode.CreateDefaultDisplayNodes()
+    resultNode.SetAndObservePolyData(DeCALib.readResultModel(resultPath, coordinateSystem=DeCALogic.coordinateSystem))
+    self.featureStores[resultNode.GetID()] = DeCALib.SubjectFeatureStore(resultPath)
+    self.meshSelect.setCurrentNode(resultNode)
+
   def onVisualizeMeshSelect(self):
+    self.subjectIDBox.blockSignals(True)
+    self.subjectIDBox.clear()
+    self.subjectIDBox.enabled = False
     if bool(self.meshSelect.currentNode()):
       self.resultNode = self.meshSelect.currentNode()
       self.resultNode.GetDisplayNode().SetVisibility(True)
       self.resultNode.GetDisplayNode().SetScalarVisibility(True)
       resultData = self.resultNode.GetPolyData().GetPointData()
-      self.subjectIDBox.enabled = True
-      arrayNumber = resultData.GetNumberOfArrays()
-      if arrayNumber > 0:
-        for i in range(resultData.GetNumberOfArrays()):
-          arrayName = resultData.GetArrayName(i)
-          self.subjectIDBox.addItem(arrayName)
-      else:
-        self.subjectIDBox.clear()
-        self.subjectIDBox.enabled = False
+      arrayNames = [resultData.GetArrayName(i) for i in range(resultData.GetNumberOfArrays())]
+      featureStore = self.featureStores.get(self.resultNode.GetID())
+      if featureStore:
+        arrayNames = [arrayName for arrayName in arrayNames if arrayName in DeCALib.summaryArrayNames] + featureStore.subjectIDs
+      for arrayName in arrayNames:
+        self.subjectIDBox.addItem(arrayName)
+      self.subjectIDBox.enabled = len(arrayNames) > 0
+    self.subjectIDBox.blockSignals(False)
+    if self.subjectIDBox.enabled:
+      self.onSubjectIDSelect()
 
   def cleanup(self):
-    pass
+    if self.job and self.job.running():
+      self.job.cancel()
+    self.jobTimer.stop()
+
+  def startJob(self, name, runName, *arguments, onFinished=None):
+    # run a DeCABatchLogic entry point in the background, onFinished() is called once it completes
+    if self.job and self.job.running():
+      slicer.util.warningDisplay(f"{self.job.name} is still running.")
+      return
+    logic = DeCALib.DeCABatchLogic()
+    logic.cacheDirectory = DeCALogic.cacheDirectory
+    self.job = DeCALib.BackgroundJob(logic, name, getattr(logic, runName), *arguments)
+    self.jobFinishedCallback = onFinished
+    self.runButtonStates = [button.enabled for button in self.runButtons]
+    for button in self.runButtons:
+      button.enabled = False
+    self.runProgressBar.setRange(0, 0)
+    self.runCancelButton.enabled = True
+    self.runStatusWidget.visible = True
+    self.runStatusLabel.text = f"{name}: starting"
+    self.job.start()
+    self.jobTimer.start()
+
+  def onJobTimer(self):
+    job = self.job
+    # log records of the run are handled here, in the main thread
+    for record in job.pendingMessages():
+      logging.getLogger().handle(record)
+    if job.total:
+      self.runProgressBar.setRange(0, job.total)
+      self.runProgressBar.value = job.done
+      if self.runCancelButton.enabled:
+        self.runStatusLabel.text = f"{job.name}: {job.stage}, {job.done} of {job.total} subjects"
+    if job.running():
+      return
+    self.jobTimer.stop()
+    for button, enabled in zip(self.runButtons, self.runButtonStates):
+      button.enabled = enabled
+    self.runCancelButton.enabled = False
+    self.runProgressBar.setRange(0, 1)
+    if job.cancelled:
+      self.runProgressBar.value = 0
+      self.runStatusLabel.text = f"{job.name} cancelled after {job.done} of {job.total} subjects"
+    elif job.error:
+      self.runProgressBar.value = 0
+      self.runStatusLabel.text = f"{job.name} failed: {job.error}"
+    else:
+      self.runProgressBar.value = 1
+      self.runStatusLabel.text = f"{job.name} finished"
+      if self.jobFinishedCallback:
+        self.jobFinishedCallback()
+
+  def onRunCancelButton(self):
+    if self.job and self.job.running():
+      self.job.cancel()
+      self.runCancelButton.enabled = False
+      self.runStatusLabel.text = f"{self.job.name}: cancelling after the subject in progress"
 
   def onSelectAlignPaths(self):
     self.applyButton.enabled = bool (self.meshDirectory.currentPath and self.landmarkDirectory.currentPath and
@@ -631,8 +841,7 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     and self.mirrorMeshDirectory.currentPath and self.mirrorLMDirectory.currentPath)
 
   def onApplyAlignmentButton(self):
-    logic = DeCALogic()
-    logic.runAlign(self.baseMeshSelector.currentPath, self.baseLMSelector.currentPath, self.meshDirectory.currentPath,
+    self.startJob("Rigid alignment", 'runAlign', self.baseMeshSelector.currentPath, self.baseLMSelector.currentPath, self.meshDirectory.currentPath,
       self.landmarkDirectory.currentPath, self.alignedMeshDirectory.currentPath, self.alignedLMDirectory.currentPath, self.removeScaleCheckBox.checked,
       self.semilandmarkSelector.currentPath, self.alignedSemilandmarkSelector.currentPath)
 
@@ -640,19 +849,45 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     self.generateMeanButton.enabled = bool (self.meanMeshDirectory.currentPath and self.meanLMDirectory.currentPath and self.meanOutputDirectory)
 
   def onGenerateMean(self):
-    logic = DeCALogic()
     base, modelExt = os.path.splitext(self.baseMeshSelector.currentPath)
-    logic.runMean(self.meanLMDirectory.currentPath, self.meanMeshDirectory.currentPath, modelExt, self.meanOutputDirectory.currentPath)
+    outputDirectory = self.meanOutputDirectory.currentPath
+    self.startJob("Generate mean", 'runMean', self.meanLMDirectory.currentPath, self.meanMeshDirectory.currentPath, modelExt, outputDirectory,
+      onFinished=lambda: self.loadMeanModel(outputDirectory))
+
+  def loadMeanModel(self, outputDirectory):
+    averageModelNode = slicer.util.loadModel(os.path.join(outputDirectory, 'decaMeanModel.ply'))
+    averageModelNode.SetName('meanTemplate')
+    averageLandmarkNode = slicer.util.loadMarkups(os.path.join(outputDirectory, 'decaMeanModel.mrk.json'))
+    averageLandmarkNode.SetName('MeanTemplateLM')
+    averageLandmarkNode.GetDisplayNode().SetPointLabelsVisibility(False)
+
+  def showResultModel(self, resultPath):
+    # open the result lazily in the Visualize Results tab, reloading it when the path is already selected
+    if self.resultFileSelector.currentPath == resultPath:
+      self.onVisualizeFileSelect()
+    else:
+      self.resultFileSelector.currentPath = resultPath
 
   def onDCApplyButton(self):
-    logic = DeCALogic()
-    if self.analysisTypeShape.checked == True:
-      logic.runDCAlign(self.DCBaseModelSelector.currentPath, self.DCBaseLMSelector.currentPath, self.DCMeshDirectory.currentPath,
-      self.DCLandmarkDirectory.currentPath, self.DCOutputDirectory.currentPath, self.CPDCheckBox.checked, self.WriteErrorCheckBox.checked)
+    resultPath = os.path.join(self.DCOutputDirectory.currentPath, 'decaResultModel.vtp')
+    onFinished = lambda: self.showResultModel(resultPath)
+    if self.analysisTypeShape.checked == True and self.incrementalCheckBox.checked:
+      self.startJob("DeCA", 'runDCAlignIncremental', self.DCMeshDirectory.currentPath, self.DCLandmarkDirectory.currentPath, self.DCOutputDirectory.currentPath,
+      self.workerNumberBox.value, onFinished=onFinished)
+    elif self.analysisTypeShape.checked == True and self.streamingCheckBox.checked:
+      self.startJob("DeCA", 'runDCAlignStreaming', self.DCBaseModelSelector.currentPath, self.DCBaseLMSelector.currentPath, self.DCMeshDirectory.currentPath,
+      self.DCLandmarkDirectory.currentPath, self.DCOutputDirectory.currentPath, self.WriteErrorCheckBox.checked,
+      self.closestPointBackendBox.currentText, self.WriteCorrPointsCheckBox.checked, onFinished=onFinished)
+    elif self.analysisTypeShape.checked == True:
+      self.startJob("DeCA", 'runDCAlign', self.DCBaseModelSelector.currentPath, self.DCBaseLMSelector.currentPath, self.DCMeshDirectory.currentPath,
+      self.DCLandmarkDirectory.currentPath, self.DCOutputDirectory.currentPath, self.CPDCheckBox.checked, self.WriteErrorCheckBox.checked,
+      self.closestPointBackendBox.currentText, self.workerNumberBox.value, self.WriteCorrPointsCheckBox.checked, onFinished=onFinished)
     else:
-      logic.runDCAlignSymmetric(self.DCBaseModelSelector.currentPath, self.DCBaseLMSelector.currentPath, self.DCMeshDirectory.currentPath,
+      resultPath = os.path.join(self.DCOutputDirectory.currentPath, 'decaSymmetryResultModel.vtp')
+      self.startJob("DeCA", 'runDCAlignSymmetric', self.DCBaseModelSelector.currentPath, self.DCBaseLMSelector.currentPath, self.DCMeshDirectory.currentPath,
       self.DCLandmarkDirectory.currentPath, self.mirrorMeshSelector.currentPath, self.mirrorLMSelector.currentPath, self.DCOutputDirectory.currentPath,
-      self.CPDCheckBox.checked, self.WriteErrorCheckBox.checked, self.WriteCorrPointsCheckBox.checked)
+      self.CPDCheckBox.checked, self.WriteErrorCheckBox.checked, self.WriteCorrPointsCheckBox.checked, self.closestPointBackendBox.currentText,
+      self.workerNumberBox.value, onFinished=lambda: self.showResultModel(resultPath))
 
   def onDCSelect(self):
     if self.analysisTypeShape.checked == True:
@@ -672,18 +907,32 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     print(bool ( self.DCLBaseLMSelector.currentPath) )
 
   def onGetPointNumberButton(self):
-    logic = DeCALogic()
-    self.baseNode, self.templateModel, pointNumber = logic.runCheckPoints(self.DCLBaseModelSelector.currentPath, self.spacingTolerance.value)
-    self.subsampleInfo.insertPlainText(f'The subsampled template has a total of {pointNumber} points. \n')
+    self.previewTemplate()
     self.DCLApplyButton.enabled = True
 
-  def onDCLApplyButton(self):
+  def previewTemplate(self):
     logic = DeCALogic()
-    logic.runDeCAL(self.baseNode, self.templateModel, self.DCLBaseLMSelector.currentPath, self.DCLMeshDirectory.currentPath,
-    self.DCLLandmarkDirectory.currentPath, self.DCLOutputDirectory.currentPath, self.spacingTolerance.value)
+    logic.templateSamplingMethod = self.templateSamplingBox.currentText
+    self.templateIndex = logic.runCheckPoints(self.DCLBaseModelSelector.currentPath, self.spacingTolerance.value, self.templatePointNumberBox.value)
+    self.subsampleInfo.setPlainText(f'The subsampled template has a total of {len(self.templateIndex)} points. \n')
+
+  def onTemplateSettingsChanged(self):
+    # once previewed, the point count follows the settings; the base mesh stays cached
+    if self.templateIndex is not None:
+      self.previewTemplate()
+
+  def onDCLBaseModelChanged(self):
+    self.templateIndex = None
+    self.subsampleInfo.clear()
+    self.DCLApplyButton.enabled = False
+
+  def onDCLApplyButton(self):
+    self.startJob("DeCAL", 'runDeCAL', self.DCLBaseModelSelector.currentPath, self.DCLBaseLMSelector.currentPath, self.DCLMeshDirectory.currentPath,
+    self.DCLLandmarkDirectory.currentPath, self.DCLOutputDirectory.currentPath, self.spacingTolerance.value,
+    self.DCLClosestPointBackendBox.currentText, self.DCLWorkerNumberBox.value, self.DCLArrayOutputCheckBox.checked,
+    self.templatePointNumberBox.value or None, self.templateIndex)
 
   def onMirrorButton(self):
-    logic = DeCALogic()
     axis = [1,1,1]
     if self.xAxis.isChecked():
       axis[0] = -1
@@ -692,757 +941,40 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     else:
       axis[2] = -1
 
-    logic.runMirroring(self.symMeshDirectory.currentPath, self.symLandmarkDirectory.currentPath, self.mirrorMeshDirectory.currentPath,
+    self.startJob("Mirror", 'runMirroring', self.symMeshDirectory.currentPath, self.symLandmarkDirectory.currentPath, self.mirrorMeshDirectory.currentPath,
       self.mirrorLMDirectory.currentPath, axis, self.landmarkIndexText.text, self.semilandmarkMirrorSelector.currentPath, self.alignedSemilandmarkMirrorSelector.currentPath, self.semilandmarkIndexMirrorText.text)
 
 #
 # DeCALogic
 #
 
-class DeCALogic(ScriptedLoadableModuleLogic):
+class DeCALogic(ScriptedLoadableModuleLogic, DeCALib.DeCABatchLogic):
   """This class should implement all the actual
     computation done by your module.  The interface
     should be such that other python code can import
     this class and make use of the functionality without
     requiring an instance of the Widget.
+    The runs are those of DeCALib.DeCABatchLogic, this class reads files in
+    the RAS coordinates of markups and model nodes and stores its artifacts
+    in the Slicer cache.
     Uses ScriptedLoadableModuleLogic base class, available at:
     https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
     """
-  def runCheckPoints(self, baseMeshPath, spacingTolerance):
-    baseNode = slicer.util.loadModel(baseMeshPath)
-    indexArrayName = "indexArray"
-    self.addIndexArray(baseNode, indexArrayName)
-    spacingPercentage = spacingTolerance/100
-    templateModel = self.downsampleModel(baseNode, spacingPercentage)
-    templatePointNumber = templateModel.GetNumberOfPoints()
-    #slicer.mrmlScene.RemoveNode(baseNode)
-    return baseNode, templateModel, templatePointNumber
-
-  def runDeCAL(self, baseNode, templateModel, baseLMPath, meshDirectory, landmarkDirectory, outputDirectory, spacingPercentage):
-    baseLandmarks=self.fiducialNodeToPolyData(baseLMPath).GetPoints()
-    modelExt=['ply','stl','vtp']
-    self.modelNames, models = self.importMeshes(meshDirectory, modelExt)
-    landmarks = self.importLandmarks(landmarkDirectory)
-    self.outputDirectory = outputDirectory
-    denseCorrespondenceGroup = self.denseCorrespondenceBaseMesh(landmarks, models, baseNode.GetPolyData(), baseLandmarks)
-
-    # get base mesh index
-    indexArrayName = "indexArray"
-    templateIndex = templateModel.GetPointData().GetArray(indexArrayName)
-
-    # saving point correspondences
-    if(templateIndex):
-      sampleNumber = denseCorrespondenceGroup.GetNumberOfBlocks()
-      for i in range(sampleNumber):
-        alignedMesh = denseCorrespondenceGroup.GetBlock(i)
-        alignedPointNode= slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode',"alignedPoints")
-        for j in range(templateIndex.GetNumberOfValues()):
-          baseIndex = templateIndex.GetValue(j)
-          alignedPoint = alignedMesh.GetPoint(baseIndex)
-          alignedPointNode.AddControlPoint(alignedPoint)
-        outputLMPath = os.path.join(outputDirectory, self.modelNames[i]+".mrk.json")
-        slicer.util.saveNode(alignedPointNode, outputLMPath)
-        slicer.mrmlScene.RemoveNode(alignedPointNode)
-
-      # save base node correspondences
-      basePointNode= slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode',"basePoints")
-      for j in range(templateIndex.GetNumberOfValues()):
-        baseIndex = templateIndex.GetValue(j)
-        basePoint = baseNode.GetPolyData().GetPoint(baseIndex)
-        basePointNode.AddControlPoint(basePoint)
-      baseLMPath = os.path.join(outputDirectory, "baseModel.mrk.json")
-      slicer.util.saveNode(basePointNode, baseLMPath)
-      slicer.mrmlScene.RemoveNode(basePointNode)
-
-  def downsampleModel(self, model, spacingPercentage):
-    points=model.GetPolyData()
-    cleanFilter=vtk.vtkCleanPolyData()
-    cleanFilter.SetToleranceIsAbsolute(False)
-    cleanFilter.SetTolerance(spacingPercentage)
-    cleanFilter.SetInputData(points)
-    cleanFilter.Update()
-    return cleanFilter.GetOutput()
-
-  def addIndexArray(self, mesh, arrayName):
-    # Array of original index values
-    indexArray = vtk.vtkIntArray()
-    indexArray.SetNumberOfComponents(1)
-    indexArray.SetName(arrayName)
-    for i in range(mesh.GetPolyData().GetNumberOfPoints()):
-      indexArray.InsertNextValue(i)
-    mesh.GetPolyData().GetPointData().AddArray(indexArray)
-
-  def computeNormals(self, inputModel):
-    normals = vtk.vtkPolyDataNormals()
-    normals.SetInputData(inputModel.GetPolyData())
-    normals.SetAutoOrientNormals(True)
-    normals.Update()
-    inputModel.SetAndObservePolyData(normals.GetOutput())
-
-  def runMirroring(self, meshDirectory, lmDirectory, mirrorMeshDirectory, mirrorLMDirectory, mirrorAxis, mirrorIndexText, slmDirectory, outputSLMDirectory, mirrorSLMIndexText):
-    mirrorMatrix = vtk.vtkMatrix4x4()
-    mirrorMatrix.SetElement(0, 0, mirrorAxis[0])
-    mirrorMatrix.SetElement(1, 1, mirrorAxis[1])
-    mirrorMatrix.SetElement(2, 2, mirrorAxis[2])
-
-    lmFileList = os.listdir(lmDirectory)
-    point=[0,0,0]
-
-    #get order of mirrored sets
-    if len(mirrorIndexText) != 0:
-      mirrorIndexList=mirrorIndexText.split(",")
-      mirrorIndexList=[int(x) for x in mirrorIndexList]
-      mirrorIndex=np.asarray(mirrorIndexList)
-    else:
-      print("Error: no landmark index for mirrored mesh")
-
-    semilandmarkOption = bool(slmDirectory and outputSLMDirectory and (len(mirrorSLMIndexText) != 0 ))
-    if semilandmarkOption:
-      mirrorSLMIndexList=mirrorSLMIndexText.split(",")
-      mirrorSLMIndexList=[int(x) for x in mirrorSLMIndexList]
-      mirrorSLMIndex=np.asarray(mirrorSLMIndexList)
-
-    for meshFileName in os.listdir(meshDirectory):
-      if(not meshFileName.startswith(".")):
-        meshFilePath = os.path.join(meshDirectory, meshFileName)
-        currentMeshNode = slicer.util.loadModel(meshFilePath)
-        subjectID = os.path.splitext(meshFileName)[0]
-        currentLMNode = self.getLandmarkFileByID(lmDirectory, subjectID)
-        if currentLMNode:
-          lmFilePath = os.path.join(lmDirectory, subjectID)
-          targetPoints = vtk.vtkPoints()
-          for i in range(currentLMNode.GetNumberOfControlPoints()):
-            point = currentLMNode.GetNthControlPointPosition(i)
-            targetPoints.InsertNextPoint(point)
-
-          mirrorTransform = vtk.vtkTransform()
-          mirrorTransform.SetMatrix(mirrorMatrix)
-          mirrorTransformNode=slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTransformNode","Mirror")
-          mirrorTransformNode.SetAndObserveTransformToParent(mirrorTransform)
-
-          # apply transform to the current surface mesh and landmarks
-          currentMeshNode.SetAndObserveTransformNodeID(mirrorTransformNode.GetID())
-          currentLMNode.SetAndObserveTransformNodeID(mirrorTransformNode.GetID())
-          slicer.vtkSlicerTransformLogic().hardenTransform(currentMeshNode)
-          slicer.vtkSlicerTransformLogic().hardenTransform(currentLMNode)
-
-          # apply rigid transformation
-          sourcePoints = vtk.vtkPoints()
-          mirrorLMNode =slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode",subjectID)
-          for i in range(currentLMNode.GetNumberOfControlPoints()):
-            point = currentLMNode.GetNthControlPointPosition(mirrorIndex[i])
-            mirrorLMNode.AddControlPoint(point)
-            sourcePoints.InsertNextPoint(point)
-
-          rigidTransform = vtk.vtkLandmarkTransform()
-          rigidTransform.SetSourceLandmarks( sourcePoints )
-          rigidTransform.SetTargetLandmarks( targetPoints )
-          rigidTransform.SetModeToRigidBody()
-          rigidTransformNode=slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTransformNode","Rigid")
-          rigidTransformNode.SetAndObserveTransformToParent(rigidTransform)
-
-          # compute normals
-          self.computeNormals(currentMeshNode)
-
-          currentMeshNode.SetAndObserveTransformNodeID(rigidTransformNode.GetID())
-          mirrorLMNode.SetAndObserveTransformNodeID(rigidTransformNode.GetID())
-          slicer.vtkSlicerTransformLogic().hardenTransform(currentMeshNode)
-          slicer.vtkSlicerTransformLogic().hardenTransform(mirrorLMNode)
-
-          # optional semi-landmark alignment
-          if semilandmarkOption:
-            currentSLMNode = self.getLandmarkFileByID(slmDirectory, subjectID)
-            mirrorSLMNode =slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode",subjectID)
-            for i in range(currentSLMNode.GetNumberOfControlPoints()):
-              point = currentSLMNode.GetNthControlPointPosition(mirrorSLMIndex[i])
-              mirrorSLMNode.AddControlPoint(point)
-            if currentSLMNode :
-              currentSLMNode.SetAndObserveTransformNodeID(mirrorTransformNode.GetID())
-              slicer.vtkSlicerTransformLogic().hardenTransform(currentSLMNode)
-              currentSLMNode.SetAndObserveTransformNodeID(rigidTransformNode.GetID())
-              slicer.vtkSlicerTransformLogic().hardenTransform(currentSLMNode)
-              outputSLMName = subjectID + '_mirror.mrk.json'
-              outputSLMPath = os.path.join(outputSLMDirectory, outputSLMName)
-              slicer.util.saveNode(mirrorSLMNode, outputSLMPath)
-              slicer.mrmlScene.RemoveNode(currentSLMNode)
-              slicer.mrmlScene.RemoveNode(mirrorSLMNode)
-
-          # save output files
-          outputMeshName = subjectID + '_mirror.ply'
-          outputMeshPath = os.path.join(mirrorMeshDirectory, outputMeshName)
-          slicer.util.saveNode(currentMeshNode, outputMeshPath)
-          outputLMName = subjectID + '_mirror.mrk.json'
-          outputLMPath = os.path.join(mirrorLMDirectory, outputLMName)
-          slicer.util.saveNode(mirrorLMNode, outputLMPath)
-
-          # clean up
-          slicer.mrmlScene.RemoveNode(currentLMNode)
-          slicer.mrmlScene.RemoveNode(currentMeshNode)
-          slicer.mrmlScene.RemoveNode(mirrorTransformNode)
-          slicer.mrmlScene.RemoveNode(rigidTransformNode)
-          slicer.mrmlScene.RemoveNode(mirrorLMNode)
-
-  def runDCAlign(self, baseMeshPath, baseLMPath, meshDirectory, landmarkDirectory, outputDirectory, optionCPD, optionErrorOutput):
-    if optionErrorOutput:
-      self.errorCheckPath = os.path.join(outputDirectory, "errorChecking")
-      if not os.path.exists(self.errorCheckPath):
-        os.mkdir(self.errorCheckPath)
-    baseNode = slicer.util.loadModel(baseMeshPath)
-    baseMesh = baseNode.GetPolyData()
-    baseLandmarks=self.fiducialNodeToPolyData(baseLMPath).GetPoints()
-    #base, modelExt = os.path.splitext(baseMeshPath)
-    modelExt=['ply','stl','vtp']
-    self.modelNames, models = self.importMeshes(meshDirectory, modelExt)
-    landmarks = self.importLandmarks(landmarkDirectory)
-    self.outputDirectory = outputDirectory
-    if not(optionCPD):
-      denseCorrespondenceGroup = self.denseCorrespondenceBaseMesh(landmarks, models, baseMesh, baseLandmarks)
-    else:
-      denseCorrespondenceGroup = self.denseCorrespondenceCPD(landmarks, models, baseMesh, baseLandmarks)
-
-    self.addMagnitudeFeature(denseCorrespondenceGroup, self.modelNames, baseMesh)
-
-    # save results to output directory
-    outputModelName = 'decaResultModel.vtp'
-    outputModelPath = os.path.join(outputDirectory, outputModelName)
-    slicer.util.saveNode(baseNode, outputModelPath)
-
-  def runDCAlignSymmetric(self, baseMeshPath, baseLMPath, meshDir, landmarkDir, mirrorMeshDir, mirrorLandmarkDir, outputDir, optionCPD, optionErrorOutput, optionPointOutput):
-    if optionErrorOutput:
-      self.errorCheckPath = os.path.join(outputDir, "errorChecking")
-      if not os.path.exists(self.errorCheckPath):
-        os.mkdir(self.errorCheckPath)
-    baseNode = slicer.util.loadModel(baseMeshPath)
-    baseMesh = baseNode.GetPolyData()
-    baseLandmarks=self.fiducialNodeToPolyData(baseLMPath).GetPoints()
-    #base, modelExt = os.path.splitext(baseMeshPath)
-    modelExt=['ply','stl','vtp']
-    self.modelNames, models = self.importMeshes(meshDir, modelExt)
-    landmarks = self.importLandmarks(landmarkDir)
-    modelMirrorNames, mirrorModels = self.importMeshes(mirrorMeshDir, modelExt)
-    mirrorLandmarks = self.importLandmarks(mirrorLandmarkDir)
-    self.outputDirectory = outputDir
-    if not(optionCPD):
-      denseCorrespondenceGroup = self.denseCorrespondenceBaseMesh(landmarks, models, baseMesh, baseLandmarks)
-      denseCorrespondenceGroupMirror = self.denseCorrespondenceBaseMesh(mirrorLandmarks, mirrorModels, baseMesh, baseLandmarks)
+  # markups and model nodes hold RAS coordinates, so files are read directly into RAS
+  coordinateSystem = 'RAS'
+  cacheDirectory = os.path.join(slicer.app.cachePath, 'DeCA')
+
+class DeCATest(ScriptedLoadableModuleTest):
+  """
+  Runs the DeCALib regression tests, which compare the NumPy alignment, warps and CPD normalization
+  with the VTK code they replace and check that serial, parallel and streaming runs agree.
+  """
+  def setUp(self):
+    slicer.mrmlScene.Clear(0)
+
+  def runTest(self):
+    self.setUp()
+    import DeCALib.Tests
+    result = unittest.TextTestRunner(verbosity=2).run(unittest.defaultTestLoader.loadTestsFromModule(DeCALib.Tests))
+    self.assertTrue(result.wasSuccessful())
 
-    else:
-      denseCorrespondenceGroup = self.denseCorrespondenceCPD(landmarks, models, baseMesh, baseLandmarks)
-      denseCorrespondenceGroupMirror = self.denseCorrespondenceCPD(mirrorLandmarks, mirrorModels, baseMesh, baseLandmarks)
-
-    self.addMagnitudeFeatureSymmetry(denseCorrespondenceGroup, denseCorrespondenceGroupMirror, self.modelNames, baseMesh)
-
-    # save results to output directory
-    outputModelName = 'decaSymmetryResultModel.vtp'
-    outputModelPath = os.path.join(outputDir, outputModelName)
-    slicer.util.saveNode(baseNode, outputModelPath)
-
-  def runMean(self, landmarkDirectory, meshDirectory, modelExt, outputDirectory):
-    modelExt=['ply','stl','vtp']
-    self.modelNames, models = self.importMeshes(meshDirectory, modelExt)
-    landmarks = self.importLandmarks(landmarkDirectory)
-    [denseCorrespondenceGroup, closestToMeanIndex] = self.denseCorrespondence(landmarks, models)
-    print("Sample closest to mean: ", closestToMeanIndex)
-    # compute mean model
-    averagePolyData = self.computeAverageModelFromGroup(denseCorrespondenceGroup, closestToMeanIndex)
-    averageModelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'meanTemplate')
-    averageModelNode.CreateDefaultDisplayNodes()
-    averageModelNode.SetAndObservePolyData(averagePolyData)
-     # compute mean landmarks
-    averageLandmarkNode = self.computeAverageLM(landmarks)
-    averageLandmarkNode.GetDisplayNode().SetPointLabelsVisibility(False)
-
-    # save results to output directory
-    outputModelName = 'decaMeanModel.ply'
-    outputModelPath = os.path.join(outputDirectory, outputModelName)
-    slicer.util.saveNode(averageModelNode, outputModelPath)
-
-    outputLMName = 'decaMeanModel.mrk.json'
-    outputLMPath = os.path.join(outputDirectory, outputLMName)
-    slicer.util.saveNode(averageLandmarkNode, outputLMPath)
-
-  def getLandmarkFileByID(self, directory, subjectID):
-    fileList = os.listdir(directory)
-    for fileName in fileList:
-      fileNameBase = Path(fileName)
-      while fileNameBase.suffix in {'.fcsv', '.mrk', '.json'}:
-        fileNameBase = fileNameBase.with_suffix('')
-      if subjectID == str(fileNameBase):
-        #print(fileName + " found matching: " + subjectID)
-        # if file with this subject id exists, load into scene
-        filePath = os.path.join(directory, fileName)
-        currentNode = slicer.util.loadMarkups(filePath)
-        return currentNode
-
-  def runAlign(self, baseMeshPath, baseLMPath, meshDirectory, lmDirectory, ouputMeshDirectory, outputLMDirectory, removeScaleOption, slmDirectory, outputSLMDirectory):
-    semilandmarkOption = bool(slmDirectory and outputSLMDirectory)
-    targetPoints = vtk.vtkPoints()
-    point=[0,0,0]
-    baseMeshNode = slicer.util.loadModel(baseMeshPath)
-    baseLMNode = slicer.util.loadMarkups(baseLMPath)
-    # Set up base points for transform
-    for i in range(baseLMNode.GetNumberOfControlPoints()):
-      point = baseLMNode.GetNthControlPointPosition(i)
-      targetPoints.InsertNextPoint(point)
-
-    # Transform each subject to base
-    for meshFileName in os.listdir(meshDirectory):
-      if(not meshFileName.startswith(".")):
-        lmFileList = os.listdir(lmDirectory)
-        meshFilePath = os.path.join(meshDirectory, meshFileName)
-        subjectID = os.path.splitext(meshFileName)[0]
-        #print("working on ", subjectID)
-        currentLMNode = self.getLandmarkFileByID(lmDirectory, subjectID)
-        if currentLMNode :
-          try:
-            currentMeshNode = slicer.util.loadModel(meshFilePath)
-          except:
-            slicer.mrmlScene.RemoveNode(currentLMNode)
-            continue
-          # set up transform between base lms and current lms
-          sourcePoints = vtk.vtkPoints()
-          for i in range(currentLMNode.GetNumberOfControlPoints()):
-            point = currentLMNode.GetNthControlPointPosition(i)
-            sourcePoints.InsertNextPoint(point)
-            transform = vtk.vtkLandmarkTransform()
-            transform.SetSourceLandmarks(sourcePoints)
-            transform.SetTargetLandmarks(targetPoints)
-          if not removeScaleOption:
-            transform.SetModeToRigidBody()
-          else:
-            transform.SetModeToSimilarity()
-
-          transformNode=slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTransformNode","Alignment")
-          transformNode.SetAndObserveTransformToParent(transform)
-
-          # apply transform to the current surface mesh and landmarks
-          currentMeshNode.SetAndObserveTransformNodeID(transformNode.GetID())
-          currentLMNode.SetAndObserveTransformNodeID(transformNode.GetID())
-          slicer.vtkSlicerTransformLogic().hardenTransform(currentMeshNode)
-          slicer.vtkSlicerTransformLogic().hardenTransform(currentLMNode)
-
-          # save output files
-          outputMeshName = subjectID + '_align.ply'
-          outputMeshPath = os.path.join(ouputMeshDirectory, outputMeshName)
-          slicer.util.saveNode(currentMeshNode, outputMeshPath)
-          outputLMName = subjectID + '_align.mrk.json'
-          outputLMPath = os.path.join(outputLMDirectory, outputLMName)
-          slicer.util.saveNode(currentLMNode, outputLMPath)
-
-          # optional semi-landmark alignment
-          if semilandmarkOption :
-            currentSLMNode = self.getLandmarkFileByID(slmDirectory, subjectID)
-            if currentSLMNode :
-              currentSLMNode.SetAndObserveTransformNodeID(transformNode.GetID())
-              slicer.vtkSlicerTransformLogic().hardenTransform(currentSLMNode)
-              outputSLMName = subjectID + '_align.mrk.json'
-              outputSLMPath = os.path.join(outputSLMDirectory, outputSLMName)
-              slicer.util.saveNode(currentSLMNode, outputSLMPath)
-              slicer.mrmlScene.RemoveNode(currentSLMNode)
-
-          # clean up
-          try:
-            slicer.mrmlScene.RemoveNode(currentLMNode)
-            slicer.mrmlScene.RemoveNode(currentMeshNode)
-            slicer.mrmlScene.RemoveNode(transformNode)
-            slicer.mrmlScene.RemoveNode(baseMeshNode)
-            slicer.mrmlScene.RemoveNode(baseLMNode)
-          except:
-            print(f"could not find nodes to remove for {subjectID}")
-
-  def distanceMatrix(self, a):
-    """
-    Computes the euclidean distance matrix for n points in a 3D space
-    Returns a nXn matrix
-     """
-    id,jd=a.shape
-    fnx = lambda q : q - np.reshape(q, (id, 1))
-    dx=fnx(a[:,0])
-    dy=fnx(a[:,1])
-    dz=fnx(a[:,2])
-    return (dx**2.0+dy**2.0+dz**2.0)**0.5
-
-  def numpyToFiducialNode(self, numpyArray, nodeName):
-    fiducialNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode',nodeName)
-    for point in numpyArray:
-      fiducialNode.AddControlPoint(point)
-    return fiducialNode
-
-  def computeAverageLM(self, fiducialGroup):
-    sampleNumber = fiducialGroup.GetNumberOfBlocks()
-    pointNumber = fiducialGroup.GetBlock(0).GetNumberOfPoints()
-    groupArray_np = np.empty((pointNumber,3,sampleNumber))
-    for i in range(sampleNumber):
-      pointData = fiducialGroup.GetBlock(i).GetPoints().GetData()
-      pointData_np = vtk_np.vtk_to_numpy(pointData)
-      groupArray_np[:,:,i] = pointData_np
-    #Calculate mean point positions of aligned group
-    averagePoints_np = np.mean(groupArray_np, axis=2)
-    averageLMNode = self.numpyToFiducialNode(averagePoints_np, "MeanTemplateLM")
-    return averageLMNode
-
-  def fiducialNodeToPolyData(self, path):
-    point = [0,0,0]
-    polydataPoints = vtk.vtkPolyData()
-    points = vtk.vtkPoints()
-    [success,fiducialNode] = slicer.util.loadMarkupsFiducialList(path)
-    if not success:
-      print("Could not load landmarks: ", inputFilePath)
-      return
-    for i in range(fiducialNode.GetNumberOfControlPoints()):
-      point = fiducialNode.GetNthControlPointPosition(i)
-      points.InsertNextPoint(point)
-    polydataPoints.SetPoints(points)
-    slicer.mrmlScene.RemoveNode(fiducialNode)
-    return polydataPoints
-
-  def importLandmarks(self, topDir):
-    fiducialGroup = vtk.vtkMultiBlockDataGroupFilter()
-    for file in sorted(os.listdir(topDir)):
-      if file.endswith(".fcsv") or file.endswith(".json"):
-        print("reading: ", file)
-        inputFilePath = os.path.join(topDir, file)
-        # may want to replace with vtk reader
-        polydataPoints = self.fiducialNodeToPolyData(inputFilePath)
-        fiducialGroup.AddInputData(polydataPoints)
-    fiducialGroup.Update()
-    return fiducialGroup.GetOutput()
-
-  def importMeshes(self, topDir, extensions):
-      modelGroup = vtk.vtkMultiBlockDataGroupFilter()
-      fileNameList = []
-      for file in sorted(os.listdir(topDir)):
-        if file.endswith(tuple(extensions)):
-          print("reading: ", file)
-          base, ext = os.path.splitext(file)
-          fileNameList.append(base)
-          inputFilePath = os.path.join(topDir, file)
-          # may want to replace with vtk reader
-          modelNode = slicer.util.loadModel(inputFilePath)
-          modelGroup.AddInputData(modelNode.GetPolyData())
-          slicer.mrmlScene.RemoveNode(modelNode)
-      modelGroup.Update()
-      return fileNameList, modelGroup.GetOutput()
-
-  def procrustesImposition(self, originalLandmarks, sizeOption):
-    procrustesFilter = vtk.vtkProcrustesAlignmentFilter()
-    if(sizeOption):
-      procrustesFilter.GetLandmarkTransform().SetModeToRigidBody()
-
-    procrustesFilter.SetInputData(originalLandmarks)
-    procrustesFilter.Update()
-    meanShape = procrustesFilter.GetMeanPoints()
-    return [meanShape, procrustesFilter.GetOutput()]
-
-  def getClosestToMeanIndex(self, meanShape, alignedPoints):
-    import operator
-    sampleNumber = alignedPoints.GetNumberOfBlocks()
-    procrustesDistances = []
-
-    for i in range(sampleNumber):
-      alignedShape = alignedPoints.GetBlock(i)
-      meanPoint = [0,0,0]
-      alignedPoint = [0,0,0]
-      distance = 0
-      for j in range(meanShape.GetNumberOfPoints()):
-        meanShape.GetPoint(j,meanPoint)
-        alignedShape.GetPoint(j,alignedPoint)
-        distance += np.sqrt(vtk.vtkMath.Distance2BetweenPoints(meanPoint,alignedPoint))
-
-      procrustesDistances.append(distance)
-
-    try:
-      min_index, min_value = min(enumerate(procrustesDistances), key=operator.itemgetter(1))
-      return min_index
-    except:
-      return 0
-
-  def denseCorrespondence(self, originalLandmarks, originalMeshes, writeErrorOption=False):
-    meanShape, alignedPoints = self.procrustesImposition(originalLandmarks, False)
-    sampleNumber = alignedPoints.GetNumberOfBlocks()
-    denseCorrespondenceGroup = vtk.vtkMultiBlockDataGroupFilter()
-    # get base mesh as the closest to the mean shape
-    baseIndex = self.getClosestToMeanIndex(meanShape, alignedPoints)
-    baseMesh = originalMeshes.GetBlock(baseIndex)
-    baseLandmarks = originalLandmarks.GetBlock(baseIndex).GetPoints()
-    for i in range(sampleNumber):
-      correspondingMesh = self.denseSurfaceCorrespondencePair(originalMeshes.GetBlock(i),
-      originalLandmarks.GetBlock(i).GetPoints(), alignedPoints.GetBlock(i).GetPoints(),
-      baseMesh, baseLandmarks, meanShape, i)
-      denseCorrespondenceGroup.AddInputData(correspondingMesh)
-
-    denseCorrespondenceGroup.Update()
-    return denseCorrespondenceGroup.GetOutput(), baseIndex
-
-  def denseCorrespondenceCPD(self, originalLandmarks, originalMeshes, baseMesh, baseLandmarks, writeErrorOption=False):
-    meanShape, alignedPoints = self.procrustesImposition(originalLandmarks, False)
-    sampleNumber = alignedPoints.GetNumberOfBlocks()
-    denseCorrespondenceGroup = vtk.vtkMultiBlockDataGroupFilter()
-
-    # assign parameters for CPD
-    parameters = {
-      "SpacingTolerance": .04,
-      "CPDIterations": 100,
-      "CPDTolerence": 0.001,
-      "alpha": 2,
-      "beta": 2,
-     }
-
-    for i in range(sampleNumber):
-      correspondingPoints = self.runCPDRegistration(originalMeshes.GetBlock(i), baseMesh, parameters)
-      # convert to vtkPoints
-      correspondingMesh = self.convertPointsToVTK(correspondingPoints)
-      correspondingMesh.SetPolys(baseMesh.GetPolys())
-      # convert to polydata
-      denseCorrespondenceGroup.AddInputData(correspondingMesh)
-      # write ouput
-      if writeErrorOption:
-        plyWriterSubject = vtk.vtkPLYWriter()
-        plyWriterSubject.SetFileName("/Users/sararolfe/Dropbox/SlicerWorkspace/SMwSML/Data/UBC/DECAOutCPD/" + str(i) + ".ply")
-        plyWriterSubject.SetInputData(correspondingMesh)
-        plyWriterSubject.Write()
-
-        plyWriterBase = vtk.vtkPLYWriter()
-        plyWriterBase.SetFileName("/Users/sararolfe/Dropbox/SlicerWorkspace/SMwSML/Data/UBC/DECAOutCPD/base.ply")
-        plyWriterBase.SetInputData(baseMesh)
-        plyWriterBase.Write()
-
-    denseCorrespondenceGroup.Update()
-    return denseCorrespondenceGroup.GetOutput()
-
-  def runCPDRegistration(self,sourceData, targetData, parameters):
-    from open3d import geometry
-    from open3d import utility
-
-    # Downsample meshes
-    sourceFilter=vtk.vtkCleanPolyData()
-    sourceFilter.SetTolerance(parameters["SpacingTolerance"])
-    sourceFilter.SetInputData(sourceData)
-    sourceFilter.Update()
-    #sourceArray = sourceFilter.GetOutput().GetPoints().GetData()
-    sourceArray = sourceData.GetPoints().GetData()
-
-    targetFilter=vtk.vtkCleanPolyData()
-    targetFilter.SetTolerance(parameters["SpacingTolerance"])
-    targetFilter.SetInputData(targetData)
-    targetFilter.Update()
-    #targetArray = targetFilter.GetOutput().GetPoints().GetData()
-    targetArray = targetData.GetPoints().GetData()
-
-    # Convert to pointcloud for scaling
-    sourceArray_np = vtk_np.vtk_to_numpy(sourceArray)
-    targetArray_np = vtk_np.vtk_to_numpy(targetArray)
-    sourceCloud = geometry.PointCloud()
-    sourceCloud.points = utility.Vector3dVector(sourceArray_np)
-    targetCloud = geometry.PointCloud()
-    targetCloud.points = utility.Vector3dVector(targetArray_np)
-    cloudSize = np.max(targetCloud.get_max_bound() - targetCloud.get_min_bound())
-    targetCloud.scale(25 / cloudSize, center = False)
-    sourceCloud.scale(25 / cloudSize, center = False)
-    # Convert back to numpy for cpd
-    sourceArray = np.asarray(sourceCloud.points,dtype=np.float32)
-    targetArray = np.asarray(targetCloud.points,dtype=np.float32)
-    registrationOutput = self.cpd_registration(targetArray, sourceArray, parameters["CPDIterations"], parameters["CPDTolerence"], parameters["alpha"], parameters["beta"])
-    deformed_array, _ = registrationOutput.register()
-    outputCloud = geometry.PointCloud()
-    outputCloud.points = utility.Vector3dVector(deformed_array)
-    outputCloud.scale(cloudSize/25, center = False)
-    return np.asarray(outputCloud.points)
-
-  def cpd_registration(self, targetArray, sourceArray, CPDIterations, CPDTolerence, alpha_parameter, beta_parameter):
-    from pycpd import DeformableRegistration
-    output = DeformableRegistration(**{'X': targetArray, 'Y': sourceArray,'max_iterations': CPDIterations, 'tolerance': CPDTolerence}, alpha = alpha_parameter, beta  = beta_parameter)
-    return output
-
-  def denseCorrespondenceBaseMesh(self, originalLandmarks, originalMeshes, baseMesh, baseLandmarks):
-    meanShape, alignedPoints = self.procrustesImposition(originalLandmarks, False)
-    sampleNumber = alignedPoints.GetNumberOfBlocks()
-    denseCorrespondenceGroup = vtk.vtkMultiBlockDataGroupFilter()
-    for i in range(sampleNumber):
-      correspondingMesh = self.denseSurfaceCorrespondencePair(originalMeshes.GetBlock(i),
-      originalLandmarks.GetBlock(i).GetPoints(), alignedPoints.GetBlock(i).GetPoints(),
-      baseMesh, baseLandmarks, meanShape, i)
-      denseCorrespondenceGroup.AddInputData(correspondingMesh)
-
-    denseCorrespondenceGroup.Update()
-    return denseCorrespondenceGroup.GetOutput()
-
-  def denseSurfaceCorrespondencePair(self, originalMesh, originalLandmarks, alignedLandmarks, baseMesh, baseLandmarks, meanShape, iteration):
-    # TPS warp target and base mesh to meanshape
-    meanTransform = vtk.vtkThinPlateSplineTransform()
-    meanTransform.SetSourceLandmarks( originalLandmarks )
-    meanTransform.SetTargetLandmarks( meanShape )
-    meanTransform.SetBasisToR() # for 3D transform
-
-    meanTransformFilter = vtk.vtkTransformPolyDataFilter()
-    meanTransformFilter.SetInputData(originalMesh)
-    meanTransformFilter.SetTransform(meanTransform)
-    meanTransformFilter.Update()
-    meanWarpedMesh = meanTransformFilter.GetOutput()
-
-    meanTransformBase = vtk.vtkThinPlateSplineTransform()
-    meanTransformBase.SetSourceLandmarks( baseLandmarks )
-    meanTransformBase.SetTargetLandmarks( meanShape )
-    meanTransformBase.SetBasisToR() # for 3D transform
-
-    meanTransformBaseFilter = vtk.vtkTransformPolyDataFilter()
-    meanTransformBaseFilter.SetInputData(baseMesh)
-    meanTransformBaseFilter.SetTransform(meanTransformBase)
-    meanTransformBaseFilter.Update()
-    meanWarpedBase = meanTransformBaseFilter.GetOutput()
-
-    # write ouput
-    if hasattr(self,"errorCheckPath"):
-      plyWriterSubject = vtk.vtkPLYWriter()
-      print(self.modelNames)
-      print(iteration)
-      plyName = "subject_" + self.modelNames[iteration] + ".ply"
-      plyPath = os.path.join(self.errorCheckPath, plyName)
-      plyWriterSubject.SetFileName(plyPath)
-      plyWriterSubject.SetInputData(meanWarpedMesh)
-      plyWriterSubject.Write()
-
-      plyWriterBase = vtk.vtkPLYWriter()
-      plyName = "base.ply"
-      plyPath = os.path.join(self.errorCheckPath, plyName)
-      plyWriterBase.SetFileName(plyPath)
-      plyWriterBase.SetInputData(meanWarpedBase)
-      plyWriterBase.Write()
-
-    # Dense correspondence
-    cellLocator = vtk.vtkCellLocator()
-    cellLocator.SetDataSet(meanWarpedMesh)
-    cellLocator.BuildLocator()
-
-    point = [0,0,0]
-    correspondingPoint = [0,0,0]
-    correspondingPoints = vtk.vtkPoints()
-    cellId = vtk.reference(0)
-    subId = vtk.reference(0)
-    distance = vtk.reference(0.0)
-    for i in range(meanWarpedBase.GetNumberOfPoints()):
-      meanWarpedBase.GetPoint(i,point)
-      cellLocator.FindClosestPoint(point,correspondingPoint,cellId, subId, distance)
-      correspondingPoints.InsertPoint(i,correspondingPoint)
-
-    #Copy points into mesh with base connectivity
-    correspondingMesh = vtk.vtkPolyData()
-    correspondingMesh.SetPoints(correspondingPoints)
-    correspondingMesh.SetPolys(meanWarpedBase.GetPolys())
-
-    # Apply inverse warping
-    inverseTransform = vtk.vtkThinPlateSplineTransform()
-    inverseTransform.SetSourceLandmarks( meanShape )
-    inverseTransform.SetTargetLandmarks( originalLandmarks )
-    inverseTransform.SetBasisToR() # for 3D transform
-
-    inverseTransformFilter = vtk.vtkTransformPolyDataFilter()
-    inverseTransformFilter.SetInputData(correspondingMesh)
-    inverseTransformFilter.SetTransform(inverseTransform)
-    inverseTransformFilter.Update()
-
-    return inverseTransformFilter.GetOutput()
-
-  def convertPointsToVTK(self, points):
-    array_vtk = vtk_np.numpy_to_vtk(points, deep=True, array_type=vtk.VTK_FLOAT)
-    points_vtk = vtk.vtkPoints()
-    points_vtk.SetData(array_vtk)
-    polydata_vtk = vtk.vtkPolyData()
-    polydata_vtk.SetPoints(points_vtk)
-    return polydata_vtk
-
-  def computeAverageModelFromGroup(self, denseCorrespondenceGroup, baseIndex):
-    sampleNumber = denseCorrespondenceGroup.GetNumberOfBlocks()
-    pointNumber = denseCorrespondenceGroup.GetBlock(0).GetNumberOfPoints()
-    groupArray_np = np.empty((pointNumber,3,sampleNumber))
-
-    # get base mesh as closest to the meanshape
-    baseMesh = denseCorrespondenceGroup.GetBlock(baseIndex)
-
-     # get points as array
-    for i in range(sampleNumber):
-      alignedMesh = denseCorrespondenceGroup.GetBlock(i)
-      alignedMesh_np = vtk_np.vtk_to_numpy(alignedMesh.GetPoints().GetData())
-      groupArray_np[:,:,i] = alignedMesh_np
-
-    #Calculate mean point positions of aligned group
-    averagePoints_np = np.mean(groupArray_np, axis=2)
-    averagePointsPolydata = self.convertPointsToVTK(averagePoints_np)
-
-    #Copy points into mesh with base connectivity
-    averageModel = vtk.vtkPolyData()
-    averageModel.SetPoints(averagePointsPolydata.GetPoints())
-    averageModel.SetPolys(baseMesh.GetPolys())
-    return averageModel
-
-  def addMagnitudeFeature(self, denseCorrespondenceGroup, modelNameArray, model):
-    sampleNumber = denseCorrespondenceGroup.GetNumberOfBlocks()
-    pointNumber = denseCorrespondenceGroup.GetBlock(0).GetNumberOfPoints()
-    statsArray = np.zeros((pointNumber, sampleNumber))
-    magnitudeMean = vtk.vtkDoubleArray()
-    magnitudeMean.SetNumberOfComponents(1)
-    magnitudeMean.SetName("Magnitude Mean")
-    magnitudeSD = vtk.vtkDoubleArray()
-    magnitudeSD.SetNumberOfComponents(1)
-    magnitudeSD.SetName("Magnitude SD")
-
-     # get distance arrays
-    for i in range(sampleNumber):
-      alignedMesh = denseCorrespondenceGroup.GetBlock(i)
-      magnitudes = vtk.vtkDoubleArray()
-      magnitudes.SetNumberOfComponents(1)
-      magnitudes.SetName(modelNameArray[i])
-      for j in range(pointNumber):
-        modelPoint = model.GetPoint(j)
-        targetPoint = alignedMesh.GetPoint(j)
-        distance = np.sqrt(vtk.vtkMath.Distance2BetweenPoints(modelPoint,targetPoint))
-        magnitudes.InsertNextValue(distance)
-        statsArray[j,i]=distance
-
-      model.GetPointData().AddArray(magnitudes)
-
-    for i in range(pointNumber):
-      pointMean = statsArray[i,:].mean()
-      magnitudeMean.InsertNextValue(pointMean)
-      pointSD = statsArray[i,:].std()
-      magnitudeSD.InsertNextValue(pointSD)
-
-    model.GetPointData().AddArray(magnitudeMean)
-    model.GetPointData().AddArray(magnitudeSD)
-
-  def addMagnitudeFeatureSymmetry(self, denseCorrespondenceGroup, denseCorrespondenceGroupMirror, modelNameArray, model):
-    sampleNumber = denseCorrespondenceGroup.GetNumberOfBlocks()
-    pointNumber = denseCorrespondenceGroup.GetBlock(0).GetNumberOfPoints()
-    statsArray = np.zeros((pointNumber, sampleNumber))
-    magnitudeMean = vtk.vtkDoubleArray()
-    magnitudeMean.SetNumberOfComponents(1)
-    magnitudeMean.SetName("Magnitude Mean")
-    magnitudeSD = vtk.vtkDoubleArray()
-    magnitudeSD.SetNumberOfComponents(1)
-    magnitudeSD.SetName("Magnitude SD")
-
-     # get distance arrays
-    for i in range(sampleNumber):
-      alignedMesh = denseCorrespondenceGroup.GetBlock(i)
-      mirrorMesh = denseCorrespondenceGroupMirror.GetBlock(i)
-      magnitudes = vtk.vtkDoubleArray()
-      magnitudes.SetNumberOfComponents(1)
-      magnitudes.SetName(modelNameArray[i])
-      for j in range(pointNumber):
-        modelPoint = model.GetPoint(j)
-        targetPoint1 = alignedMesh.GetPoint(j)
-        targetPoint2 = mirrorMesh.GetPoint(j)
-        distance = np.sqrt(vtk.vtkMath.Distance2BetweenPoints(targetPoint1,targetPoint2))
-        magnitudes.InsertNextValue(distance)
-        statsArray[j,i]=distance
-
-      model.GetPointData().AddArray(magnitudes)
-
-    for i in range(pointNumber):
-      pointMean = statsArray[i,:].mean()
-      magnitudeMean.InsertNextValue(pointMean)
-      pointSD = statsArray[i,:].std()
-      magnitudeSD.InsertNextValue(pointSD)
-
-    model.GetPointData().AddArray(magnitudeMean)
-    model.GetPointData().AddArray(magnitudeSD)
@@ -0,0 +1,106 @@
+import numpy as np
+import vtk.util.numpy_support as vtk_np
+
+#
+# Vectorized landmark alignment of whole cohorts
+#
+
+def optimalRotations(centeredSource, centeredTarget):
+  """
+  Kabsch rotations (S x 3 x 3) best mapping each centered source shape (S x K x 3) onto the centered
+  target, which is one shape (K x 3) or one per source shape (S x K x 3). Reflections are excluded.
+  """
+  # cross-covariance of each subject with the target, H = sum a b^T
+  if centeredTarget.ndim == 2:
+    covariance = np.einsum('ski,kj->sij', centeredSource, centeredTarget)
+  else:
+    covariance = np.einsum('ski,skj->sij', centeredSource, centeredTarget)
+  u, _, vt = np.linalg.svd(covariance)
+  reflection = np.sign(np.linalg.det(np.matmul(vt.transpose(0,2,1), u.transpose(0,2,1))))
+  reflection[reflection == 0] = 1
+  u[:,:,2] *= reflection[:,np.newaxis]
+  return np.matmul(vt.transpose(0,2,1), u.transpose(0,2,1))
+
+def landmarkAlignments(sourcePoints, targetPoints, mode='rigid'):
+  """
+  Solve the rigid or similarity fit of every subject's landmarks (S x K x 3) onto the target
+  landmarks (K x 3) at once. Rotations come from a batched Kabsch SVD with reflections excluded;
+  the similarity scale is the ratio of RMS centroid distances, as in vtkLandmarkTransform, so results
+  match the per-subject VTK transforms. Returns rotations (S x 3 x 3), scales (S) and translations
+  (S x 3) mapping x to scale * R x + t.
+  """
+  sourcePoints = np.asarray(sourcePoints, dtype=np.float64)
+  targetPoints = np.asarray(targetPoints, dtype=np.float64)
+  sourceCentroids = sourcePoints.mean(axis=1)
+  targetCentroid = targetPoints.mean(axis=0)
+  centeredSource = sourcePoints - sourceCentroids[:,np.newaxis,:]
+  centeredTarget = targetPoints - targetCentroid
+
+  rotations = optimalRotations(centeredSource, centeredTarget)
+
+  scales = np.ones(len(sourcePoints))
+  if mode == 'similarity':
+    sourceSpread = np.einsum('ski,ski->s', centeredSource, centeredSource)
+    targetSpread = np.einsum('ki,ki->', centeredTarget, centeredTarget)
+    valid = sourceSpread > 0
+    scales[valid] = np.sqrt(targetSpread / sourceSpread[valid])
+  translations = targetCentroid - scales[:,np.newaxis] * np.einsum('sij,sj->si', rotations, sourceCentroids)
+  return rotations, scales, translations
+
+def normalizeShape(shape):
+  """Center a K x 3 shape on its centroid and scale it to unit centroid size."""
+  shape = shape - shape.mean(axis=0)
+  size = np.sqrt(np.sum(shape**2))
+  return shape / size if size > 0 else shape
+
+def procrustesDistances(alignedShapes, meanShape):
+  """Sum of the landmark distances between each aligned shape (S x K x 3) and the mean shape."""
+  return np.linalg.norm(alignedShapes - meanShape, axis=2).sum(axis=1)
+
+def generalizedProcrustes(shapes, mode='similarity', tolerance=1e-10, maxIterations=100):
+  """
+  Generalized Procrustes analysis of a (S x K x 3) landmark array, following vtkProcrustesAlignmentFilter.
+  In similarity mode every shape is centered and scaled to unit centroid size, in rigid mode shapes keep
+  their size and only rotation and translation are removed. Starting from the first shape, all shapes
+  are aligned to the mean, and the new mean is normalized and rotated back onto the previous one, until
+  the mean moves less than tolerance (relative to its squared size) or maxIterations is reached.
+  Returns the mean shape (K x 3), the aligned shapes (S x K x 3) and their Procrustes distances (S).
+  """
+  shapes = np.array(shapes, dtype=np.float64)
+  centeredShapes = shapes - shapes.mean(axis=1, keepdims=True)
+  if mode == 'similarity':
+    sizes = np.sqrt(np.sum(centeredShapes**2, axis=(1,2)))
+    centeredShapes /= np.where(sizes > 0, sizes, 1)[:,np.newaxis,np.newaxis]
+    shapes = centeredShapes
+  meanShape = shapes[0].copy()
+  for iteration in range(maxIterations):
+    meanCentroid = meanShape.mean(axis=0)
+    rotations = optimalRotations(centeredShapes, meanShape - meanCentroid)
+    alignedShapes = np.einsum('sij,skj->ski', rotations, centeredShapes) + meanCentroid
+
+    newMean = alignedShapes.mean(axis=0)
+    if mode == 'similarity':
+      newMean = normalizeShape(newMean)
+    newMean = newMean - newMean.mean(axis=0)
+    newMean = newMean @ optimalRotations(newMean[np.newaxis], meanShape - meanCentroid)[0].T + meanCentroid
+    change = np.sum((newMean - meanShape)**2) / max(np.sum((meanShape - meanCentroid)**2), np.finfo(float).tiny)
+    meanShape = newMean
+    if change < tolerance:
+      break
+  return meanShape, alignedShapes, procrustesDistances(alignedShapes, meanShape)
+
+def applyAlignment(points, rotation, scale, translation):
+  """Apply one subject's alignment to an N x 3 array."""
+  return scale * (np.asarray(points) @ rotation.T) + translation
+
+def alignPolyData(polydata, rotation, scale, translation):
+  """Apply an alignment in place to the points and normals of a mesh."""
+  points = vtk_np.vtk_to_numpy(polydata.GetPoints().GetData())
+  points[:] = applyAlignment(points, rotation, scale, translation)
+  polydata.GetPoints().Modified()
+  normals = polydata.GetPointData().GetNormals()
+  if normals:
+    normalArray = vtk_np.vtk_to_numpy(normals)
+    normalArray[:] = normalArray @ rotation.T
+    normals.Modified()
+  return polydata
@@ -0,0 +1,1154 @@
+import contextlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import vtk
+import vtk.util.numpy_support as vtk_np
+
+from .Alignment import landmarkAlignments, applyAlignment, alignPolyData, generalizedProcrustes, procrustesDistances
+from .Benchmark import benchmarkCohorts
+from .Cache import ArtifactStore, contentHash
+from .ClosestPoint import closestPointBackends
+from .CPD import defaultCPDParameters, normalizedSize, registrationFromParameters
+from .Correspondence import CorrespondenceContext, denseSurfaceCorrespondence, numpyToVTKPoints, transformPolyData
+from .Jobs import RunCancelled
+from .LandmarkIO import readLandmarks, readLandmarkDirectory, readLandmarkFiles, writeLandmarks, writeLandmarkFiles
+from .Manifest import SubjectManifest
+from .MeshIO import readMesh, readMeshes, writeMesh
+from .Parallel import denseCorrespondenceParallel
+from .Profiling import RunProfile
+from .Subsampling import loadTemplateSampler, templateSamplingMethods
+from .Sweep import SweepData, parameterGrid, runSweep, writeSweepSummary
+from .Streaming import (RunningStatistics, FeatureSpill, CorrespondenceTensor, appendArrayRows, appendCorrespondenceTensor,
+  correspondenceMetadataPath, correspondencePolygonPath, readCorrespondenceTensor, readResultModel, readResultSubjectIDs,
+  truncateArrayRows, truncateCorrespondenceTensor, writeResultModel, writeTextAtomic)
+
+logger = logging.getLogger(__name__)
+
+#
+# DeCABatchLogic
+#
+
+class DeCABatchLogic:
+  """
+  DeCA workflows on plain VTK and NumPy data, with no MRML scene. Meshes and landmarks are read and
+  written directly and kept in the coordinate system of the files (LPS for files saved by Slicer).
+  DeCALogic derives from this class, reading files into the RAS coordinates of the scene.
+  """
+  # coordinate system meshes and landmarks are read into by loadMeshPolyData and importLandmarks
+  coordinateSystem = 'LPS'
+  # floating point type of the thin plate spline warps, 'float32' trades precision for speed
+  warpPrecision = 'float64'
+  # entries overriding the CPD parameters of denseCorrespondenceCPD, for example {"CPDLevels": 3}
+  cpdParameters = {}
+  # how DeCAL templates with a target point number are sampled, one of templateSamplingMethods
+  templateSamplingMethod = 'voxel'
+  # content-addressed store of GPA results, warped bases and correspondences, None disables it
+  cacheDirectory = os.path.join(os.path.expanduser('~'), '.cache', 'DeCA')
+  cacheSize = 2*2**30
+  artifactStore = None
+  # RunProfile of the run in progress, None outside the run entry points
+  profile = None
+  # progressCallback(stage, done, total) is called as each subject of a run finishes
+  progressCallback = None
+  cancelRequested = False
+
+  def getArtifactStore(self):
+    if self.artifactStore is None and self.cacheDirectory:
+      self.artifactStore = ArtifactStore(self.cacheDirectory, self.cacheSize)
+    return self.artifactStore
+
+  def cancel(self):
+    # runs stop with RunCancelled after the subject in progress, finished subjects stay in the artifact store
+    self.cancelRequested = True
+
+  def reportProgress(self, stage, done, total):
+    if self.cancelRequested:
+      self.cancelRequested = False
+      raise RunCancelled(f"{stage} cancelled after {done} of {total} subjects")
+    if self.progressCallback:
+      self.progressCallback(stage, done, total)
+
+  def startProfile(self, command, **settings):
+    self.profile = RunProfile(command, dict(settings, coordinateSystem=self.coordinateSystem, warpPrecision=self.warpPrecision))
+    if self.getArtifactStore():
+      self.getArtifactStore().startRun()
+
+  def profileStage(self, name):
+    # times a stage of the run in progress, a no-op outside profiled runs
+    return self.profile.stage(name) if self.profile else contextlib.nullcontext()
+
+  def addSubjectTimings(self, index, seconds, timings=None):
+    # correspondence latency of subject index of self.modelNames and the seconds of its steps
+    if self.profile:
+      self.profile.addTimings(timings or {})
+      self.profile.addSubject(self.modelNames[index], seconds)
+
+  def writeProfile(self, outputDirectory):
+    # run report next to the outputs, see Profiling.RunProfile, or only logged for a None directory
+    if self.profile:
+      self.profile.write(outputDirectory)
+      self.profile = None
+
+  def readLandmarkPolyData(self, path):
+    polydataPoints = vtk.vtkPolyData()
+    polydataPoints.SetPoints(numpyToVTKPoints(readLandmarks(path, self.coordinateSystem)))
+    return polydataPoints
+
+  def loadMeshPolyData(self, inputFilePath):
+    return readMesh(inputFilePath, self.coordinateSystem)
+
+  def importLandmarkArray(self, topDir):
+    logger.info("reading landmarks from %s", topDir)
+    with self.profileStage('import'):
+      return readLandmarkDirectory(topDir, self.coordinateSystem)
+
+  def importLandmarks(self, topDir):
+    subjectIDs, landmarks = self.importLandmarkArray(topDir)
+    return self.landmarkGroup(landmarks)
+
+  def landmarkGroup(self, landmarks):
+    # subjects x K x 3 landmark array as a group of point sets
+    fiducialGroup = vtk.vtkMultiBlockDataGroupFilter()
+    for subjectLandmarks in landmarks:
+      polydataPoints = vtk.vtkPolyData()
+      polydataPoints.SetPoints(numpyToVTKPoints(subjectLandmarks))
+      fiducialGroup.AddInputData(polydataPoints)
+    fiducialGroup.Update()
+    return fiducialGroup.GetOutput()
+
+  def setErrorCheckPath(self, outputDirectory, optionErrorOutput):
+    if optionErrorOutput:
+      self.errorCheckPath = os.path.join(outputDirectory, "errorChecking")
+      if not os.path.exists(self.errorCheckPath):
+        os.mkdir(self.errorCheckPath)
+
+  def landmarkArray(self, landmarks):
+    # points of a landmark group as a subjects x K x 3 array
+    return np.stack([vtk_np.vtk_to_numpy(landmarks.GetBlock(i).GetPoints().GetData()) for i in range(landmarks.GetNumberOfBlocks())])
+
+  def averageLandmarks(self, landmarks):
+    # mean landmark positions of a landmark group, as a K x 3 array
+    return self.landmarkArray(landmarks).mean(axis=0)
+
+  def landmarkTransform(self, sourcePoints, targetPoints, mode='rigid'):
+    transform = vtk.vtkLandmarkTransform()
+    transform.SetSourceLandmarks(numpyToVTKPoints(sourcePoints))
+    transform.SetTargetLandmarks(numpyToVTKPoints(targetPoints))
+    if mode == 'similarity':
+      transform.SetModeToSimilarity()
+    else:
+      transform.SetModeToRigidBody()
+    transform.Update()
+    return transform
+
+  def transformLandmarks(self, points, transform):
+    transformedPoints = vtk.vtkPoints()
+    transform.TransformPoints(numpyToVTKPoints(points), transformedPoints)
+    return vtk_np.vtk_to_numpy(transformedPoints.GetData()).astype(np.float64)
+
+  def subjectManifest(self, meshDirectory, lmDirectory, slmDirectory=None):
+    # manifests are kept with the cached artifacts, away from the dataset
+    manifestDirectory = os.path.join(self.cacheDirectory, 'manifests') if self.cacheDirectory else None
+    manifest = SubjectManifest.load(meshDirectory, lmDirectory, slmDirectory, manifestDirectory)
+    manifest.report()
+    return manifest
+
+  def importSubjects(self, meshDirectory, landmarkDirectory, threadNumber=None):
+    # subject IDs, meshes and landmark array of the subjects with both a mesh and a landmark file,
+    # paired by subject ID through the manifest
+    manifest = self.subjectManifest(meshDirectory, landmarkDirectory)
+    subjectIDs = manifest.subjectIDs()
+    logger.info("reading: %d meshes from %s", len(subjectIDs), meshDirectory)
+    models = self.importMeshFiles([manifest.meshPath(subjectID) for subjectID in subjectIDs], threadNumber)
+    logger.info("reading landmarks from %s", landmarkDirectory)
+    with self.profileStage('import'):
+      landmarks = readLandmarkFiles([manifest.landmarkPath(subjectID) for subjectID in subjectIDs], self.coordinateSystem)
+    return subjectIDs, models, landmarks
+
+  def runAlign(self, baseMeshPath, baseLMPath, meshDirectory, lmDirectory, ouputMeshDirectory, outputLMDirectory, removeScaleOption, slmDirectory, outputSLMDirectory, threadNumber=None):
+    semilandmarkOption = bool(slmDirectory and outputSLMDirectory)
+    targetPoints = readLandmarks(baseLMPath, self.coordinateSystem)
+    mode = 'similarity' if removeScaleOption else 'rigid'
+    manifest = self.subjectManifest(meshDirectory, lmDirectory, slmDirectory if semilandmarkOption else None)
+    subjectIDs = manifest.subjectIDs()
+    if not subjectIDs:
+      return
+
+    # Solve every subject's transform to the base at once
+    sourcePoints = np.stack([readLandmarks(manifest.landmarkPath(subjectID), self.coordinateSystem) for subjectID in subjectIDs])
+    rotations, scales, translations = landmarkAlignments(sourcePoints, targetPoints, mode)
+
+    def alignSubject(i):
+      subjectID = subjectIDs[i]
+      alignment = (rotations[i], scales[i], translations[i])
+      try:
+        currentMesh = self.loadMeshPolyData(manifest.meshPath(subjectID))
+      except (ValueError, IOError) as error:
+        logger.error("%s: %s", subjectID, error)
+        return subjectID
+
+      # save output files
+      writeMesh(alignPolyData(currentMesh, *alignment), os.path.join(ouputMeshDirectory, subjectID + '_align.ply'), self.coordinateSystem)
+      writeLandmarks(os.path.join(outputLMDirectory, subjectID + '_align.mrk.json'), applyAlignment(sourcePoints[i], *alignment), self.coordinateSystem)
+
+      # optional semi-landmark alignment
+      slmFilePath = manifest.semilandmarkPath(subjectID)
+      if slmFilePath :
+        alignedSemilandmarks = applyAlignment(readLandmarks(slmFilePath, self.coordinateSystem), *alignment)
+        writeLandmarks(os.path.join(outputSLMDirectory, subjectID + '_align.mrk.json'), alignedSemilandmarks, self.coordinateSystem)
+
+    # VTK releases the GIL while reading meshes but mostly holds it while writing them, as measured by
+    # Benchmark.benchmarkMeshIO, so threads overlap the reads of some subjects with the work of others
+    if threadNumber is None:
+      threadNumber = min(8, os.cpu_count() or 1)
+    failedSubjectIDs = []
+    with ThreadPoolExecutor(max_workers=max(1, threadNumber)) as executor:
+      try:
+        for done, failedSubjectID in enumerate(executor.map(alignSubject, range(len(subjectIDs))), 1):
+          if failedSubjectID:
+            failedSubjectIDs.append(failedSubjectID)
+          self.reportProgress('alignment', done, len(subjectIDs))
+      except RunCancelled:
+        executor.shutdown(cancel_futures=True)
+        raise
+    # the other subjects are written, the run fails so that the missing ones are not overlooked
+    if failedSubjectIDs:
+      raise IOError(f"Could not read the meshes of {len(failedSubjectIDs)} subjects: {', '.join(failedSubjectIDs)}")
+
+  def runMirroring(self, meshDirectory, lmDirectory, mirrorMeshDirectory, mirrorLMDirectory, mirrorAxis, mirrorIndexText, slmDirectory, outputSLMDirectory, mirrorSLMIndexText):
+    mirrorTransform = vtk.vtkTransform()
+    mirrorTransform.Scale(mirrorAxis[0], mirrorAxis[1], mirrorAxis[2])
+
+    #get order of mirrored sets
+    if len(mirrorIndexText) == 0:
+      raise ValueError("No landmark index for mirrored mesh")
+    mirrorIndex = np.asarray([int(x) for x in mirrorIndexText.split(",")])
+
+    semilandmarkOption = bool(slmDirectory and outputSLMDirectory and (len(mirrorSLMIndexText) != 0 ))
+    if semilandmarkOption:
+      mirrorSLMIndex = np.asarray([int(x) for x in mirrorSLMIndexText.split(",")])
+
+    manifest = self.subjectManifest(meshDirectory, lmDirectory, slmDirectory if semilandmarkOption else None)
+    subjectIDs = manifest.subjectIDs()
+    for done, subjectID in enumerate(subjectIDs, 1):
+      currentMesh = self.loadMeshPolyData(manifest.meshPath(subjectID))
+      targetPoints = readLandmarks(manifest.landmarkPath(subjectID), self.coordinateSystem)
+
+      # mirror the surface mesh and landmarks, then reorder landmarks to match the original sides
+      mirrorMesh = transformPolyData(currentMesh, mirrorTransform)
+      mirrorPoints = self.transformLandmarks(targetPoints, mirrorTransform)[mirrorIndex]
+
+      # apply rigid transformation
+      rigidTransform = self.landmarkTransform(mirrorPoints, targetPoints, 'rigid')
+      normals = vtk.vtkPolyDataNormals()
+      normals.SetInputData(mirrorMesh)
+      normals.SetAutoOrientNormals(True)
+      normals.Update()
+      mirrorMesh = transformPolyData(normals.GetOutput(), rigidTransform)
+      mirrorPoints = self.transformLandmarks(mirrorPoints, rigidTransform)
+
+      # optional semi-landmark alignment
+      if semilandmarkOption:
+        slmFilePath = manifest.semilandmarkPath(subjectID)
+        if slmFilePath:
+          mirrorSemilandmarks = self.transformLandmarks(readLandmarks(slmFilePath, self.coordinateSystem), mirrorTransform)[mirrorSLMIndex]
+          mirrorSemilandmarks = self.transformLandmarks(mirrorSemilandmarks, rigidTransform)
+          writeLandmarks(os.path.join(outputSLMDirectory, subjectID + '_mirror.mrk.json'), mirrorSemilandmarks, self.coordinateSystem)
+
+      # save output files
+      writeMesh(mirrorMesh, os.path.join(mirrorMeshDirectory, subjectID + '_mirror.ply'), self.coordinateSystem)
+      writeLandmarks(os.path.join(mirrorLMDirectory, subjectID + '_mirror.mrk.json'), mirrorPoints, self.coordinateSystem)
+      self.reportProgress('mirroring', done, len(subjectIDs))
+
+  def runMean(self, landmarkDirectory, meshDirectory, modelExt, outputDirectory, workerNumber=1):
+    self.startProfile('mean', workers=workerNumber)
+    self.modelNames, models, landmarks = self.importSubjects(meshDirectory, landmarkDirectory)
+    landmarks = self.landmarkGroup(landmarks)
+    [denseCorrespondenceGroup, closestToMeanIndex] = self.denseCorrespondence(landmarks, models, workerNumber=workerNumber)
+    logger.info("Sample closest to mean: %s", closestToMeanIndex)
+    # compute mean model and landmarks
+    with self.profileStage('features'):
+      averagePolyData = self.computeAverageModelFromGroup(denseCorrespondenceGroup, closestToMeanIndex)
+      averageLandmarks = self.averageLandmarks(landmarks)
+
+    # save results to output directory
+    with self.profileStage('writes'):
+      writeMesh(averagePolyData, os.path.join(outputDirectory, 'decaMeanModel.ply'), self.coordinateSystem)
+      writeLandmarks(os.path.join(outputDirectory, 'decaMeanModel.mrk.json'), averageLandmarks, self.coordinateSystem)
+    self.writeProfile(outputDirectory)
+
+  def runDCAlign(self, baseMeshPath, baseLMPath, meshDirectory, landmarkDirectory, outputDirectory, optionCPD, optionErrorOutput, closestPointBackend='locator', workerNumber=1, optionPointOutput=False):
+    self.startProfile('deca', correspondence='CPD' if optionCPD else 'closest point', closestPointBackend=closestPointBackend, workers=workerNumber)
+    self.setErrorCheckPath(outputDirectory, optionErrorOutput)
+    self.removeEarlierResults(outputDirectory)
+    baseMesh = self.loadMeshPolyData(baseMeshPath)
+    baseLandmarks = self.readLandmarkPolyData(baseLMPath).GetPoints()
+    self.modelNames, models, landmarks = self.importSubjects(meshDirectory, landmarkDirectory)
+    landmarks = self.landmarkGroup(landmarks)
+    self.outputDirectory = outputDirectory
+    if not(optionCPD):
+      denseCorrespondenceGroup = self.denseCorrespondenceBaseMesh(landmarks, models, baseMesh, baseLandmarks, closestPointBackend, workerNumber)
+    else:
+      denseCorrespondenceGroup = self.denseCorrespondenceCPD(landmarks, models, baseMesh, baseLandmarks)
+
+    if optionPointOutput:
+      self.writeCorrespondenceTensor(os.path.join(outputDirectory, 'decaCorrespondences.npy'), denseCorrespondenceGroup, self.modelNames, baseMesh,
+        self.correspondenceParameters(baseMeshPath, baseLMPath, closestPointBackend, optionCPD))
+    magnitudes = self.addMagnitudeFeature(denseCorrespondenceGroup, self.modelNames, baseMesh)
+    # CPD results have no run state, so subjects cannot be added to them
+    if not(optionCPD):
+      self.writeRunState(outputDirectory, RunningStatistics.fromArray(magnitudes), self.meanShape, baseLandmarks, closestPointBackend)
+
+    # save results to output directory
+    with self.profileStage('writes'):
+      writeResultModel(baseMesh, os.path.join(outputDirectory, 'decaResultModel.vtp'), self.modelNames, self.coordinateSystem)
+    self.writeProfile(outputDirectory)
+
+  def runDCAlignStreaming(self, baseMeshPath, baseLMPath, meshDirectory, landmarkDirectory, outputDirectory, optionErrorOutput, closestPointBackend='locator', optionPointOutput=False):
+    self.startProfile('deca streaming', closestPointBackend=closestPointBackend)
+    self.setErrorCheckPath(outputDirectory, optionErrorOutput)
+    self.removeEarlierResults(outputDirectory)
+    baseMesh = self.loadMeshPolyData(baseMeshPath)
+    baseLandmarks = self.readLandmarkPolyData(baseLMPath).GetPoints()
+    parameters = self.correspondenceParameters(baseMeshPath, baseLMPath, closestPointBackend) if optionPointOutput else None
+    self.streamCorrespondences(baseMesh, baseLandmarks, meshDirectory, landmarkDirectory, outputDirectory, closestPointBackend, parameters)
+
+    # save results to output directory
+    with self.profileStage('writes'):
+      writeResultModel(baseMesh, os.path.join(outputDirectory, 'decaResultModel.vtp'), self.modelNames, self.coordinateSystem)
+    self.writeProfile(outputDirectory)
+
+  def streamCorrespondences(self, baseMesh, baseLandmarks, meshDirectory, landmarkDirectory, outputDirectory, closestPointBackend, tensorParameters=None):
+    # Read, correspond and discard one subject at a time. Per-point statistics are accumulated online
+    # and per-subject magnitudes are written to decaMagnitudes.npy instead of the result model.
+    # With tensorParameters the corresponding points are also written to decaCorrespondences.npy.
+    manifest = self.subjectManifest(meshDirectory, landmarkDirectory)
+    self.modelNames = manifest.subjectIDs()
+    logger.info("reading landmarks from %s", landmarkDirectory)
+    with self.profileStage('import'):
+      landmarks = self.landmarkGroup(readLandmarkFiles([manifest.landmarkPath(subjectID) for subjectID in self.modelNames], self.coordinateSystem))
+    self.outputDirectory = outputDirectory
+    meanShape, alignedPoints = self.procrustesImposition(landmarks, False)
+    context = self.createCorrespondenceContext(baseMesh, baseLandmarks, meanShape, closestPointBackend)
+
+    sampleNumber = len(self.modelNames)
+    pointNumber = baseMesh.GetNumberOfPoints()
+    basePoints = vtk_np.vtk_to_numpy(baseMesh.GetPoints().GetData())
+    statistics = RunningStatistics(pointNumber)
+    magnitudeSpill = FeatureSpill(os.path.join(outputDirectory, 'decaMagnitudes.npy'), sampleNumber, pointNumber)
+    tensor = None
+    if tensorParameters is not None:
+      tensor = CorrespondenceTensor(os.path.join(outputDirectory, 'decaCorrespondences.npy'), self.modelNames, baseMesh, tensorParameters)
+    try:
+      for i, subjectID in enumerate(self.modelNames):
+        logger.debug("reading: %s", manifest.meshPath(subjectID))
+        with self.profileStage('import'):
+          originalMesh = self.loadMeshPolyData(manifest.meshPath(subjectID))
+        correspondingMesh = self.denseSurfaceCorrespondencePair(originalMesh, landmarks.GetBlock(i).GetPoints(), context, i)
+        correspondingPoints = vtk_np.vtk_to_numpy(correspondingMesh.GetPoints().GetData())
+        with self.profileStage('features'):
+          magnitudes = np.linalg.norm(correspondingPoints - basePoints, axis=1)
+          statistics.update(magnitudes)
+        with self.profileStage('writes'):
+          magnitudeSpill.write(i, magnitudes)
+          if tensor:
+            tensor.write(i, correspondingPoints)
+    finally:
+      magnitudeSpill.close()
+      if tensor:
+        tensor.close()
+
+    with self.profileStage('writes'):
+      with open(os.path.join(outputDirectory, 'decaSubjects.txt'), 'w') as subjectFile:
+        subjectFile.write("\n".join(self.modelNames) + "\n")
+    self.writeRunState(outputDirectory, statistics, meanShape, baseLandmarks, closestPointBackend)
+
+    magnitudeMean = vtk_np.numpy_to_vtk(statistics.mean, deep=True)
+    magnitudeMean.SetName("Magnitude Mean")
+    magnitudeSD = vtk_np.numpy_to_vtk(statistics.standardDeviation(), deep=True)
+    magnitudeSD.SetName("Magnitude SD")
+    baseMesh.GetPointData().AddArray(magnitudeMean)
+    baseMesh.GetPointData().AddArray(magnitudeSD)
+
+  def removeEarlierResults(self, outputDirectory):
+    # The run state and the per-subject files of an earlier run in outputDirectory, which this run
+    # may not overwrite, would otherwise be extended by runDCAlignIncremental as if they were its own.
+    tensorPath = os.path.join(outputDirectory, 'decaCorrespondences.npy')
+    for path in (os.path.join(outputDirectory, 'decaState.npz'), os.path.join(outputDirectory, 'decaMagnitudes.npy'),
+      os.path.join(outputDirectory, 'decaSubjects.txt'), tensorPath, correspondenceMetadataPath(tensorPath), correspondencePolygonPath(tensorPath)):
+      if os.path.exists(path):
+        os.remove(path)
+
+  def writeRunState(self, outputDirectory, statistics, meanShape, baseLandmarks, closestPointBackend):
+    # What runDCAlignIncremental needs to add subjects without revisiting the ones already analysed.
+    # The state is replaced in one step and lists the subjects of the results, see truncateToRunState.
+    with self.profileStage('writes'):
+      partialPath = os.path.join(outputDirectory, 'decaState.partial.npz')
+      np.savez(partialPath, subjectIDs=np.array(self.modelNames), count=statistics.count,
+        mean=statistics.mean, sumSquares=statistics.sumSquares, meanShape=vtk_np.vtk_to_numpy(meanShape.GetData()),
+        baseLandmarks=vtk_np.vtk_to_numpy(baseLandmarks.GetData()), coordinateSystem=self.coordinateSystem,
+        closestPointBackend=closestPointBackend, warpPrecision=self.warpPrecision)
+      os.replace(partialPath, os.path.join(outputDirectory, 'decaState.npz'))
+
+  def runDCAlignIncremental(self, meshDirectory, landmarkDirectory, outputDirectory, workerNumber=1):
+    # Add the subjects of meshDirectory that are not yet in the shape analysis results of outputDirectory.
+    # They are corresponded against the stored mean shape and their magnitudes appended to
+    # decaMagnitudes.npy, and the Magnitude Mean and SD arrays are updated from the stored running sums,
+    # so the work and the writes grow with the new subjects only.
+    self.startProfile('add', workers=workerNumber)
+    statePath = os.path.join(outputDirectory, 'decaState.npz')
+    if not os.path.exists(statePath):
+      raise FileNotFoundError(f"No DeCA run state in {outputDirectory}, run the shape analysis first")
+    with np.load(statePath) as stateFile:
+      state = {key: stateFile[key] for key in stateFile.files}
+    statistics = RunningStatistics(len(state['mean']))
+    statistics.count, statistics.mean, statistics.sumSquares = int(state['count']), state['mean'], state['sumSquares']
+    meanShape, baseLandmarks = state['meanShape'], state['baseLandmarks']
+    if str(state['coordinateSystem']) != self.coordinateSystem:
+      meanShape, baseLandmarks = meanShape * [-1,-1,1], baseLandmarks * [-1,-1,1]
+    self.warpPrecision = str(state['warpPrecision'])
+    self.outputDirectory = outputDirectory
+
+    manifest = self.subjectManifest(meshDirectory, landmarkDirectory)
+    previousSubjectIDs = state['subjectIDs'].tolist()
+    newSubjectIDs = sorted(set(manifest.subjectIDs()) - set(previousSubjectIDs))
+    resultModelPath = os.path.join(outputDirectory, 'decaResultModel.vtp')
+    magnitudePath = os.path.join(outputDirectory, 'decaMagnitudes.npy')
+    subjectPath = os.path.join(outputDirectory, 'decaSubjects.txt')
+    tensorPath = os.path.join(outputDirectory, 'decaCorrespondences.npy')
+    self.truncateToRunState(outputDirectory, previousSubjectIDs)
+    logger.info("adding: %d subjects to %d", len(newSubjectIDs), len(previousSubjectIDs))
+    # a result model not yet replaced by an interrupted run is rewritten from the state
+    if not newSubjectIDs and readResultSubjectIDs(resultModelPath) == previousSubjectIDs:
+      self.profile = None
+      return
+
+    # the result model is the base mesh with the summary arrays
+    with self.profileStage('import'):
+      if os.path.exists(magnitudePath):
+        resultModel = baseMesh = readResultModel(resultModelPath, coordinateSystem=self.coordinateSystem)
+      else:
+        # results with a point array per subject have them moved out of the result model once
+        resultModel = baseMesh = self.loadMeshPolyData(resultModelPath)
+        self.moveSubjectArrays(resultModel, previousSubjectIDs, magnitudePath, subjectPath)
+    closestPointBackend = str(state['closestPointBackend'])
+    if newSubjectIDs:
+      context = self.createCorrespondenceContext(baseMesh, numpyToVTKPoints(baseLandmarks), numpyToVTKPoints(meanShape), closestPointBackend)
+      with self.profileStage('import'):
+        landmarkGroup = vtk.vtkMultiBlockDataGroupFilter()
+        for subjectID in newSubjectIDs:
+          landmarkGroup.AddInputData(self.readLandmarkPolyData(manifest.landmarkPath(subjectID)))
+        landmarkGroup.Update()
+        landmarks = landmarkGroup.GetOutput()
+        models = readMeshes([manifest.meshPath(subjectID) for subjectID in newSubjectIDs], reader=self.loadMeshPolyData)
+      self.modelNames = newSubjectIDs
+      if workerNumber > 1:
+        modelGroup = vtk.vtkMultiBlockDataGroupFilter()
+        for model in models:
+          modelGroup.AddInputData(model)
+        modelGroup.Update()
+        denseCorrespondenceGroup = self.denseCorrespondenceParallel(landmarks, modelGroup.GetOutput(), context, workerNumber)
+        correspondingPoints = np.stack([self.getCorrespondencePoints(denseCorrespondenceGroup, i) for i in range(len(newSubjectIDs))])
+      else:
+        correspondingPoints = np.stack([vtk_np.vtk_to_numpy(self.denseSurfaceCorrespondencePair(model,
+          landmarks.GetBlock(i).GetPoints(), context, i).GetPoints().GetData()) for i, model in enumerate(models)])
+      with self.profileStage('features'):
+        magnitudes = np.linalg.norm(correspondingPoints - vtk_np.vtk_to_numpy(baseMesh.GetPoints().GetData()), axis=2)
+        for subjectMagnitudes in magnitudes:
+          statistics.update(subjectMagnitudes)
+
+      with self.profileStage('writes'):
+        appendArrayRows(magnitudePath, magnitudes)
+        with open(subjectPath, 'a') as subjectFile:
+          subjectFile.write("\n".join(newSubjectIDs) + "\n")
+        if os.path.exists(tensorPath):
+          if readCorrespondenceTensor(tensorPath)[1]['parameters'].get('coordinateSystem', self.coordinateSystem) != self.coordinateSystem:
+            correspondingPoints = correspondingPoints * [-1,-1,1]
+          appendCorrespondenceTensor(tensorPath, newSubjectIDs, correspondingPoints)
+    # the new subjects are part of the results once the state lists them
+    self.modelNames = previousSubjectIDs + newSubjectIDs
+    self.writeRunState(outputDirectory, statistics, numpyToVTKPoints(meanShape), numpyToVTKPoints(baseLandmarks), closestPointBackend)
+
+    resultData = resultModel.GetPointData()
+    magnitudeMean = vtk_np.numpy_to_vtk(statistics.mean, deep=True)
+    magnitudeMean.SetName("Magnitude Mean")
+    magnitudeSD = vtk_np.numpy_to_vtk(statistics.standardDeviation(), deep=True)
+    magnitudeSD.SetName("Magnitude SD")
+    resultData.AddArray(magnitudeMean)
+    resultData.AddArray(magnitudeSD)
+    with self.profileStage('writes'):
+      # written next to the results and renamed, so an interrupted write leaves the earlier model
+      partialPath = os.path.join(outputDirectory, 'decaResultModel.partial.vtp')
+      writeResultModel(resultModel, partialPath, self.modelNames, self.coordinateSystem)
+      os.replace(partialPath, resultModelPath)
+    self.writeProfile(outputDirectory)
+
+  def truncateToRunState(self, outputDirectory, subjectIDs):
+    # New subjects are appended to decaMagnitudes.npy, decaSubjects.txt and decaCorrespondences.npy
+    # before decaState.npz lists them, so the subjects past those of the state were left by an
+    # interrupted run and are removed.
+    magnitudePath = os.path.join(outputDirectory, 'decaMagnitudes.npy')
+    subjectPath = os.path.join(outputDirectory, 'decaSubjects.txt')
+    tensorPath = os.path.join(outputDirectory, 'decaCorrespondences.npy')
+    truncated = os.path.exists(magnitudePath) and truncateArrayRows(magnitudePath, len(subjectIDs))
+    if os.path.exists(tensorPath):
+      truncated = truncateCorrespondenceTensor(tensorPath, len(subjectIDs)) or truncated
+    if os.path.exists(subjectPath):
+      with open(subjectPath) as subjectFile:
+        listedSubjectIDs = [line.strip() for line in subjectFile if line.strip()]
+      if listedSubjectIDs != subjectIDs:
+        writeTextAtomic(subjectPath, "\n".join(subjectIDs) + "\n")
+        truncated = True
+    if truncated:
+      logger.warning("removed the subjects of an interrupted run from %s", outputDirectory)
+
+  def moveSubjectArrays(self, resultModel, subjectIDs, magnitudePath, subjectPath):
+    # the per-subject point arrays of a result model become the rows of a subjects x points .npy file,
+    # the layout written by streaming runs and read by SubjectFeatureStore
+    pointData = resultModel.GetPointData()
+    magnitudes = np.stack([vtk_np.vtk_to_numpy(pointData.GetArray(subjectID)) for subjectID in subjectIDs]).astype(np.float64)
+    writeTextAtomic(subjectPath, "\n".join(subjectIDs) + "\n")
+    # the magnitude file decides which layout later runs read, so it is renamed into place last
+    partialPath = os.path.splitext(magnitudePath)[0] + '.partial.npy'
+    np.save(partialPath, magnitudes)
+    os.replace(partialPath, magnitudePath)
+    for subjectID in subjectIDs:
+      pointData.RemoveArray(subjectID)
+
+  def runDCAlignSymmetric(self, baseMeshPath, baseLMPath, meshDir, landmarkDir, mirrorMeshDir, mirrorLandmarkDir, outputDir, optionCPD, optionErrorOutput, optionPointOutput, closestPointBackend='locator', workerNumber=1):
+    self.startProfile('deca symmetry', correspondence='CPD' if optionCPD else 'closest point', closestPointBackend=closestPointBackend,
+      workers=workerNumber)
+    self.setErrorCheckPath(outputDir, optionErrorOutput)
+    baseMesh = self.loadMeshPolyData(baseMeshPath)
+    baseLandmarks = self.readLandmarkPolyData(baseLMPath).GetPoints()
+    self.modelNames, models, landmarks = self.importSubjects(meshDir, landmarkDir)
+    landmarks = self.landmarkGroup(landmarks)
+    modelMirrorNames, mirrorModels, mirrorLandmarks = self.importSubjects(mirrorMeshDir, mirrorLandmarkDir)
+    mirrorLandmarks = self.landmarkGroup(mirrorLandmarks)
+    self.outputDirectory = outputDir
+    if not(optionCPD):
+      denseCorrespondenceGroup = self.denseCorrespondenceBaseMesh(landmarks, models, baseMesh, baseLandmarks, closestPointBackend, workerNumber)
+      denseCorrespondenceGroupMirror = self.denseCorrespondenceBaseMesh(mirrorLandmarks, mirrorModels, baseMesh, baseLandmarks, closestPointBackend, workerNumber)
+    else:
+      denseCorrespondenceGroup = self.denseCorrespondenceCPD(landmarks, models, baseMesh, baseLandmarks)
+      denseCorrespondenceGroupMirror = self.denseCorrespondenceCPD(mirrorLandmarks, mirrorModels, baseMesh, baseLandmarks)
+
+    if optionPointOutput:
+      parameters = self.correspondenceParameters(baseMeshPath, baseLMPath, closestPointBackend, optionCPD)
+      self.writeCorrespondenceTensor(os.path.join(outputDir, 'decaCorrespondences.npy'), denseCorrespondenceGroup, self.modelNames, baseMesh, parameters)
+      self.writeCorrespondenceTensor(os.path.join(outputDir, 'decaMirrorCorrespondences.npy'), denseCorrespondenceGroupMirror, modelMirrorNames, baseMesh, parameters)
+    self.addMagnitudeFeatureSymmetry(denseCorrespondenceGroup, denseCorrespondenceGroupMirror, self.modelNames, baseMesh)
+
+    # save results to output directory
+    with self.profileStage('writes'):
+      writeResultModel(baseMesh, os.path.join(outputDir, 'decaSymmetryResultModel.vtp'), self.modelNames, self.coordinateSystem)
+    self.writeProfile(outputDir)
+
+  def runDeCAL(self, baseMeshPath, baseLMPath, meshDirectory, landmarkDirectory, outputDirectory, spacingTolerance, closestPointBackend='locator',
+    workerNumber=1, optionArrayOutput=False, templatePointNumber=None, templateIndex=None):
+    # The template is the templateIndex points of the base mesh, such as a sample previewed with
+    # runCheckPoints, or else about templatePointNumber points or the points kept at the spacing tolerance.
+    self.startProfile('decal', closestPointBackend=closestPointBackend, workers=workerNumber)
+    sampler = loadTemplateSampler(baseMeshPath)
+    baseMesh = sampler.meshIn(self.coordinateSystem)
+    if templateIndex is None:
+      templateIndex = sampler.sample(spacingTolerance, templatePointNumber, self.templateSamplingMethod)
+    logger.info("The subsampled template has a total of %d points.", len(templateIndex))
+
+    baseLandmarks = self.readLandmarkPolyData(baseLMPath).GetPoints()
+    self.modelNames, models, landmarks = self.importSubjects(meshDirectory, landmarkDirectory)
+    landmarks = self.landmarkGroup(landmarks)
+    self.outputDirectory = outputDirectory
+    denseCorrespondenceGroup = self.denseCorrespondenceBaseMesh(landmarks, models, baseMesh, baseLandmarks, closestPointBackend, workerNumber)
+
+    # saving point correspondences
+    self.writeDeCALLandmarks(outputDirectory, denseCorrespondenceGroup, baseMesh, templateIndex, workerNumber, optionArrayOutput)
+    # the output directory is read back as a landmark directory, so the run report is only logged
+    self.writeProfile(None)
+
+  def runCheckPoints(self, baseMeshPath, spacingTolerance, templatePointNumber=None):
+    # base point indices of the DeCAL template; the base mesh and its samples are cached, so previews
+    # of other settings do not read the mesh again
+    return loadTemplateSampler(baseMeshPath).sample(spacingTolerance, templatePointNumber, self.templateSamplingMethod)
+
+  def writeDeCALLandmarks(self, outputDirectory, denseCorrespondenceGroup, baseMesh, templateIndex, workerNumber=1, optionArrayOutput=False):
+    # The template points of every subject are gathered into one subjects x K x 3 array, then all
+    # landmark files are written at once, split over workerNumber processes. With optionArrayOutput
+    # the array is also saved to decaLandmarks.npz with the subject IDs and template indices.
+    with self.profileStage('writes'):
+      sampleNumber = denseCorrespondenceGroup.GetNumberOfBlocks()
+      landmarks = np.empty((sampleNumber + 1, len(templateIndex), 3))
+      for i in range(sampleNumber):
+        landmarks[i] = self.getCorrespondencePoints(denseCorrespondenceGroup, i)[templateIndex]
+      # base node correspondences go last
+      landmarks[sampleNumber] = vtk_np.vtk_to_numpy(baseMesh.GetPoints().GetData())[templateIndex]
+      paths = [os.path.join(outputDirectory, subjectID + ".mrk.json") for subjectID in self.modelNames[:sampleNumber]]
+      paths.append(os.path.join(outputDirectory, "baseModel.mrk.json"))
+      writeLandmarkFiles(paths, landmarks, self.coordinateSystem, workerNumber)
+      if optionArrayOutput:
+        np.savez(os.path.join(outputDirectory, 'decaLandmarks.npz'), subjectIDs=np.array(self.modelNames[:sampleNumber]),
+          landmarks=landmarks[:sampleNumber], baseLandmarks=landmarks[sampleNumber], templateIndex=templateIndex,
+          coordinateSystem=self.coordinateSystem)
+
+  def runParameterSweep(self, baseMeshPath, baseLMPath, meshDirectory, landmarkDirectory, outputDirectory, grid, workerNumber=1):
+    # Meshes, landmarks and the Procrustes mean are prepared once and shared by every combination of
+    # grid, {parameter: list of values}. Writes one summary row per combination to decaSweep.csv.
+    baseMesh = self.loadMeshPolyData(baseMeshPath)
+    baseLandmarks = vtk_np.vtk_to_numpy(self.readLandmarkPolyData(baseLMPath).GetPoints().GetData())
+    self.modelNames, models, landmarks = self.importSubjects(meshDirectory, landmarkDirectory)
+    meanShape, _, _ = self.procrustesAnalysis(landmarks, 'similarity')
+    data = SweepData(baseMesh, baseLandmarks, meanShape, [models.GetBlock(i) for i in range(models.GetNumberOfBlocks())], landmarks)
+    fixedParameters = {"warpPrecision": self.warpPrecision}
+    fixedParameters.update(self.cpdParameters)
+    combinations = [dict(fixedParameters, **combination) for combination in parameterGrid(grid)]
+    logger.info("running: %d combinations on %d subjects", len(combinations), len(self.modelNames))
+    summaries = runSweep(data, combinations, workerNumber, lambda summary: logger.info("%s", summary))
+    writeSweepSummary(os.path.join(outputDirectory, 'decaSweep.csv'), summaries)
+    return summaries
+
+  def runBenchmark(self, reportPath, subjectCounts, pointCounts, workerNumber=1, workDirectory=None):
+    # every stage on synthetic cohorts, without the artifact store so that each run does the full work
+    self.cacheDirectory = None
+    self.artifactStore = None
+    return benchmarkCohorts(self, reportPath, subjectCounts, pointCounts, workerNumber, workDirectory)
+
+  def distanceMatrix(self, a):
+    """
+    Computes the euclidean distance matrix for n points in a 3D space
+    Returns a nXn matrix
+     """
+    id,jd=a.shape
+    fnx = lambda q : q - np.reshape(q, (id, 1))
+    dx=fnx(a[:,0])
+    dy=fnx(a[:,1])
+    dz=fnx(a[:,2])
+    return (dx**2.0+dy**2.0+dz**2.0)**0.5
+
+  def getMeshFileList(self, topDir, extensions):
+    return [file for file in sorted(os.listdir(topDir)) if file.endswith(tuple(extensions))]
+
+  def importMeshes(self, topDir, extensions, threadNumber=None):
+      fileList = self.getMeshFileList(topDir, extensions)
+      fileNameList = [os.path.splitext(file)[0] for file in fileList]
+      logger.info("reading: %d meshes from %s", len(fileList), topDir)
+      return fileNameList, self.importMeshFiles([os.path.join(topDir, file) for file in fileList], threadNumber)
+
+  def importMeshFiles(self, paths, threadNumber=None):
+      modelGroup = vtk.vtkMultiBlockDataGroupFilter()
+      with self.profileStage('import'):
+        polydataList = readMeshes(paths, threadNumber=threadNumber, reader=self.loadMeshPolyData)
+      for polydata in polydataList:
+        modelGroup.AddInputData(polydata)
+      modelGroup.Update()
+      return modelGroup.GetOutput()
+
+  def procrustesAnalysis(self, landmarks, mode='similarity'):
+    # generalized Procrustes analysis of a subjects x K x 3 array, reused from the artifact store
+    store = self.getArtifactStore()
+    key = contentHash('procrustes', landmarks, mode) if store else None
+    artifact = store.load(key) if store else None
+    if artifact is not None:
+      return artifact['meanShape'], artifact['alignedShapes'], artifact['distances']
+    with self.profileStage('GPA'):
+      meanShape, alignedShapes, distances = generalizedProcrustes(landmarks, mode)
+    if store:
+      store.save(key, meanShape=meanShape, alignedShapes=alignedShapes, distances=distances)
+    return meanShape, alignedShapes, distances
+
+  def procrustesImposition(self, originalLandmarks, sizeOption):
+    mode = 'rigid' if sizeOption else 'similarity'
+    meanShape, alignedShapes, _ = self.procrustesAnalysis(self.landmarkArray(originalLandmarks), mode)
+    alignedGroup = vtk.vtkMultiBlockDataGroupFilter()
+    for alignedShape in alignedShapes:
+      alignedPolyData = vtk.vtkPolyData()
+      alignedPolyData.SetPoints(numpyToVTKPoints(alignedShape))
+      alignedGroup.AddInputData(alignedPolyData)
+    alignedGroup.Update()
+    return [numpyToVTKPoints(meanShape), alignedGroup.GetOutput()]
+
+  def getClosestToMeanIndex(self, meanShape, alignedPoints):
+    if alignedPoints.GetNumberOfBlocks() == 0:
+      return 0
+    distances = procrustesDistances(self.landmarkArray(alignedPoints), vtk_np.vtk_to_numpy(meanShape.GetData()))
+    return int(np.argmin(distances))
+
+  def denseCorrespondence(self, originalLandmarks, originalMeshes, writeErrorOption=False, closestPointBackend='locator', workerNumber=1):
+    meanShape, _, distances = self.procrustesAnalysis(self.landmarkArray(originalLandmarks))
+    meanShape = numpyToVTKPoints(meanShape)
+    sampleNumber = originalLandmarks.GetNumberOfBlocks()
+    denseCorrespondenceGroup = vtk.vtkMultiBlockDataGroupFilter()
+    # get base mesh as the closest to the mean shape
+    baseIndex = int(np.argmin(distances))
+    baseMesh = originalMeshes.GetBlock(baseIndex)
+    baseLandmarks = originalLandmarks.GetBlock(baseIndex).GetPoints()
+    context = self.createCorrespondenceContext(baseMesh, baseLandmarks, meanShape, closestPointBackend)
+    if workerNumber > 1:
+      denseCorrespondenceGroup = self.denseCorrespondenceParallel(originalLandmarks, originalMeshes, context, workerNumber)
+      return denseCorrespondenceGroup, baseIndex
+    for i in range(sampleNumber):
+      correspondingMesh = self.denseSurfaceCorrespondencePair(originalMeshes.GetBlock(i),
+      originalLandmarks.GetBlock(i).GetPoints(), context, i)
+      denseCorrespondenceGroup.AddInputData(correspondingMesh)
+
+    denseCorrespondenceGroup.Update()
+    return denseCorrespondenceGroup.GetOutput(), baseIndex
+
+  def denseCorrespondenceCPD(self, originalLandmarks, originalMeshes, baseMesh, baseLandmarks, writeErrorOption=False, cpdParameters=None):
+    meanShape, alignedPoints = self.procrustesImposition(originalLandmarks, False)
+    sampleNumber = alignedPoints.GetNumberOfBlocks()
+    denseCorrespondenceGroup = vtk.vtkMultiBlockDataGroupFilter()
+
+    # assign parameters for CPD
+    parameters = dict(defaultCPDParameters)
+    parameters.update(self.cpdParameters)
+    parameters.update(cpdParameters or {})
+
+    normalization = self.cpdNormalization(baseMesh)
+    for i in range(sampleNumber):
+      start = time.perf_counter()
+      correspondingPoints = self.runCPDRegistration(originalMeshes.GetBlock(i), baseMesh, parameters, normalization)
+      seconds = time.perf_counter() - start
+      self.addSubjectTimings(i, seconds, {'CPD registration': seconds})
+      self.reportProgress('CPD registration', i + 1, sampleNumber)
+      # convert to vtkPoints
+      correspondingMesh = self.convertPointsToVTK(correspondingPoints)
+      correspondingMesh.SetPolys(baseMesh.GetPolys())
+      # convert to polydata
+      denseCorrespondenceGroup.AddInputData(correspondingMesh)
+      # write ouput
+      if writeErrorOption:
+        plyWriterSubject = vtk.vtkPLYWriter()
+        plyWriterSubject.SetFileName("/Users/sararolfe/Dropbox/SlicerWorkspace/SMwSML/Data/UBC/DECAOutCPD/" + str(i) + ".ply")
+        plyWriterSubject.SetInputData(correspondingMesh)
+        plyWriterSubject.Write()
+
+        plyWriterBase = vtk.vtkPLYWriter()
+        plyWriterBase.SetFileName("/Users/sararolfe/Dropbox/SlicerWorkspace/SMwSML/Data/UBC/DECAOutCPD/base.ply")
+        plyWriterBase.SetInputData(baseMesh)
+        plyWriterBase.Write()
+
+    denseCorrespondenceGroup.Update()
+    return denseCorrespondenceGroup.GetOutput()
+
+  def cpdNormalization(self, baseMesh):
+    # uniform scale giving the base the normalized size alpha, beta and the spacings are chosen in
+    basePoints = vtk_np.vtk_to_numpy(baseMesh.GetPoints().GetData())
+    return normalizedSize / np.max(basePoints.max(axis=0) - basePoints.min(axis=0))
+
+  def runCPDRegistration(self, sourceData, targetData, parameters, normalization=None):
+    # the scaled clouds are made in one pass from zero-copy views of the VTK points
+    if normalization is None:
+      normalization = self.cpdNormalization(targetData)
+    if parameters.get("CPDEngine", 'pycpd') != 'pycpd':
+      return self.runScalableCPDRegistration(sourceData, targetData, parameters, normalization)
+    sourceArray = np.multiply(vtk_np.vtk_to_numpy(sourceData.GetPoints().GetData()), normalization, dtype=np.float32)
+    targetArray = np.multiply(vtk_np.vtk_to_numpy(targetData.GetPoints().GetData()), normalization, dtype=np.float32)
+    registrationOutput = self.cpd_registration(targetArray, sourceArray, parameters["CPDIterations"], parameters["CPDTolerence"], parameters["alpha"], parameters["beta"])
+    deformed_array, _ = registrationOutput.register()
+    deformed_array /= normalization
+    return deformed_array
+
+  def runScalableCPDRegistration(self, subjectData, baseData, parameters, normalization):
+    # move the base points onto the subject, so the result has the points and polygons of the base mesh
+    basePoints = np.multiply(vtk_np.vtk_to_numpy(baseData.GetPoints().GetData()), normalization, dtype=np.float64)
+    subjectPoints = np.multiply(vtk_np.vtk_to_numpy(subjectData.GetPoints().GetData()), normalization, dtype=np.float64)
+    correspondingPoints = registrationFromParameters(basePoints, subjectPoints, parameters).register()
+    correspondingPoints /= normalization
+    return correspondingPoints
+
+  def cpd_registration(self, targetArray, sourceArray, CPDIterations, CPDTolerence, alpha_parameter, beta_parameter):
+    from pycpd import DeformableRegistration
+    output = DeformableRegistration(**{'X': targetArray, 'Y': sourceArray,'max_iterations': CPDIterations, 'tolerance': CPDTolerence}, alpha = alpha_parameter, beta  = beta_parameter)
+    return output
+
+  def denseCorrespondenceBaseMesh(self, originalLandmarks, originalMeshes, baseMesh, baseLandmarks, closestPointBackend='locator', workerNumber=1):
+    meanShape, alignedPoints = self.procrustesImposition(originalLandmarks, False)
+    self.meanShape = meanShape
+    sampleNumber = alignedPoints.GetNumberOfBlocks()
+    context = self.createCorrespondenceContext(baseMesh, baseLandmarks, meanShape, closestPointBackend)
+    if workerNumber > 1:
+      return self.denseCorrespondenceParallel(originalLandmarks, originalMeshes, context, workerNumber)
+    denseCorrespondenceGroup = vtk.vtkMultiBlockDataGroupFilter()
+    for i in range(sampleNumber):
+      correspondingMesh = self.denseSurfaceCorrespondencePair(originalMeshes.GetBlock(i),
+      originalLandmarks.GetBlock(i).GetPoints(), context, i)
+      denseCorrespondenceGroup.AddInputData(correspondingMesh)
+
+    denseCorrespondenceGroup.Update()
+    return denseCorrespondenceGroup.GetOutput()
+
+  def createCorrespondenceContext(self, baseMesh, baseLandmarks, meanShape, closestPointBackend):
+    # TPS warp the base mesh to the mean shape once for all subjects, or reuse a stored warp
+    store = self.getArtifactStore()
+    baseKey = contentHash('meanWarpedBase', baseMesh, baseLandmarks, meanShape, self.warpPrecision) if store else None
+    artifact = store.load(baseKey) if store else None
+    if artifact is None:
+      with self.profileStage('TPS warps'):
+        context = CorrespondenceContext.fromBase(baseMesh, baseLandmarks, meanShape, closestPointBackend, self.warpPrecision)
+      if store:
+        store.save(baseKey, points=context.meanWarpedBasePoints)
+    else:
+      meanWarpedBase = vtk.vtkPolyData()
+      meanWarpedBase.ShallowCopy(baseMesh)
+      meanWarpedBase.SetPoints(numpyToVTKPoints(artifact['points']))
+      meanWarpedBase.GetPointData().SetNormals(None)
+      context = CorrespondenceContext(meanWarpedBase, meanShape, closestPointBackend, self.warpPrecision)
+    if store:
+      context.cacheKey = contentHash(baseKey, closestPointBackend)
+
+    # write ouput
+    if hasattr(self,"errorCheckPath"):
+      plyWriterBase = vtk.vtkPLYWriter()
+      plyName = "base.ply"
+      plyPath = os.path.join(self.errorCheckPath, plyName)
+      plyWriterBase.SetFileName(plyPath)
+      plyWriterBase.SetInputData(context.meanWarpedBase)
+      plyWriterBase.Write()
+    return context
+
+  def correspondenceKey(self, context, originalMesh, originalLandmarks):
+    # artifact key of one subject's correspondence, None when it is not cached. Runs writing error
+    # checking meshes always recompute, since the warped subject meshes are not stored.
+    if context.cacheKey is None or hasattr(self, "errorCheckPath"):
+      return None
+    return contentHash(context.cacheKey, originalMesh, originalLandmarks)
+
+  def correspondingMeshFromPoints(self, points, context):
+    correspondingMesh = vtk.vtkPolyData()
+    correspondingMesh.SetPoints(numpyToVTKPoints(points))
+    correspondingMesh.SetPolys(context.meanWarpedBase.GetPolys())
+    return correspondingMesh
+
+  def denseSurfaceCorrespondencePair(self, originalMesh, originalLandmarks, context, iteration):
+    start = time.perf_counter()
+    key = self.correspondenceKey(context, originalMesh, originalLandmarks)
+    artifact = self.getArtifactStore().load(key) if key else None
+    if artifact is not None:
+      self.addSubjectTimings(iteration, time.perf_counter() - start)
+      self.reportProgress('correspondence', iteration + 1, len(self.modelNames))
+      return self.correspondingMeshFromPoints(artifact['points'], context)
+
+    # TPS warp target mesh to meanshape, find closest points to the warped base and warp back to the target
+    timings = {}
+    correspondingMesh, meanWarpedMesh = denseSurfaceCorrespondence(originalMesh, originalLandmarks, context, timings)
+    if key:
+      self.getArtifactStore().save(key, points=vtk_np.vtk_to_numpy(correspondingMesh.GetPoints().GetData()))
+    self.addSubjectTimings(iteration, time.perf_counter() - start, timings)
+
+    # write ouput
+    if hasattr(self,"errorCheckPath"):
+      plyWriterSubject = vtk.vtkPLYWriter()
+      logger.debug("writing the warped mesh of %s", self.modelNames[iteration])
+      plyName = "subject_" + self.modelNames[iteration] + ".ply"
+      plyPath = os.path.join(self.errorCheckPath, plyName)
+      plyWriterSubject.SetFileName(plyPath)
+      plyWriterSubject.SetInputData(meanWarpedMesh)
+      plyWriterSubject.Write()
+
+    self.reportProgress('correspondence', iteration + 1, len(self.modelNames))
+    return correspondingMesh
+
+  def denseCorrespondenceParallel(self, originalLandmarks, originalMeshes, context, workerNumber):
+    sampleNumber = originalMeshes.GetNumberOfBlocks()
+    meshList = [originalMeshes.GetBlock(i) for i in range(sampleNumber)]
+    landmarks_np = self.landmarkArray(originalLandmarks)
+
+    errorCheckMeshPaths = None
+    if hasattr(self,"errorCheckPath"):
+      errorCheckMeshPaths = [os.path.join(self.errorCheckPath, "subject_" + self.modelNames[i] + ".ply") for i in range(sampleNumber)]
+
+    # reuse stored correspondences and only send the remaining subjects to the workers
+    keys = [self.correspondenceKey(context, meshList[i], originalLandmarks.GetBlock(i).GetPoints()) for i in range(sampleNumber)]
+    correspondingPoints = [None] * sampleNumber
+    for i, key in enumerate(keys):
+      artifact = self.getArtifactStore().load(key) if key else None
+      if artifact is not None:
+        correspondingPoints[i] = artifact['points']
+    pending = [i for i in range(sampleNumber) if correspondingPoints[i] is None]
+    if len(pending) < sampleNumber:
+      logger.info("reusing stored correspondences for %d of %d subjects", sampleNumber - len(pending), sampleNumber)
+
+    if pending:
+      finishedNumber = sampleNumber - len(pending)
+      def storeResult(index, points):
+        nonlocal finishedNumber
+        if keys[pending[index]]:
+          self.getArtifactStore().save(keys[pending[index]], points=points)
+        finishedNumber += 1
+        self.reportProgress('correspondence', finishedNumber, sampleNumber)
+      def storeTimings(index, timings):
+        self.addSubjectTimings(pending[index], timings.pop('subject'), timings)
+      pendingPoints = denseCorrespondenceParallel([meshList[i] for i in pending], landmarks_np[pending], context, workerNumber,
+        [errorCheckMeshPaths[i] for i in pending] if errorCheckMeshPaths else None, storeResult, storeTimings)
+      for j, i in enumerate(pending):
+        correspondingPoints[i] = pendingPoints[j]
+
+    denseCorrespondenceGroup = vtk.vtkMultiBlockDataGroupFilter()
+    for i in range(sampleNumber):
+      denseCorrespondenceGroup.AddInputData(self.correspondingMeshFromPoints(correspondingPoints[i], context))
+    denseCorrespondenceGroup.Update()
+    return denseCorrespondenceGroup.GetOutput()
+
+  def convertPointsToVTK(self, points):
+    array_vtk = vtk_np.numpy_to_vtk(points, deep=True, array_type=vtk.VTK_FLOAT)
+    points_vtk = vtk.vtkPoints()
+    points_vtk.SetData(array_vtk)
+    polydata_vtk = vtk.vtkPolyData()
+    polydata_vtk.SetPoints(points_vtk)
+    return polydata_vtk
+
+  def computeAverageModelFromGroup(self, denseCorrespondenceGroup, baseIndex):
+    sampleNumber = denseCorrespondenceGroup.GetNumberOfBlocks()
+    pointNumber = denseCorrespondenceGroup.GetBlock(0).GetNumberOfPoints()
+    groupArray_np = np.empty((pointNumber,3,sampleNumber))
+
+    # get base mesh as closest to the meanshape
+    baseMesh = denseCorrespondenceGroup.GetBlock(baseIndex)
+
+     # get points as array
+    for i in range(sampleNumber):
+      alignedMesh = denseCorrespondenceGroup.GetBlock(i)
+      alignedMesh_np = vtk_np.vtk_to_numpy(alignedMesh.GetPoints().GetData())
+      groupArray_np[:,:,i] = alignedMesh_np
+
+    #Calculate mean point positions of aligned group
+    averagePoints_np = np.mean(groupArray_np, axis=2)
+    averagePointsPolydata = self.convertPointsToVTK(averagePoints_np)
+
+    #Copy points into mesh with base connectivity
+    averageModel = vtk.vtkPolyData()
+    averageModel.SetPoints(averagePointsPolydata.GetPoints())
+    averageModel.SetPolys(baseMesh.GetPolys())
+    return averageModel
+
+  def getCorrespondencePoints(self, denseCorrespondenceGroup, index):
+    # zero-copy view of the corresponding points of one subject
+    return vtk_np.vtk_to_numpy(denseCorrespondenceGroup.GetBlock(index).GetPoints().GetData())
+
+
+  def correspondenceParameters(self, baseMeshPath, baseLMPath, closestPointBackend, optionCPD=False):
+    # run settings recorded with a correspondence tensor
+    return {
+      'baseMesh': os.path.abspath(baseMeshPath),
+      'baseLandmarks': os.path.abspath(baseLMPath),
+      'coordinateSystem': self.coordinateSystem,
+      'correspondence': 'CPD' if optionCPD else 'closest point',
+      'closestPointBackend': closestPointBackend,
+      'warpPrecision': self.warpPrecision,
+      }
+
+  def writeCorrespondenceTensor(self, path, denseCorrespondenceGroup, subjectIDs, baseMesh, parameters):
+    with self.profileStage('writes'):
+      tensor = CorrespondenceTensor(path, subjectIDs, baseMesh, parameters)
+      try:
+        for i in range(denseCorrespondenceGroup.GetNumberOfBlocks()):
+          tensor.write(i, self.getCorrespondencePoints(denseCorrespondenceGroup, i))
+      finally:
+        tensor.close()
+  def addFeatureArrays(self, model, featureArray, modelNameArray):
+    # attach one array per subject and the per-point statistics, sharing memory with featureArray
+    for i in range(featureArray.shape[0]):
+      subjectArray = vtk_np.numpy_to_vtk(featureArray[i], deep=False)
+      subjectArray.SetName(modelNameArray[i])
+      model.GetPointData().AddArray(subjectArray)
+
+    magnitudeMean = vtk_np.numpy_to_vtk(featureArray.mean(axis=0), deep=True)
+    magnitudeMean.SetName("Magnitude Mean")
+    magnitudeSD = vtk_np.numpy_to_vtk(featureArray.std(axis=0), deep=True)
+    magnitudeSD.SetName("Magnitude SD")
+    model.GetPointData().AddArray(magnitudeMean)
+    model.GetPointData().AddArray(magnitudeSD)
+
+  def addMagnitudeFeature(self, denseCorrespondenceGroup, modelNameArray, model):
+    with self.profileStage('features'):
+      return self.computeMagnitudeFeature(denseCorrespondenceGroup, modelNameArray, model)
+
+  def computeMagnitudeFeature(self, denseCorrespondenceGroup, modelNameArray, model):
+    sampleNumber = denseCorrespondenceGroup.GetNumberOfBlocks()
+    pointNumber = denseCorrespondenceGroup.GetBlock(0).GetNumberOfPoints()
+    modelPoints = vtk_np.vtk_to_numpy(model.GetPoints().GetData())
+    # subjects x points distance array
+    statsArray = np.empty((sampleNumber, pointNumber))
+    for i in range(sampleNumber):
+      targetPoints = self.getCorrespondencePoints(denseCorrespondenceGroup, i)
+      statsArray[i] = np.linalg.norm(targetPoints - modelPoints, axis=1)
+    self.addFeatureArrays(model, statsArray, modelNameArray)
+    return statsArray
+
+  def addMagnitudeFeatureSymmetry(self, denseCorrespondenceGroup, denseCorrespondenceGroupMirror, modelNameArray, model):
+    with self.profileStage('features'):
+      self.computeMagnitudeFeatureSymmetry(denseCorrespondenceGroup, denseCorrespondenceGroupMirror, modelNameArray, model)
+
+  def computeMagnitudeFeatureSymmetry(self, denseCorrespondenceGroup, denseCorrespondenceGroupMirror, modelNameArray, model):
+    sampleNumber = denseCorrespondenceGroup.GetNumberOfBlocks()
+    pointNumber = denseCorrespondenceGroup.GetBlock(0).GetNumberOfPoints()
+    # subjects x points distance array
+    statsArray = np.empty((sampleNumber, pointNumber))
+    for i in range(sampleNumber):
+      targetPoints1 = self.getCorrespondencePoints(denseCorrespondenceGroup, i)
+      targetPoints2 = self.getCorrespondencePoints(denseCorrespondenceGroupMirror, i)
+      statsArray[i] = np.linalg.norm(targetPoints1 - targetPoints2, axis=1)
+    self.addFeatureArrays(model, statsArray, modelNameArray)
+
+#
+# Command line entry point
+#
+
+def main(argv=None):
+  """
+  Run a DeCA workflow without the Slicer application, for example:
+    PythonSlicer -m DeCALib deca --base-mesh base.ply --base-landmarks base.mrk.json --meshes aligned/meshes --landmarks aligned/landmarks --output results
+  """
+  import argparse
+  parser = argparse.ArgumentParser(prog='DeCALib', description='Dense correspondence analysis without the Slicer scene')
+  parser.add_argument('--verbose', '-v', action='store_true', help='also log every subject')
+  parser.add_argument('--quiet', '-q', action='store_true', help='only log warnings and errors')
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  def addBaseArguments(subparser):
+    subparser.add_argument('--base-mesh', required=True, help='base model file')
+    subparser.add_argument('--base-landmarks', required=True, help='base landmark file')
+
+  def addCacheArguments(subparser):
+    subparser.add_argument('--cache-dir', default=DeCABatchLogic.cacheDirectory, help='artifact store for resuming and reusing runs')
+    subparser.add_argument('--cache-size', type=float, default=DeCABatchLogic.cacheSize / 2**30, help='artifact store size limit in GB')
+    subparser.add_argument('--no-cache', action='store_true', help='do not read or write stored artifacts')
+
+  def addCorrespondenceArguments(subparser):
+    subparser.add_argument('--closest-point', choices=closestPointBackends, default='locator', help='closest point search backend')
+    subparser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    subparser.add_argument('--warp-precision', choices=('float64', 'float32'), default='float64', help='thin plate spline warp precision')
+    addCacheArguments(subparser)
+
+  alignParser = subparsers.add_parser('align', help='rigidly align all samples to the base sample')
+  addBaseArguments(alignParser)
+  alignParser.add_argument('--meshes', required=True, help='mesh directory')
+  alignParser.add_argument('--landmarks', required=True, help='landmark directory')
+  alignParser.add_argument('--output-meshes', required=True, help='aligned mesh directory')
+  alignParser.add_argument('--output-landmarks', required=True, help='aligned landmark directory')
+  alignParser.add_argument('--scale', action='store_true', help='include isotropic scaling in the alignment')
+  alignParser.add_argument('--semilandmarks', default='', help='semi-landmark directory')
+  alignParser.add_argument('--output-semilandmarks', default='', help='aligned semi-landmark directory')
+  alignParser.add_argument('--threads', type=int, default=None, help='number of mesh reading and writing threads')
+
+  meanParser = subparsers.add_parser('mean', help='generate a mean model from aligned samples')
+  meanParser.add_argument('--meshes', required=True, help='aligned mesh directory')
+  meanParser.add_argument('--landmarks', required=True, help='aligned landmark directory')
+  meanParser.add_argument('--output', required=True, help='mean output directory')
+  meanParser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+  addCacheArguments(meanParser)
+
+  mirrorParser = subparsers.add_parser('mirror', help='generate mirrored data for symmetry analysis')
+  mirrorParser.add_argument('--meshes', required=True, help='aligned mesh directory')
+  mirrorParser.add_argument('--landmarks', required=True, help='aligned landmark directory')
+  mirrorParser.add_argument('--output-meshes', required=True, help='mirrored mesh directory')
+  mirrorParser.add_argument('--output-landmarks', required=True, help='mirrored landmark directory')
+  mirrorParser.add_argument('--axis', choices=('x', 'y', 'z'), default='x', help='mirror axis')
+  mirrorParser.add_argument('--landmark-index', required=True, help='mirrored landmark order, for example 2,1,3,5,4')
+  mirrorParser.add_argument('--semilandmarks', default='', help='semi-landmark directory')
+  mirrorParser.add_argument('--output-semilandmarks', default='', help='mirrored semi-landmark directory')
+  mirrorParser.add_argument('--semilandmark-index', default='', help='mirrored semi-landmark order')
+
+  decaParser = subparsers.add_parser('deca', help='dense correspondence shape or symmetry analysis')
+  addBaseArguments(decaParser)
+  decaParser.add_argument('--meshes', required=True, help='rigidly aligned mesh directory')
+  decaParser.add_argument('--landmarks', required=True, help='rigidly aligned landmark directory')
+  decaParser.add_argument('--output', required=True, help='DeCA output directory')
+  decaParser.add_argument('--mirror-meshes', default='', help='mirrored mesh directory, runs symmetry analysis')
+  decaParser.add_argument('--mirror-landmarks', default='', help='mirrored landmark directory, runs symmetry analysis')
+  decaParser.add_argument('--cpd', action='store_true', help='find correspondences with coherent point drift instead of closest points')
+  decaParser.add_argument('--cpd-levels', type=int, default=0, help='coarse to fine CPD levels, each at half the spacing of the previous one')
+  decaParser.add_argument('--streaming', action='store_true', help='load one subject at a time (shape analysis)')
+  decaParser.add_argument('--error-output', action='store_true', help='write meshes for estimating correspondence error')
+  decaParser.add_argument('--point-output', action='store_true', help='write the corresponding points to decaCorrespondences.npy')
+  addCorrespondenceArguments(decaParser)
+
+  addParser = subparsers.add_parser('add', help='add new subjects to existing shape analysis results')
+  addParser.add_argument('--meshes', required=True, help='rigidly aligned mesh directory, subjects already in the results are skipped')
+  addParser.add_argument('--landmarks', required=True, help='rigidly aligned landmark directory')
+  addParser.add_argument('--output', required=True, help='DeCA output directory of the earlier run')
+  addParser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+  addCacheArguments(addParser)
+
+  sweepParser = subparsers.add_parser('sweep', help='compare CPD and correspondence settings over a parameter grid')
+  addBaseArguments(sweepParser)
+  sweepParser.add_argument('--meshes', required=True, help='rigidly aligned mesh directory')
+  sweepParser.add_argument('--landmarks', required=True, help='rigidly aligned landmark directory')
+  sweepParser.add_argument('--output', required=True, help='directory for decaSweep.csv')
+  sweepParser.add_argument('--grid', required=True,
+    help='JSON object or file of parameter lists, for example {"alpha": [1, 2], "beta": [1, 2, 4], "method": ["CPD", "closest point"]}')
+  sweepParser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+
+  benchmarkParser = subparsers.add_parser('benchmark', help='time every stage on synthetic cohorts of increasing size')
+  benchmarkParser.add_argument('--output', required=True, help='JSON report file')
+  benchmarkParser.add_argument('--subjects', default='4,8,16', help='subject counts of the subject scaling curve')
+  benchmarkParser.add_argument('--points', default='2000,8000,32000', help='mesh point counts of the point scaling curve')
+  benchmarkParser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+  benchmarkParser.add_argument('--work-dir', default=None, help='directory for the temporary cohorts')
+
+  decalParser = subparsers.add_parser('decal', help='dense correspondence landmarking')
+  addBaseArguments(decalParser)
+  decalParser.add_argument('--meshes', required=True, help='rigidly aligned mesh directory')
+  decalParser.add_argument('--landmarks', required=True, help='rigidly aligned landmark directory')
+  decalParser.add_argument('--output', required=True, help='DeCAL output directory')
+  decalParser.add_argument('--spacing-tolerance', type=float, default=4, help='template spacing as a percentage of the model diagonal')
+  decalParser.add_argument('--template-points', type=int, default=None, help='target number of template points, instead of the spacing tolerance')
+  decalParser.add_argument('--template-sampling', choices=templateSamplingMethods, default='voxel',
+    help="sampling for --template-points, 'voxel' is fast, 'farthest' gives the exact number")
+  decalParser.add_argument('--array-output', action='store_true', help='also save all landmarks as one array in decaLandmarks.npz')
+  addCorrespondenceArguments(decalParser)
+
+  args = parser.parse_args(argv)
+  # the streaming run corresponds one subject at a time by closest points in this process
+  if args.command == 'deca' and args.streaming and (args.cpd or args.workers > 1 or args.mirror_meshes):
+    decaParser.error("--streaming cannot be combined with --cpd, --workers or --mirror-meshes")
+  logging.basicConfig(level=logging.WARNING if args.quiet else logging.DEBUG if args.verbose else logging.INFO, format='%(message)s')
+  logic = DeCABatchLogic()
+  if hasattr(args, 'warp_precision'):
+    logic.warpPrecision = args.warp_precision
+  if hasattr(args, 'cpd_levels'):
+    logic.cpdParameters = {"CPDLevels": args.cpd_levels}
+  if hasattr(args, 'cache_dir'):
+    logic.cacheDirectory = None if args.no_cache else args.cache_dir
+    logic.cacheSize = int(args.cache_size * 2**30)
+  if args.command == 'align':
+    logic.runAlign(args.base_mesh, args.base_landmarks, args.meshes, args.landmarks, args.output_meshes, args.output_landmarks,
+      args.scale, args.semilandmarks, args.output_semilandmarks, args.threads)
+  elif args.command == 'mean':
+    logic.runMean(args.landmarks, args.meshes, None, args.output, args.workers)
+  elif args.command == 'mirror':
+    axis = [1,1,1]
+    axis['xyz'.index(args.axis)] = -1
+    logic.runMirroring(args.meshes, args.landmarks, args.output_meshes, args.output_landmarks, axis, args.landmark_index,
+      args.semilandmarks, args.output_semilandmarks, args.semilandmark_index)
+  elif args.command == 'deca':
+    if args.mirror_meshes and args.mirror_landmarks:
+      logic.runDCAlignSymmetric(args.base_mesh, args.base_landmarks, args.meshes, args.landmarks, args.mirror_meshes, args.mirror_landmarks,
+        args.output, args.cpd, args.error_output, args.point_output, args.closest_point, args.workers)
+    elif args.streaming:
+      logic.runDCAlignStreaming(args.base_mesh, args.base_landmarks, args.meshes, args.landmarks, args.output, args.error_output,
+        args.closest_point, args.point_output)
+    else:
+      logic.runDCAlign(args.base_mesh, args.base_landmarks, args.meshes, args.landmarks, args.output, args.cpd, args.error_output,
+        args.closest_point, args.workers, args.point_output)
+  elif args.command == 'add':
+    logic.runDCAlignIncremental(args.meshes, args.landmarks, args.output, args.workers)
+  elif args.command == 'sweep':
+    if os.path.isfile(args.grid):
+      with open(args.grid) as gridFile:
+        grid = json.load(gridFile)
+    else:
+      grid = json.loads(args.grid)
+    logic.runParameterSweep(args.base_mesh, args.base_landmarks, args.meshes, args.landmarks, args.output, grid, args.workers)
+  elif args.command == 'benchmark':
+    logic.runBenchmark(args.output, [int(x) for x in args.subjects.split(",")], [int(x) for x in args.points.split(",")],
+      args.workers, args.work_dir)
+  elif args.command == 'decal':
+    logic.templateSamplingMethod = args.template_sampling
+    logic.runDeCAL(args.base_mesh, args.base_landmarks, args.meshes, args.landmarks, args.output, args.spacing_tolerance,
+      args.closest_point, args.workers, args.array_output, args.template_points)
+  return 0
@@ -0,0 +1,215 @@
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import vtk
+import vtk.util.numpy_support as vtk_np
+from scipy.spatial import cKDTree
+
+from .CPD import farthestPointSample
+from .LandmarkIO import writeLandmarks
+from .MeshIO import readMesh, readMeshes, writeMesh
+
+#
+# Synthetic cohorts and stage timing
+#
+
+def templateSurface(pointNumber):
+  """Unit sphere mesh with about pointNumber points, mapped onto itself by mirroring in x."""
+  resolution = max(4, int(round(np.sqrt(pointNumber / 2))))
+  sphere = vtk.vtkSphereSource()
+  sphere.SetRadius(1)
+  # an even number of meridians, starting on the x axis, makes the mesh symmetric about x = 0
+  sphere.SetThetaResolution(2 * resolution)
+  sphere.SetPhiResolution(resolution + 2)
+  sphere.Update()
+  return sphere.GetOutput()
+
+def symmetricLandmarkIndices(points, landmarkNumber):
+  """
+  Vertex indices of landmarkNumber // 2 well spread points with x > 0 followed by their mirror
+  images, and the mirrored landmark order to pass to runMirroring.
+  """
+  pairNumber = max(landmarkNumber // 2, 2)
+  side = np.flatnonzero(points[:,0] > 1e-6)
+  indices = side[farthestPointSample(points[side], pairNumber)]
+  mirrorIndices = cKDTree(points).query(points[indices] * [-1,1,1])[1]
+  mirrorOrder = np.concatenate([np.arange(pairNumber, 2 * pairNumber), np.arange(pairNumber)])
+  return np.concatenate([indices, mirrorIndices]), mirrorOrder
+
+def syntheticSubject(unitPoints, random):
+  """
+  Skull-like variation of the unit sphere: a random ellipsoid with a flattened base and a few
+  Gaussian bumps, in a random pose. Points keep their order, so the landmarks are known vertices.
+  """
+  radii = np.array([60, 45, 50]) * random.uniform(0.85, 1.15, 3)
+  radialScale = np.ones(len(unitPoints))
+  for _ in range(4):
+    direction = random.normal(size=3)
+    direction /= np.linalg.norm(direction)
+    radialScale += random.uniform(-0.12, 0.12) * np.exp(-np.sum((unitPoints - direction)**2, axis=1) / (2 * 0.35**2))
+  points = unitPoints * radialScale[:,np.newaxis] * radii
+  points[:,2] = np.where(points[:,2] < -0.6 * radii[2], -0.6 * radii[2] + 0.3 * (points[:,2] + 0.6 * radii[2]), points[:,2])
+  axis = random.normal(size=3)
+  axis /= np.linalg.norm(axis)
+  angle = np.radians(random.uniform(-15, 15))
+  crossMatrix = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+  rotation = np.eye(3) + np.sin(angle) * crossMatrix + (1 - np.cos(angle)) * crossMatrix @ crossMatrix
+  return points @ rotation.T + random.uniform(-10, 10, 3)
+
+def writeSyntheticCohort(directory, subjectNumber, pointNumber, landmarkNumber=16, seed=0):
+  """
+  Writes subjectNumber synthetic meshes to directory/meshes and their landmarks to
+  directory/landmarks, returning the two directories, the template point number and the mirrored
+  landmark order as text.
+  """
+  template = templateSurface(pointNumber)
+  unitPoints = vtk_np.vtk_to_numpy(template.GetPoints().GetData()).astype(np.float64)
+  landmarkIndices, mirrorOrder = symmetricLandmarkIndices(unitPoints, landmarkNumber)
+  meshDirectory = os.path.join(directory, 'meshes')
+  landmarkDirectory = os.path.join(directory, 'landmarks')
+  os.makedirs(meshDirectory, exist_ok=True)
+  os.makedirs(landmarkDirectory, exist_ok=True)
+  random = np.random.default_rng(seed)
+  for i in range(subjectNumber):
+    points = syntheticSubject(unitPoints, random)
+    subject = vtk.vtkPolyData()
+    subject.ShallowCopy(template)
+    subjectPoints = vtk.vtkPoints()
+    subjectPoints.SetData(vtk_np.numpy_to_vtk(points, deep=True))
+    subject.SetPoints(subjectPoints)
+    subject.GetPointData().SetNormals(None)
+    writeMesh(subject, os.path.join(meshDirectory, f'subject{i:04d}.ply'))
+    writeLandmarks(os.path.join(landmarkDirectory, f'subject{i:04d}.mrk.json'), points[landmarkIndices])
+  return meshDirectory, landmarkDirectory, len(unitPoints), ','.join(str(index) for index in mirrorOrder)
+
+def pythonProgressDuring(call, seconds=0.25):
+  """
+  Rate of a pure Python loop in another thread while call() runs, repeated for at least seconds,
+  relative to its rate while the calling thread sleeps. Near 0 when call holds the GIL; when it
+  releases the GIL, near 1 with a free core or about 0.5 sharing one core with it.
+  """
+  counter = [0]
+  running = [True]
+  def count():
+    while running[0]:
+      counter[0] += 1
+  thread = threading.Thread(target=count, daemon=True)
+  thread.start()
+  try:
+    time.sleep(0.05)
+    start, startCount = time.perf_counter(), counter[0]
+    while time.perf_counter() - start < seconds:
+      call()
+    callSeconds, callCount = time.perf_counter() - start, counter[0] - startCount
+    sleepCount = counter[0]
+    time.sleep(callSeconds)
+    sleepCount = counter[0] - sleepCount
+  finally:
+    running[0] = False
+    thread.join()
+  return round(callCount / max(sleepCount, 1), 3)
+
+def benchmarkMeshIO(meshPaths, threadNumber, workDirectory):
+  """
+  Whether the VTK mesh reader and writer release the GIL, measured with pythonProgressDuring on
+  the first mesh, and the time to read all meshes serially and on threadNumber threads. Meshes that
+  take less than the interpreter's 5 ms switch interval to read or write give rough rates.
+  """
+  mesh = readMesh(meshPaths[0])
+  writePath = os.path.join(workDirectory, 'meshWrite.ply')
+  result = {'threads': threadNumber,
+    'readerPythonProgress': pythonProgressDuring(lambda: readMesh(meshPaths[0])),
+    'writerPythonProgress': pythonProgressDuring(lambda: writeMesh(mesh, writePath))}
+  os.remove(writePath)
+  for name, threads in (('serialRead', 1), ('threadedRead', threadNumber)):
+    start = time.perf_counter()
+    readMeshes(meshPaths, threadNumber=threads)
+    result[name] = round(time.perf_counter() - start, 4)
+  return result
+
+def benchmarkStages(logic, directory, subjectNumber, pointNumber, workerNumber=1, seed=0):
+  """
+  Runs every DeCA stage of logic on a synthetic cohort written to directory, returning the cohort
+  size and the wall time of each stage in seconds. Progress messages of the stages are not logged.
+  """
+  meshDirectory, landmarkDirectory, templatePointNumber, mirrorOrder = writeSyntheticCohort(
+    os.path.join(directory, 'cohort'), subjectNumber, pointNumber, seed=seed)
+  outputDirectories = {name: os.path.join(directory, name) for name in
+    ('alignedMeshes', 'alignedLandmarks', 'mean', 'deca', 'mirrorMeshes', 'mirrorLandmarks', 'symmetry', 'decal')}
+  for outputDirectory in outputDirectories.values():
+    os.makedirs(outputDirectory, exist_ok=True)
+  baseMeshPath = os.path.join(meshDirectory, 'subject0000.ply')
+  baseLandmarkPath = os.path.join(landmarkDirectory, 'subject0000.mrk.json')
+  meanMeshPath = os.path.join(outputDirectories['mean'], 'decaMeanModel.ply')
+  meanLandmarkPath = os.path.join(outputDirectories['mean'], 'decaMeanModel.mrk.json')
+  alignedMeshes, alignedLandmarks = outputDirectories['alignedMeshes'], outputDirectories['alignedLandmarks']
+  mirrorMeshes, mirrorLandmarks = outputDirectories['mirrorMeshes'], outputDirectories['mirrorLandmarks']
+  stages = [
+    ('runAlign', logic.runAlign, baseMeshPath, baseLandmarkPath, meshDirectory, landmarkDirectory, alignedMeshes, alignedLandmarks, False, '', ''),
+    ('runMean', logic.runMean, alignedLandmarks, alignedMeshes, None, outputDirectories['mean'], workerNumber),
+    ('runDCAlign', logic.runDCAlign, meanMeshPath, meanLandmarkPath, alignedMeshes, alignedLandmarks, outputDirectories['deca'],
+      False, False, 'locator', workerNumber),
+    ('runMirroring', logic.runMirroring, alignedMeshes, alignedLandmarks, mirrorMeshes, mirrorLandmarks, [-1,1,1], mirrorOrder, '', '', ''),
+    ('runDCAlignSymmetric', logic.runDCAlignSymmetric, meanMeshPath, meanLandmarkPath, alignedMeshes, alignedLandmarks, mirrorMeshes,
+      mirrorLandmarks, outputDirectories['symmetry'], False, False, False, 'locator', workerNumber),
+    ('runDeCAL', logic.runDeCAL, meanMeshPath, meanLandmarkPath, alignedMeshes, alignedLandmarks, outputDirectories['decal'], 4,
+      'locator', workerNumber),
+    ]
+  timings = {}
+  libraryLogger = logging.getLogger(__package__)
+  level = libraryLogger.level
+  libraryLogger.setLevel(logging.WARNING)
+  try:
+    for name, stage, *arguments in stages:
+      start = time.perf_counter()
+      stage(*arguments)
+      timings[name] = round(time.perf_counter() - start, 4)
+  finally:
+    libraryLogger.setLevel(level)
+  meshPaths = [os.path.join(meshDirectory, fileName) for fileName in sorted(os.listdir(meshDirectory))]
+  return {'subjects': subjectNumber, 'points': templatePointNumber, 'workers': workerNumber, 'stages': timings,
+    'total': round(sum(timings.values()), 4), 'meshIO': benchmarkMeshIO(meshPaths, min(8, os.cpu_count() or 1), directory)}
+
+def benchmarkEnvironment():
+  return {
+    'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    'platform': platform.platform(),
+    'processor': platform.processor(),
+    'cpuCount': os.cpu_count(),
+    'python': sys.version.split()[0],
+    'numpy': np.__version__,
+    'vtk': vtk.vtkVersion.GetVTKVersion(),
+    }
+
+def benchmarkCohorts(logic, reportPath, subjectCounts, pointCounts, workerNumber=1, workDirectory=None, seed=0):
+  """
+  Times the stages of logic over two scaling curves, subjectCounts at the first point count and
+  pointCounts at the first subject count, and writes them with the environment as JSON to
+  reportPath. Cohorts are written to temporary directories under workDirectory and removed after use.
+  """
+  # the run shared by both curves is timed once and listed under both
+  configurations = {}
+  for subjectNumber in subjectCounts:
+    configurations.setdefault((subjectNumber, pointCounts[0]), []).append('subjects')
+  for pointNumber in pointCounts:
+    configurations.setdefault((subjectCounts[0], pointNumber), []).append('points')
+  report = {'environment': benchmarkEnvironment(), 'runs': []}
+  for (subjectNumber, pointNumber), curves in configurations.items():
+    directory = tempfile.mkdtemp(prefix='decaBenchmark', dir=workDirectory)
+    try:
+      run = benchmarkStages(logic, directory, subjectNumber, pointNumber, workerNumber, seed)
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+    run['curves'] = curves
+    report['runs'].append(run)
+    logging.getLogger(__name__).info("%d subjects, %d points: %s s %s", run['subjects'], run['points'], run['total'], run['stages'])
+    with open(reportPath, 'w') as reportFile:
+      json.dump(report, reportFile, indent=2)
+  return report
@@ -0,0 +1,165 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+#
+# Coherent point drift for large point sets
+#
+
+# point sets are scaled to this largest extent, the units of alpha, beta and the spacings
+normalizedSize = 25
+
+defaultCPDParameters = {
+  "SpacingTolerance": .04,
+  "CPDIterations": 100,
+  "CPDTolerence": 0.001,
+  "alpha": 2,
+  "beta": 2,
+  "CPDEngine": 'lowrank',
+  "CPDRank": 200,
+  "CPDNeighbours": 16,
+  "CPDOutlierWeight": 0,
+  "CPDLevels": 0,
+  "CPDSpacings": None,
+  }
+
+def farthestPointSample(points, sampleNumber):
+  """Indices of sampleNumber points spread over points, each the farthest from those already chosen."""
+  sampleNumber = min(sampleNumber, len(points))
+  indices = np.zeros(sampleNumber, dtype=np.int64)
+  distances = np.sum((points - points[0])**2, axis=1)
+  for i in range(1, sampleNumber):
+    indices[i] = np.argmax(distances)
+    np.minimum(distances, np.sum((points - points[indices[i]])**2, axis=1), out=distances)
+  return indices
+
+def voxelDownsample(points, spacing):
+  """Centroids of the points falling in each cubic cell of size spacing, or all points for a spacing of 0."""
+  if spacing <= 0:
+    return points
+  _, cellIndices = np.unique(np.floor(points / spacing).astype(np.int64), axis=0, return_inverse=True)
+  cellIndices = cellIndices.ravel()
+  cellSizes = np.bincount(cellIndices)
+  return np.stack([np.bincount(cellIndices, weights=points[:,i]) for i in range(3)], axis=1) / cellSizes[:,np.newaxis]
+
+def gaussianKernel(points, centers, beta):
+  """Gaussian kernel matrix between points (N x 3) and centers (K x 3) with width beta."""
+  squaredDistances = np.einsum('ni,ni->n', points, points)[:,np.newaxis] + np.einsum('ki,ki->k', centers, centers) - 2 * points @ centers.T
+  return np.exp(-np.maximum(squaredDistances, 0) / (2 * beta**2))
+
+class DeformableCPD:
+  """
+  Deformable coherent point drift (Myronenko and Song, 2010) moving sourcePoints onto targetPoints
+  without N x M matrices. The correspondence probabilities of each target point are kept only for
+  its neighbours nearest source points, found with a KD-tree, and the displacement field is spanned
+  by the Gaussian kernel at rank source points chosen by farthest point sampling (a Nystrom
+  approximation of the kernel). Memory and time per iteration grow linearly with the point number.
+  alpha, beta and outlierWeight are the lambda, beta and w of the paper. sigma2 replaces the initial
+  variance estimated from the point sets, to continue from an earlier registration.
+  """
+  def __init__(self, sourcePoints, targetPoints, alpha=2, beta=2, maxIterations=100, tolerance=1e-3, rank=200, neighbours=16, outlierWeight=0, sigma2=None):
+    self.sourcePoints = np.asarray(sourcePoints, dtype=np.float64)
+    self.targetPoints = np.asarray(targetPoints, dtype=np.float64)
+    self.alpha = alpha
+    self.beta = beta
+    self.maxIterations = maxIterations
+    self.tolerance = tolerance
+    self.neighbours = min(neighbours, len(self.sourcePoints))
+    self.outlierWeight = outlierWeight
+    self.centers = self.sourcePoints[farthestPointSample(self.sourcePoints, rank)]
+    self.coefficients = np.zeros((len(self.centers), 3))
+    self.sourceKernel = gaussianKernel(self.sourcePoints, self.centers, beta)
+    self.centerKernel = gaussianKernel(self.centers, self.centers, beta)
+    self.transformedPoints = self.sourcePoints.copy()
+    self.sigma2 = self.initialVariance() if sigma2 is None else sigma2
+    self.iteration = 0
+
+  def initialVariance(self):
+    # mean squared distance over all source and target pairs, from the sums of the two sets
+    sourceNumber, targetNumber = len(self.sourcePoints), len(self.targetPoints)
+    squaredSum = sourceNumber * np.sum(self.targetPoints**2) + targetNumber * np.sum(self.transformedPoints**2)
+    crossSum = 2 * np.dot(self.targetPoints.sum(axis=0), self.transformedPoints.sum(axis=0))
+    return (squaredSum - crossSum) / (3 * sourceNumber * targetNumber)
+
+  def expectation(self):
+    """Truncated posterior probabilities, returned as their row sums P1, column sums Pt1 and P X."""
+    sourceNumber, targetNumber = len(self.sourcePoints), len(self.targetPoints)
+    distances, indices = cKDTree(self.transformedPoints).query(self.targetPoints, k=self.neighbours)
+    distances, indices = distances.reshape(targetNumber, -1), indices.reshape(targetNumber, -1)
+    probabilities = np.exp(-distances**2 / (2 * self.sigma2))
+    outlierTerm = (2 * np.pi * self.sigma2)**1.5 * self.outlierWeight / (1 - self.outlierWeight) * sourceNumber / targetNumber
+    denominator = probabilities.sum(axis=1) + outlierTerm
+    denominator[denominator == 0] = np.finfo(float).eps
+    probabilities /= denominator[:,np.newaxis]
+    Pt1 = probabilities.sum(axis=1)
+    P1 = np.bincount(indices.ravel(), weights=probabilities.ravel(), minlength=sourceNumber)
+    PX = np.stack([np.bincount(indices.ravel(), weights=(probabilities * self.targetPoints[:,i,np.newaxis]).ravel(), minlength=sourceNumber)
+      for i in range(3)], axis=1)
+    return P1, Pt1, PX
+
+  def maximization(self, P1, Pt1, PX):
+    # coefficients of the kernel centers minimizing the expected energy plus the kernel norm of the field
+    system = self.sourceKernel.T @ (P1[:,np.newaxis] * self.sourceKernel) + self.alpha * self.sigma2 * self.centerKernel
+    system[np.diag_indices_from(system)] += 1e-10 * np.trace(system) / len(system)
+    rightHandSide = self.sourceKernel.T @ (PX - P1[:,np.newaxis] * self.sourcePoints)
+    self.coefficients = np.linalg.solve(system, rightHandSide)
+    self.transformedPoints = self.sourcePoints + self.sourceKernel @ self.coefficients
+    matchedNumber = P1.sum()
+    sigma2 = (np.dot(Pt1, np.sum(self.targetPoints**2, axis=1)) - 2 * np.sum(PX * self.transformedPoints)
+      + np.dot(P1, np.sum(self.transformedPoints**2, axis=1))) / (3 * matchedNumber)
+    return sigma2 if sigma2 > 0 else self.tolerance / 10
+
+  def register(self):
+    """Runs EM until the variance changes by less than tolerance, returning the moved source points."""
+    for self.iteration in range(1, self.maxIterations + 1):
+      previousSigma2 = self.sigma2
+      self.sigma2 = self.maximization(*self.expectation())
+      if abs(self.sigma2 - previousSigma2) < self.tolerance:
+        break
+    return self.transformedPoints
+
+  def displacement(self, points):
+    """Displacement of the registration field at arbitrary points."""
+    return gaussianKernel(np.asarray(points, dtype=np.float64), self.centers, self.beta) @ self.coefficients
+
+class MultiResolutionCPD:
+  """
+  Coarse to fine DeformableCPD. Each level registers the source and target downsampled to its
+  spacing, starting from the source moved by the coarser levels and from their final variance, so
+  the finer levels converge in a few iterations. The levels' displacement fields are composed by
+  transformPoints, which carries the registration to any points, such as the full resolution source.
+  options are passed to DeformableCPD.
+  """
+  def __init__(self, sourcePoints, targetPoints, spacings=(0,), **options):
+    self.sourcePoints = np.asarray(sourcePoints, dtype=np.float64)
+    self.targetPoints = np.asarray(targetPoints, dtype=np.float64)
+    self.spacings = spacings
+    self.options = options
+    self.levels = []
+
+  def register(self):
+    """Registers each level in turn, returning the moved full resolution source points."""
+    self.levels = []
+    sigma2 = None
+    for spacing in self.spacings:
+      registration = DeformableCPD(self.transformPoints(voxelDownsample(self.sourcePoints, spacing)),
+        voxelDownsample(self.targetPoints, spacing), sigma2=sigma2, **self.options)
+      registration.register()
+      self.levels.append(registration)
+      sigma2 = registration.sigma2
+    return self.transformPoints(self.sourcePoints)
+
+  def transformPoints(self, points):
+    for registration in self.levels:
+      points = points + registration.displacement(points)
+    return points
+
+def registrationFromParameters(sourcePoints, targetPoints, parameters):
+  """
+  MultiResolutionCPD of normalized point sets configured by a DeCA CPD parameters dictionary.
+  CPDSpacings (fractions of the normalized size, coarse to fine) or CPDLevels halvings of
+  SpacingTolerance give the levels, by default a single full resolution level.
+  """
+  spacings = parameters["CPDSpacings"] or [parameters["SpacingTolerance"] / 2**level for level in range(parameters["CPDLevels"])] or [0]
+  return MultiResolutionCPD(sourcePoints, targetPoints, [spacing * normalizedSize for spacing in spacings],
+    alpha=parameters["alpha"], beta=parameters["beta"], maxIterations=parameters["CPDIterations"], tolerance=parameters["CPDTolerence"],
+    rank=parameters["CPDRank"], neighbours=parameters["CPDNeighbours"], outlierWeight=parameters["CPDOutlierWeight"])
@@ -0,0 +1,110 @@
+import hashlib
+import logging
+import os
+import tempfile
+import zipfile
+import numpy as np
+import vtk
+import vtk.util.numpy_support as vtk_np
+
+#
+# Content-addressed on-disk store of intermediate results
+#
+
+def contentHash(*parts):
+  """
+  Hash of arrays, vtkPoints, vtkPolyData (points and polygons) and plain values, used as artifact keys.
+  Equal content gives equal keys, whatever file or run the data came from.
+  """
+  digest = hashlib.blake2b(digest_size=20)
+  for part in parts:
+    if isinstance(part, vtk.vtkPolyData):
+      polys = part.GetPolys()
+      arrays = [vtk_np.vtk_to_numpy(part.GetPoints().GetData()),
+        vtk_np.vtk_to_numpy(polys.GetOffsetsArray()), vtk_np.vtk_to_numpy(polys.GetConnectivityArray())]
+    elif isinstance(part, vtk.vtkPoints):
+      arrays = [vtk_np.vtk_to_numpy(part.GetData())]
+    elif isinstance(part, np.ndarray):
+      arrays = [part]
+    else:
+      digest.update(repr(part).encode())
+      continue
+    for array in arrays:
+      digest.update(f'{array.dtype.str}{array.shape}'.encode())
+      digest.update(np.ascontiguousarray(array).tobytes())
+  return digest.hexdigest()
+
+class ArtifactStore:
+  """
+  Directory of .npz artifacts named by content hash. Artifacts are written atomically, so an
+  interrupted run leaves only complete entries and the next run resumes from them. When the store
+  grows beyond maxBytes the least recently used artifacts are removed, except those loaded or saved
+  since startRun: a run larger than maxBytes keeps all of its artifacts and logs a warning.
+  """
+  def __init__(self, directory, maxBytes=2*2**30):
+    self.directory = directory
+    self.maxBytes = maxBytes
+    self.size = None
+    self.runPaths = set()
+    self.runWarned = False
+
+  def startRun(self):
+    """Start a run, whose artifacts are kept until the next startRun."""
+    self.runPaths = set()
+    self.runWarned = False
+
+  def artifactPath(self, key):
+    return os.path.join(self.directory, key + '.npz')
+
+  def load(self, key):
+    """Returns the arrays stored under key as a dictionary, or None."""
+    path = self.artifactPath(key)
+    try:
+      with np.load(path) as artifact:
+        arrays = {name: artifact[name] for name in artifact.files}
+      os.utime(path)
+    except (OSError, ValueError, zipfile.BadZipFile):
+      return None
+    self.runPaths.add(path)
+    return arrays
+
+  def save(self, key, **arrays):
+    try:
+      os.makedirs(self.directory, exist_ok=True)
+      fileDescriptor, temporaryPath = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+      with os.fdopen(fileDescriptor, 'wb') as artifactFile:
+        np.savez(artifactFile, **arrays)
+      os.replace(temporaryPath, self.artifactPath(key))
+    except OSError as error:
+      logging.getLogger(__name__).warning("Could not cache artifact: %s", error)
+      return
+    self.runPaths.add(self.artifactPath(key))
+    if self.size is not None:
+      self.size += os.path.getsize(self.artifactPath(key))
+    if self.size is None or self.size > self.maxBytes:
+      self.evict()
+
+  def evict(self):
+    """Remove least recently used artifacts of earlier runs until the store fits in maxBytes."""
+    entries = []
+    with os.scandir(self.directory) as directoryEntries:
+      for entry in directoryEntries:
+        if entry.name.endswith('.npz'):
+          status = entry.stat()
+          entries.append((status.st_mtime, status.st_size, entry.path))
+    entries.sort()
+    self.size = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+      if self.size <= self.maxBytes:
+        break
+      if path in self.runPaths:
+        continue
+      try:
+        os.remove(path)
+        self.size -= size
+      except OSError:
+        pass
+    if self.size > self.maxBytes and not self.runWarned:
+      self.runWarned = True
+      logging.getLogger(__name__).warning("The cached artifacts of this run take %.2f GB, more than the %.2f GB cache size; "
+        "they are kept so that the run can resume, raise the cache size to keep them for later runs", self.size / 2**30, self.maxBytes / 2**30)
@@ -0,0 +1,103 @@
+import time
+import numpy as np
+import vtk
+import vtk.util.numpy_support as vtk_np
+
+from .ClosestPoint import ClosestPointLocator
+from .ThinPlateSpline import ThinPlateSpline
+
+#
+# Landmark-guided dense surface correspondence
+#
+
+def thinPlateSplineTransform(sourceLandmarks, targetLandmarks):
+  transform = vtk.vtkThinPlateSplineTransform()
+  transform.SetSourceLandmarks(sourceLandmarks)
+  transform.SetTargetLandmarks(targetLandmarks)
+  transform.SetBasisToR() # for 3D transform
+  return transform
+
+def transformPolyData(polydata, transform):
+  transformFilter = vtk.vtkTransformPolyDataFilter()
+  transformFilter.SetInputData(polydata)
+  transformFilter.SetTransform(transform)
+  transformFilter.Update()
+  return transformFilter.GetOutput()
+
+class CorrespondenceContext:
+  """
+  Base-side state shared by every subject of a run: the mean shape and the base mesh TPS warped
+  to it, with its points as an array ready for closest point queries. warpPrecision is the
+  floating point type ('float64' or 'float32') the thin plate spline kernels are evaluated in.
+  """
+  def __init__(self, meanWarpedBase, meanShape, closestPointBackend='locator', warpPrecision='float64'):
+    self.meanWarpedBase = meanWarpedBase
+    self.meanWarpedBasePoints = vtk_np.vtk_to_numpy(meanWarpedBase.GetPoints().GetData())
+    self.meanShape = meanShape
+    self.closestPointBackend = closestPointBackend
+    self.warpPrecision = warpPrecision
+    # key of the base-side inputs in an ArtifactStore, set when correspondences are cached
+    self.cacheKey = None
+
+  @classmethod
+  def fromBase(cls, baseMesh, baseLandmarks, meanShape, closestPointBackend='locator', warpPrecision='float64'):
+    meanWarpedBase = ThinPlateSpline(baseLandmarks, meanShape, warpPrecision).transformPolyData(baseMesh)
+    return cls(meanWarpedBase, meanShape, closestPointBackend, warpPrecision)
+
+def denseSurfaceCorrespondence(originalMesh, originalLandmarks, context, timings=None):
+  """
+  Finds the point on originalMesh corresponding to each base mesh point. The subject is TPS warped
+  to the mean shape, matched by closest point to the warped base of the CorrespondenceContext, and
+  the matches are warped back to the subject. Landmarks are vtkPoints. Returns the corresponding
+  mesh with base connectivity and the subject mesh warped to the mean shape. The seconds spent in
+  each step are added to the timings dictionary when one is given.
+  """
+  start = time.perf_counter()
+  meanWarpedMesh = ThinPlateSpline(originalLandmarks, context.meanShape, context.warpPrecision).transformPolyData(originalMesh)
+  warped = time.perf_counter()
+
+  # Dense correspondence
+  closestPointLocator = ClosestPointLocator(meanWarpedMesh, context.closestPointBackend)
+  built = time.perf_counter()
+  correspondingPoints_np = closestPointLocator.findClosestPoints(context.meanWarpedBasePoints)
+  queried = time.perf_counter()
+
+  # Apply inverse warping, the mean shape system is factored once and shared by all subjects
+  correspondingPoints_np = ThinPlateSpline(context.meanShape, originalLandmarks, context.warpPrecision).transformPoints(correspondingPoints_np)
+  if timings is not None:
+    for name, seconds in (('TPS warps', warped - start + time.perf_counter() - queried), ('locator build', built - warped),
+      ('closest point query', queried - built)):
+      timings[name] = timings.get(name, 0) + seconds
+
+  #Copy points into mesh with base connectivity
+  correspondingMesh = vtk.vtkPolyData()
+  correspondingMesh.SetPoints(numpyToVTKPoints(correspondingPoints_np))
+  correspondingMesh.SetPolys(context.meanWarpedBase.GetPolys())
+  return correspondingMesh, meanWarpedMesh
+
+#
+# Conversion between VTK and NumPy
+#
+
+def numpyToVTKPoints(array):
+  points = vtk.vtkPoints()
+  points.SetData(vtk_np.numpy_to_vtk(np.ascontiguousarray(array), deep=True))
+  return points
+
+def polyDataToCellArrays(polydata):
+  """Returns the points, polygon offsets and polygon connectivity of a mesh as NumPy arrays."""
+  points = vtk_np.vtk_to_numpy(polydata.GetPoints().GetData())
+  polys = polydata.GetPolys()
+  offsets = vtk_np.vtk_to_numpy(polys.GetOffsetsArray()).astype(np.int64)
+  connectivity = vtk_np.vtk_to_numpy(polys.GetConnectivityArray()).astype(np.int64)
+  return points, offsets, connectivity
+
+def cellArraysToPolyData(points, offsets, connectivity):
+  idType = vtk_np.get_vtk_to_numpy_typemap()[vtk.VTK_ID_TYPE]
+  polys = vtk.vtkCellArray()
+  polys.SetData(vtk_np.numpy_to_vtkIdTypeArray(np.asarray(offsets, dtype=idType), deep=True),
+    vtk_np.numpy_to_vtkIdTypeArray(np.asarray(connectivity, dtype=idType), deep=True))
+  polydata = vtk.vtkPolyData()
+  polydata.SetPoints(numpyToVTKPoints(points))
+  polydata.SetPolys(polys)
+  return polydata
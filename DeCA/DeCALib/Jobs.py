@@ -0,0 +1,80 @@
+import logging
+import logging.handlers
+import queue
+import threading
+
+#
+# Runs in the background of an application
+#
+
+class RunCancelled(Exception):
+  """Raised between subjects when a run is stopped with DeCABatchLogic.cancel."""
+
+class BackgroundJob:
+  """
+  Runs one DeCABatchLogic entry point, run(*arguments), in a worker thread, so an application's
+  event loop keeps running. Mesh reads and large NumPy operations release the GIL and
+  correspondences can use worker processes, so the caller keeps getting time; mesh writes mostly
+  hold it (see Benchmark.benchmarkMeshIO) and can briefly delay the caller. The latest per-subject
+  progress of the logic is kept in stage, done and total, and log records of the library are
+  queued in messages instead of being handled in the worker thread, for a UI to poll. cancel() stops the run between subjects; subjects already finished stay in the artifact
+  store, so starting the same run again resumes from them.
+  """
+  def __init__(self, logic, name, run, *arguments):
+    self.logic = logic
+    self.name = name
+    self.run = run
+    self.arguments = arguments
+    self.stage = name
+    self.done = 0
+    self.total = 0
+    self.result = None
+    self.error = None
+    self.cancelled = False
+    self.messages = queue.Queue()
+    self.thread = threading.Thread(target=self.execute, name=f'DeCA {name}', daemon=True)
+
+  def start(self):
+    self.logic.cancelRequested = False
+    self.logic.progressCallback = self.setProgress
+    self.thread.start()
+
+  def setProgress(self, stage, done, total):
+    self.stage, self.done, self.total = stage, done, total
+
+  def cancel(self):
+    self.logic.cancel()
+
+  def running(self):
+    return self.thread.is_alive()
+
+  def finished(self):
+    return not self.running() and self.thread.ident is not None
+
+  def execute(self):
+    libraryLogger = logging.getLogger(__package__)
+    handler = logging.handlers.QueueHandler(self.messages)
+    libraryLogger.addHandler(handler)
+    propagate = libraryLogger.propagate
+    libraryLogger.propagate = False
+    try:
+      self.result = self.run(*self.arguments)
+    except RunCancelled as error:
+      self.cancelled = True
+      libraryLogger.warning("%s", error)
+    except Exception as error:
+      self.error = error
+      libraryLogger.exception("%s failed", self.name)
+    finally:
+      libraryLogger.propagate = propagate
+      libraryLogger.removeHandler(handler)
+      self.logic.progressCallback = None
+
+  def pendingMessages(self):
+    """Returns the log records queued since the last call."""
+    records = []
+    while True:
+      try:
+        records.append(self.messages.get_nowait())
+      except queue.Empty:
+        return records
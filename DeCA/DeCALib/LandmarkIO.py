@@ -0,0 +1,160 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from .Parallel import processContext
+
+#
+# Landmark file reading and writing without markups nodes
+#
+
+landmarkExtensions = ('.fcsv', '.json')
+# each process writing landmark files formats at least this many points, fewer do not pay for its start
+writePointsPerWorker = 500000
+markupsSchema = 'https://raw.githubusercontent.com/slicer/slicer/master/Modules/Loadable/Markups/Resources/Schema/markups-schema-v1.0.3.json#'
+
+def convertCoordinateSystem(points, sourceCoordinateSystem, targetCoordinateSystem):
+  """Convert an N x 3 array between the LPS and RAS coordinate systems."""
+  if sourceCoordinateSystem.upper() == targetCoordinateSystem.upper():
+    return points
+  points = np.array(points, dtype=np.float64)
+  points[:,:2] *= -1
+  return points
+
+def readMarkupsJSON(path):
+  """Returns the control point positions (K x 3) and coordinate system of a .mrk.json file."""
+  with open(path) as landmarkFile:
+    markups = json.load(landmarkFile)['markups'][0]
+  coordinateSystem = markups.get('coordinateSystem', 'LPS')
+  # undefined control points keep their index with a zero position, as in the markups node
+  points = [controlPoint.get('position', [0,0,0]) for controlPoint in markups.get('controlPoints', [])]
+  return np.array(points, dtype=np.float64).reshape(-1, 3), coordinateSystem
+
+def readFCSV(path):
+  """Returns the point positions (K x 3) and coordinate system of a .fcsv file."""
+  coordinateSystem = 'RAS'
+  points = []
+  with open(path) as landmarkFile:
+    for line in landmarkFile:
+      if line.startswith('#'):
+        if line.startswith('# CoordinateSystem'):
+          value = line.split('=')[1].strip()
+          # older files store the coordinate system as 0 (RAS) or 1 (LPS)
+          coordinateSystem = {'0': 'RAS', '1': 'LPS'}.get(value, value)
+        continue
+      fields = line.split(',')
+      if len(fields) >= 4:
+        points.append([float(fields[1]), float(fields[2]), float(fields[3])])
+  return np.array(points, dtype=np.float64).reshape(-1, 3), coordinateSystem
+
+def readLandmarks(path, coordinateSystem='LPS'):
+  """Read a .fcsv, .json or .mrk.json landmark file as a K x 3 array in the requested coordinate system."""
+  if path.endswith('.fcsv'):
+    points, fileCoordinateSystem = readFCSV(path)
+  elif path.endswith('.json'):
+    points, fileCoordinateSystem = readMarkupsJSON(path)
+  else:
+    raise ValueError(f"Unsupported landmark format: {path}")
+  return convertCoordinateSystem(points, fileCoordinateSystem, coordinateSystem)
+
+def readLandmarkDirectory(directory, coordinateSystem='LPS'):
+  """
+  Read every landmark file in directory, in sorted file order, into one (subjects x K x 3) array.
+  Returns the subject IDs and the array.
+  """
+  fileNames = [fileName for fileName in sorted(os.listdir(directory)) if fileName.endswith(landmarkExtensions) and not fileName.startswith('.')]
+  landmarks = readLandmarkFiles([os.path.join(directory, fileName) for fileName in fileNames], coordinateSystem)
+  return [landmarkSubjectID(fileName) for fileName in fileNames], landmarks
+
+def readLandmarkFiles(paths, coordinateSystem='LPS'):
+  """Read landmark files with the same number of points into one (files x K x 3) array."""
+  landmarks = None
+  for i, path in enumerate(paths):
+    points = readLandmarks(path, coordinateSystem)
+    if landmarks is None:
+      landmarks = np.empty((len(paths),) + points.shape)
+    elif points.shape != landmarks.shape[1:]:
+      raise ValueError(f"{os.path.basename(path)} has {len(points)} landmarks, expected {landmarks.shape[1]}")
+    landmarks[i] = points
+  if landmarks is None:
+    landmarks = np.empty((0, 0, 3))
+  return landmarks
+
+class MarkupsJSONFormat:
+  """
+  Text of .mrk.json markups fiducial files with pointNumber control points. Everything but the
+  positions is formatted once, so writing many files of the same length, such as the DeCAL
+  landmarks of a cohort, only formats their coordinates.
+  """
+  def __init__(self, pointNumber, coordinateSystem='LPS'):
+    markups = {
+      '@schema': markupsSchema,
+      'markups': [{
+        'type': 'Fiducial',
+        'coordinateSystem': coordinateSystem,
+        'coordinateUnits': 'mm',
+        'controlPoints': None,
+        }],
+      }
+    header, footer = json.dumps(markups, indent=2).split('null')
+    self.header = header + "[\n"
+    self.footer = "\n      ]" + footer + "\n"
+    self.pointPrefixes = [f'        {{"id": "{i+1}", "label": "F-{i+1}", "position": [' for i in range(pointNumber)]
+
+  def text(self, points):
+    points = np.asarray(points, dtype=np.float64)
+    checkFinitePoints(points)
+    # repr gives the shortest text that reads back to the same float, as the json module writes it
+    lines = [f'{prefix}{x!r}, {y!r}, {z!r}], "positionStatus": "defined"}}'
+      for prefix, (x, y, z) in zip(self.pointPrefixes, points.tolist())]
+    return self.header + ",\n".join(lines) + self.footer
+
+def checkFinitePoints(points, path=None):
+  """Raise ValueError for NaN or infinite coordinates in a K x 3 array, which JSON cannot represent."""
+  invalid = np.flatnonzero(~np.isfinite(points).all(axis=1))
+  if len(invalid) > 0:
+    location = f" to {path}" if path else ""
+    raise ValueError(f"Cannot write landmarks{location}: {len(invalid)} of {len(points)} points have NaN or infinite "
+      f"coordinates, the first is point {invalid[0] + 1} at {points[invalid[0]].tolist()}")
+
+def writeLandmarks(path, points, coordinateSystem='LPS'):
+  """Write a K x 3 array in the given coordinate system as a .mrk.json markups fiducial file."""
+  points = np.asarray(points, dtype=np.float64)
+  checkFinitePoints(points, path)
+  text = MarkupsJSONFormat(len(points), coordinateSystem).text(points)
+  with open(path, 'w') as landmarkFile:
+    landmarkFile.write(text)
+
+def _writeLandmarkFiles(paths, landmarks, coordinateSystem):
+  markupsFormat = MarkupsJSONFormat(landmarks.shape[1], coordinateSystem)
+  for path, points in zip(paths, landmarks):
+    with open(path, 'w') as landmarkFile:
+      landmarkFile.write(markupsFormat.text(points))
+
+def writeLandmarkFiles(paths, landmarks, coordinateSystem='LPS', workerNumber=1):
+  """
+  Write each K x 3 array of landmarks (subjects x K x 3) to the .mrk.json file of the same index in
+  paths. With workerNumber above 1 the subjects are split over up to that many processes, as many
+  as the processors and the number of points allow.
+  """
+  landmarks = np.asarray(landmarks, dtype=np.float64)
+  # checked before any file is written
+  for path, points in zip(paths, landmarks):
+    checkFinitePoints(points, path)
+  workerNumber = min(workerNumber, os.cpu_count() or 1, landmarks.shape[0] * landmarks.shape[1] // writePointsPerWorker)
+  if workerNumber <= 1 or len(paths) <= 1:
+    _writeLandmarkFiles(paths, landmarks, coordinateSystem)
+    return
+  chunks = [chunk for chunk in np.array_split(np.arange(len(paths)), workerNumber) if len(chunk)]
+  with ProcessPoolExecutor(max_workers=len(chunks), mp_context=processContext()) as executor:
+    futures = [executor.submit(_writeLandmarkFiles, [paths[i] for i in chunk], landmarks[chunk], coordinateSystem) for chunk in chunks]
+    for future in futures:
+      future.result()
+
+def landmarkSubjectID(fileName):
+  # strip every landmark suffix, so that subject.mrk.json and subject.fcsv both give subject
+  base = fileName
+  while os.path.splitext(base)[1] in {'.fcsv', '.mrk', '.json'}:
+    base = os.path.splitext(base)[0]
+  return base
@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import tempfile
+
+from .Cache import contentHash
+from .LandmarkIO import landmarkExtensions, landmarkSubjectID
+from .MeshIO import meshReaderClasses
+
+#
+# Subject manifest: one directory scan pairing meshes, landmarks and semi-landmarks by subject ID
+#
+
+logger = logging.getLogger(__name__)
+
+manifestVersion = 2
+
+def scanDirectory(directory, extensions, subjectIDFunction):
+  """Returns {subjectID: [fileName, mtime_ns, size]} for the non-hidden files in directory with one of the extensions."""
+  files = {}
+  with os.scandir(directory) as entries:
+    for entry in entries:
+      if entry.name.startswith('.') or not entry.name.lower().endswith(extensions) or not entry.is_file():
+        continue
+      status = entry.stat()
+      files[subjectIDFunction(entry.name)] = [entry.name, status.st_mtime_ns, status.st_size]
+  return files
+
+def filesCurrent(directory, files):
+  """Whether every file of a scanDirectory result still has its recorded modification time and size."""
+  for fileName, mtime, size in files.values():
+    try:
+      status = os.stat(os.path.join(directory, fileName))
+    except OSError:
+      return False
+    if status.st_mtime_ns != mtime or status.st_size != size:
+      return False
+  return True
+
+def meshSubjectID(fileName):
+  return os.path.splitext(fileName)[0]
+
+class SubjectManifest:
+  """
+  Pairs the mesh, landmark and optional semi-landmark files of a dataset by subject ID from a single
+  scan of each directory. The manifest is saved in manifestDirectory, never in the dataset, with the
+  modification times of the directories and the modification times and sizes of the files. Later
+  runs reuse it until a file is added, removed or renamed, which changes its directory's time, or a
+  file is rewritten in place.
+  """
+  def __init__(self, meshDirectory, landmarkDirectory, semilandmarkDirectory=None, manifestDirectory=None):
+    self.meshDirectory = os.path.abspath(meshDirectory)
+    self.landmarkDirectory = os.path.abspath(landmarkDirectory)
+    self.semilandmarkDirectory = os.path.abspath(semilandmarkDirectory) if semilandmarkDirectory else None
+    self.manifestDirectory = manifestDirectory
+    self.directoryTimes = {}
+    self.meshes = {}
+    self.landmarks = {}
+    self.semilandmarks = {}
+
+  @classmethod
+  def load(cls, meshDirectory, landmarkDirectory, semilandmarkDirectory=None, manifestDirectory=None):
+    """
+    Returns the manifest saved in manifestDirectory for these directories if it is still current,
+    otherwise scans and saves a new one. With no manifestDirectory the directories are always scanned.
+    """
+    manifest = cls(meshDirectory, landmarkDirectory, semilandmarkDirectory, manifestDirectory)
+    if not manifest.read():
+      manifest.scan()
+      manifest.write()
+    return manifest
+
+  def directories(self):
+    return [directory for directory in (self.meshDirectory, self.landmarkDirectory, self.semilandmarkDirectory) if directory]
+
+  def currentDirectoryTimes(self):
+    return {directory: os.stat(directory).st_mtime_ns for directory in self.directories()}
+
+  def scan(self):
+    self.directoryTimes = self.currentDirectoryTimes()
+    self.meshes = scanDirectory(self.meshDirectory, tuple(meshReaderClasses), meshSubjectID)
+    self.landmarks = scanDirectory(self.landmarkDirectory, landmarkExtensions, landmarkSubjectID)
+    if self.semilandmarkDirectory:
+      self.semilandmarks = scanDirectory(self.semilandmarkDirectory, landmarkExtensions, landmarkSubjectID)
+
+  def manifestPath(self):
+    return os.path.join(self.manifestDirectory, contentHash(*self.directories()) + '.json')
+
+  def read(self):
+    """Load the saved manifest, returning False if it is missing, for other directories, or out of date."""
+    if not self.manifestDirectory:
+      return False
+    try:
+      with open(self.manifestPath()) as manifestFile:
+        saved = json.load(manifestFile)
+      if saved.get('version') != manifestVersion or saved['directories'] != [self.meshDirectory, self.landmarkDirectory, self.semilandmarkDirectory]:
+        return False
+      directoryTimes = self.currentDirectoryTimes()
+      if saved['directoryTimes'] != directoryTimes:
+        return False
+      if not (filesCurrent(self.meshDirectory, saved['meshes']) and filesCurrent(self.landmarkDirectory, saved['landmarks'])
+        and filesCurrent(self.semilandmarkDirectory, saved['semilandmarks'])):
+        return False
+    except (OSError, ValueError, KeyError):
+      return False
+    self.directoryTimes = directoryTimes
+    self.meshes = saved['meshes']
+    self.landmarks = saved['landmarks']
+    self.semilandmarks = saved['semilandmarks']
+    return True
+
+  def write(self):
+    if not self.manifestDirectory:
+      return
+    saved = {
+      'version': manifestVersion,
+      'directories': [self.meshDirectory, self.landmarkDirectory, self.semilandmarkDirectory],
+      'directoryTimes': self.directoryTimes,
+      'meshes': self.meshes,
+      'landmarks': self.landmarks,
+      'semilandmarks': self.semilandmarks,
+      }
+    try:
+      os.makedirs(self.manifestDirectory, exist_ok=True)
+      fileDescriptor, temporaryPath = tempfile.mkstemp(suffix='.tmp', dir=self.manifestDirectory)
+      with os.fdopen(fileDescriptor, 'w') as manifestFile:
+        json.dump(saved, manifestFile)
+      os.replace(temporaryPath, self.manifestPath())
+    except OSError as error:
+      # the directories are scanned again on the next run
+      logger.warning("Could not save subject manifest: %s", error)
+
+  def subjectIDs(self):
+    """Sorted IDs of the subjects that have both a mesh and a landmark file."""
+    return sorted(self.meshes.keys() & self.landmarks.keys())
+
+  def unmatchedMeshes(self):
+    return sorted(self.meshes.keys() - self.landmarks.keys())
+
+  def unmatchedLandmarks(self):
+    return sorted(self.landmarks.keys() - self.meshes.keys())
+
+  def meshPath(self, subjectID):
+    return os.path.join(self.meshDirectory, self.meshes[subjectID][0])
+
+  def landmarkPath(self, subjectID):
+    return os.path.join(self.landmarkDirectory, self.landmarks[subjectID][0])
+
+  def semilandmarkPath(self, subjectID):
+    """Returns the semi-landmark file of the subject, or None."""
+    if subjectID in self.semilandmarks:
+      return os.path.join(self.semilandmarkDirectory, self.semilandmarks[subjectID][0])
+    return None
+
+  def report(self):
+    """Log the subjects that are missing a mesh or landmark file."""
+    for subjectID in self.unmatchedMeshes():
+      logger.warning("no landmark file for mesh: %s", subjectID)
+    for subjectID in self.unmatchedLandmarks():
+      logger.warning("no mesh file for landmarks: %s", subjectID)
@@ -0,0 +1,130 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import vtk
+import vtk.util.numpy_support as vtk_np
+
+#
+# Mesh file reading and writing without the MRML scene
+#
+
+meshReaderClasses = {
+  '.ply': vtk.vtkPLYReader,
+  '.stl': vtk.vtkSTLReader,
+  '.obj': vtk.vtkOBJReader,
+  '.vtk': vtk.vtkPolyDataReader,
+  '.vtp': vtk.vtkXMLPolyDataReader,
+  }
+
+meshWriterClasses = {
+  '.ply': vtk.vtkPLYWriter,
+  '.stl': vtk.vtkSTLWriter,
+  '.vtk': vtk.vtkPolyDataWriter,
+  '.vtp': vtk.vtkXMLPolyDataWriter,
+  }
+
+def meshFileCoordinateSystem(path):
+  """
+  Returns the coordinate system a mesh file was saved in. As in Slicer, files are LPS unless
+  their header declares SPACE=RAS. XML files declare it in a SPACE field data array instead, see
+  readMesh.
+  """
+  with open(path, 'rb') as meshFile:
+    header = meshFile.read(1024)
+  return 'RAS' if b'SPACE=RAS' in header else 'LPS'
+
+def convertMeshCoordinateSystem(polydata, sourceCoordinateSystem, targetCoordinateSystem):
+  """Convert the points and normals of a mesh in place between the LPS and RAS coordinate systems."""
+  if sourceCoordinateSystem.upper() == targetCoordinateSystem.upper():
+    return polydata
+  # flipping the first two axes is a rotation, so polygon orientation is unchanged
+  points = vtk_np.vtk_to_numpy(polydata.GetPoints().GetData())
+  points[:,:2] *= -1
+  polydata.GetPoints().Modified()
+  normals = polydata.GetPointData().GetNormals()
+  if normals:
+    vtk_np.vtk_to_numpy(normals)[:,:2] *= -1
+    normals.Modified()
+  return polydata
+
+def readMesh(path, coordinateSystem=None):
+  """
+  Read a surface mesh file into vtkPolyData. By default the coordinates stored in the file are kept,
+  coordinateSystem ('LPS' or 'RAS') converts them instead.
+  """
+  extension = os.path.splitext(path)[1].lower()
+  if extension not in meshReaderClasses:
+    raise ValueError(f"Unsupported mesh format: {path}")
+  reader = meshReaderClasses[extension]()
+  reader.SetFileName(path)
+  reader.Update()
+  polydata = reader.GetOutput()
+  if polydata.GetNumberOfPoints() == 0:
+    raise IOError(f"Could not read mesh: {path}")
+  if coordinateSystem:
+    space = polydata.GetFieldData().GetAbstractArray('SPACE')
+    fileCoordinateSystem = space.GetValue(0) if space else meshFileCoordinateSystem(path)
+    convertMeshCoordinateSystem(polydata, fileCoordinateSystem, coordinateSystem)
+  return polydata
+
+def writeMesh(polydata, path, coordinateSystem=None, compress=True):
+  """
+  Write vtkPolyData to a surface mesh file. coordinateSystem ('LPS' or 'RAS'), the system the points
+  are in, is declared in the file so that readMesh and Slicer can convert them back. compress=False
+  writes .vtp arrays as raw appended data at fixed offsets, which can be memory-mapped.
+  """
+  extension = os.path.splitext(path)[1].lower()
+  if extension not in meshWriterClasses:
+    raise ValueError(f"Unsupported mesh format: {path}")
+  writer = meshWriterClasses[extension]()
+  writer.SetFileName(path)
+  if coordinateSystem:
+    space = f'SPACE={coordinateSystem.upper()}'
+    if extension == '.ply':
+      writer.AddComment(space)
+    elif extension in ('.stl', '.vtk'):
+      writer.SetHeader(space)
+    else:
+      # field data of a shallow copy, so that the caller's mesh is unchanged
+      spaceArray = vtk.vtkStringArray()
+      spaceArray.SetName('SPACE')
+      spaceArray.InsertNextValue(coordinateSystem.upper())
+      copy = vtk.vtkPolyData()
+      copy.ShallowCopy(polydata)
+      fieldData = vtk.vtkFieldData()
+      fieldData.ShallowCopy(polydata.GetFieldData())
+      fieldData.AddArray(spaceArray)
+      copy.SetFieldData(fieldData)
+      polydata = copy
+  writer.SetInputData(polydata)
+  if extension == '.ply':
+    writer.SetFileTypeToBinary()
+  if extension == '.vtp' and not compress:
+    writer.SetDataModeToAppended()
+    writer.EncodeAppendedDataOff()
+    writer.SetCompressorTypeToNone()
+    writer.SetHeaderTypeToUInt64()
+  if not writer.Write():
+    raise IOError(f"Could not write mesh: {path}")
+
+def readMeshArrays(path, coordinateSystem=None):
+  """Read a surface mesh file as NumPy arrays of points (N x 3), polygon offsets and connectivity."""
+  polydata = readMesh(path, coordinateSystem)
+  points = vtk_np.vtk_to_numpy(polydata.GetPoints().GetData())
+  polys = polydata.GetPolys()
+  return points, vtk_np.vtk_to_numpy(polys.GetOffsetsArray()), vtk_np.vtk_to_numpy(polys.GetConnectivityArray())
+
+def readMeshes(paths, coordinateSystem=None, threadNumber=None, reader=None):
+  """
+  Read mesh files on a thread pool, returning vtkPolyData in the order of paths. reader replaces
+  readMesh for each file. The VTK 9.7 readers release the GIL while parsing, as measured by
+  Benchmark.benchmarkMeshIO, so files can be read in parallel on several cores; the benchmark
+  report compares serial and threaded reads on the machine it runs on.
+  """
+  if reader is None:
+    reader = lambda path: readMesh(path, coordinateSystem)
+  if threadNumber is None:
+    threadNumber = min(8, os.cpu_count() or 1)
+  if threadNumber <= 1 or len(paths) <= 1:
+    return [reader(path) for path in paths]
+  with ThreadPoolExecutor(max_workers=threadNumber) as executor:
+    return list(executor.map(reader, paths))
@@ -0,0 +1,146 @@
+import os
+import sys
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+import vtk
+import vtk.util.numpy_support as vtk_np
+
+from . import Correspondence
+
+#
+# Process pool execution of per-subject dense correspondence
+#
+
+def pythonExecutable():
+  """
+  Returns the interpreter worker processes should be started with. Inside the Slicer application
+  sys.executable is the application itself, so use the PythonSlicer launcher next to it.
+  """
+  executableDir, executableName = os.path.split(sys.executable)
+  if executableName.lower().startswith('slicer'):
+    for launcherName in ('PythonSlicer', 'PythonSlicer.exe'):
+      launcherPath = os.path.join(executableDir, launcherName)
+      if os.path.exists(launcherPath):
+        return launcherPath
+  return sys.executable
+
+def processContext():
+  context = multiprocessing.get_context('spawn')
+  context.set_executable(pythonExecutable())
+  return context
+
+class SharedArray:
+  """
+  NumPy array in shared memory. The owning process creates it from an array, workers attach to it
+  through the picklable descriptor instead of receiving a copy.
+  """
+  def __init__(self, shape, dtype, name=None):
+    self.shape = tuple(shape)
+    self.dtype = np.dtype(dtype)
+    size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+    self.owner = name is None
+    # spawned workers share the resource tracker of the creating process, which unlinks the memory
+    self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+    self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.memory.buf)
+
+  @classmethod
+  def fromArray(cls, array):
+    array = np.ascontiguousarray(array)
+    sharedArray = cls(array.shape, array.dtype)
+    sharedArray.array[...] = array
+    return sharedArray
+
+  def descriptor(self):
+    return (self.shape, self.dtype.str, self.memory.name)
+
+  @classmethod
+  def attach(cls, descriptor):
+    shape, dtype, name = descriptor
+    return cls(shape, dtype, name)
+
+  def close(self):
+    self.array = None
+    self.memory.close()
+    if self.owner:
+      self.memory.unlink()
+
+_workerArrays = {}
+_workerContext = {}
+
+def _initializeWorker(descriptors, options):
+  for key, descriptor in descriptors.items():
+    _workerArrays[key] = SharedArray.attach(descriptor)
+  arrays = {key: sharedArray.array for key, sharedArray in _workerArrays.items()}
+  meanWarpedBase = Correspondence.cellArraysToPolyData(arrays['meanWarpedBasePoints'], arrays['baseOffsets'], arrays['baseConnectivity'])
+  _workerContext['context'] = Correspondence.CorrespondenceContext(meanWarpedBase,
+    Correspondence.numpyToVTKPoints(arrays['meanShape']), options['closestPointBackend'], options['warpPrecision'])
+
+def _correspondSubject(index, points, offsets, connectivity, errorCheckMeshPath):
+  start = time.perf_counter()
+  arrays = {key: sharedArray.array for key, sharedArray in _workerArrays.items()}
+  originalMesh = Correspondence.cellArraysToPolyData(points, offsets, connectivity)
+  timings = {}
+  correspondingMesh, meanWarpedMesh = Correspondence.denseSurfaceCorrespondence(originalMesh,
+    Correspondence.numpyToVTKPoints(arrays['landmarks'][index]), _workerContext['context'], timings)
+  if errorCheckMeshPath:
+    plyWriterSubject = vtk.vtkPLYWriter()
+    plyWriterSubject.SetFileName(errorCheckMeshPath)
+    plyWriterSubject.SetInputData(meanWarpedMesh)
+    plyWriterSubject.Write()
+  correspondingPoints = Correspondence.polyDataToCellArrays(correspondingMesh)[0]
+  arrays['output'][index] = correspondingPoints
+  timings['subject'] = time.perf_counter() - start
+  return index, timings
+
+def denseCorrespondenceParallel(originalMeshes, landmarks, context, workerNumber=None, errorCheckMeshPaths=None, resultCallback=None,
+  timingCallback=None):
+  """
+  Runs Correspondence.denseSurfaceCorrespondence for each subject in a pool of worker processes.
+  originalMeshes is a list of vtkPolyData, landmarks a (subjects x K x 3) array and context the
+  CorrespondenceContext of the run. The warped base mesh, landmarks, mean shape and the output are
+  placed in shared memory once, only the subject meshes are sent per task. Returns a
+  (subjects x base points x 3) array of corresponding points in the order of originalMeshes.
+  resultCallback(index, points) is called in this process as each subject finishes, and
+  timingCallback(index, timings) with the seconds of its correspondence steps and, under
+  'subject', of the whole subject in the worker.
+  """
+  if workerNumber is None:
+    workerNumber = os.cpu_count()
+  subjectNumber = len(originalMeshes)
+  basePoints, baseOffsets, baseConnectivity = Correspondence.polyDataToCellArrays(context.meanWarpedBase)
+  sharedArrays = {
+    'meanWarpedBasePoints': SharedArray.fromArray(basePoints),
+    'baseOffsets': SharedArray.fromArray(baseOffsets),
+    'baseConnectivity': SharedArray.fromArray(baseConnectivity),
+    'landmarks': SharedArray.fromArray(np.asarray(landmarks, dtype=np.float64)),
+    'meanShape': SharedArray.fromArray(vtk_np.vtk_to_numpy(context.meanShape.GetData()).astype(np.float64)),
+    'output': SharedArray((subjectNumber, len(basePoints), 3), np.float64),
+    }
+  try:
+    descriptors = {key: sharedArray.descriptor() for key, sharedArray in sharedArrays.items()}
+    options = {'closestPointBackend': context.closestPointBackend, 'warpPrecision': context.warpPrecision}
+    with ProcessPoolExecutor(max_workers=min(workerNumber, max(subjectNumber, 1)), mp_context=processContext(),
+      initializer=_initializeWorker, initargs=(descriptors, options)) as executor:
+      futures = []
+      for i, originalMesh in enumerate(originalMeshes):
+        points, offsets, connectivity = Correspondence.polyDataToCellArrays(originalMesh)
+        errorCheckMeshPath = errorCheckMeshPaths[i] if errorCheckMeshPaths else None
+        futures.append(executor.submit(_correspondSubject, i, points, offsets, connectivity, errorCheckMeshPath))
+      try:
+        for future in as_completed(futures):
+          index, timings = future.result()
+          if timingCallback:
+            timingCallback(index, timings)
+          if resultCallback:
+            resultCallback(index, sharedArrays['output'].array[index])
+      except BaseException:
+        # a failing subject or callback stops the run without starting the subjects still queued
+        executor.shutdown(cancel_futures=True)
+        raise
+    return sharedArrays['output'].array.copy()
+  finally:
+    for sharedArray in sharedArrays.values():
+      sharedArray.close()
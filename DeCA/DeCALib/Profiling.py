@@ -0,0 +1,95 @@
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+from collections import OrderedDict
+import numpy as np
+try:
+  import resource
+except ImportError:
+  resource = None
+
+#
+# Stage timing and run reports
+#
+
+runReportName = 'decaRunReport.json'
+
+def peakMemory():
+  """
+  Peak resident set size in bytes of this process and of the largest finished child process, such
+  as a correspondence worker, or None where the platform does not report it.
+  """
+  if resource is None:
+    return None, None
+  # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+  scale = 1 if sys.platform == 'darwin' else 1024
+  return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+class RunProfile:
+  """
+  Wall time of the stages of a run, per-subject correspondence latencies and peak memory, written
+  as a JSON run report. A stage may be timed many times, its seconds and calls add up. Stages can
+  be nested, so the stage times are not summed; the run's own wall time is reported separately.
+  Times measured in worker processes are added over all workers.
+  """
+  def __init__(self, command, settings=None):
+    self.command = command
+    self.settings = settings or {}
+    self.start = time.perf_counter()
+    self.stages = OrderedDict()
+    self.subjectLatencies = OrderedDict()
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.addStage(name, time.perf_counter() - start)
+
+  def addStage(self, name, seconds, calls=1):
+    stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+    stage['seconds'] += seconds
+    stage['calls'] += calls
+
+  def addTimings(self, timings):
+    """Adds a {stage: seconds} dictionary, such as the one filled by denseSurfaceCorrespondence."""
+    for name, seconds in timings.items():
+      self.addStage(name, seconds)
+
+  def addSubject(self, subjectID, seconds):
+    self.subjectLatencies[subjectID] = seconds
+
+  def report(self):
+    latencies = np.array(list(self.subjectLatencies.values()))
+    subjects = {'count': len(latencies)}
+    if len(latencies):
+      subjects.update({f'p{q}': round(float(np.percentile(latencies, q)), 4) for q in (50, 90, 95, 99)})
+      subjects.update({'mean': round(float(latencies.mean()), 4), 'max': round(float(latencies.max()), 4)})
+      slowest = sorted(self.subjectLatencies.items(), key=lambda item: item[1], reverse=True)[:5]
+      subjects['slowest'] = {subjectID: round(seconds, 4) for subjectID, seconds in slowest}
+    peakRSS, peakWorkerRSS = peakMemory()
+    return {
+      'command': self.command,
+      'settings': self.settings,
+      'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+      'wallTime': round(time.perf_counter() - self.start, 4),
+      'stages': {name: {'seconds': round(stage['seconds'], 4), 'calls': stage['calls']} for name, stage in self.stages.items()},
+      'subjectLatency': subjects,
+      'peakRSS': peakRSS,
+      'peakWorkerRSS': peakWorkerRSS,
+      }
+
+  def write(self, directory):
+    """Writes the report to decaRunReport.json in directory, when one is given, logs and returns it."""
+    report = self.report()
+    if directory:
+      with open(os.path.join(directory, runReportName), 'w') as reportFile:
+        json.dump(report, reportFile, indent=2)
+    logging.getLogger(__name__).info("%s finished in %.1f s, stages: %s", self.command, report['wallTime'],
+      ", ".join(f"{name} {stage['seconds']:.2f} s" for name, stage in report['stages'].items()))
+    return report
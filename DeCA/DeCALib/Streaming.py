@@ -0,0 +1,383 @@
+import io
+import json
+import logging
+import os
+import re
+from collections import OrderedDict
+import numpy as np
+import vtk
+import vtk.util.numpy_support as vtk_np
+
+from .MeshIO import convertMeshCoordinateSystem, meshFileCoordinateSystem, writeMesh
+
+logger = logging.getLogger(__name__)
+
+#
+# Out-of-core per-point features and correspondence output
+#
+
+summaryArrayNames = ("Magnitude Mean", "Magnitude SD")
+# field data array of a result model listing the subjects of the run
+subjectIDArrayName = 'SubjectIDs'
+# numpy types of the VTK XML array types
+vtkDataTypes = {'Int8': 'i1', 'UInt8': 'u1', 'Int16': 'i2', 'UInt16': 'u2', 'Int32': 'i4', 'UInt32': 'u4',
+  'Int64': 'i8', 'UInt64': 'u8', 'Float32': 'f4', 'Float64': 'f8'}
+
+#
+# Writing
+#
+
+class RunningStatistics:
+  """
+  Per-point mean and standard deviation accumulated one subject at a time with Welford's
+  algorithm, so no subjects x points array is needed. The standard deviation is the population
+  value, matching numpy.std.
+  """
+  def __init__(self, pointNumber):
+    self.count = 0
+    self.mean = np.zeros(pointNumber)
+    self.sumSquares = np.zeros(pointNumber)
+
+  def update(self, values):
+    self.count += 1
+    delta = values - self.mean
+    self.mean += delta / self.count
+    self.sumSquares += delta * (values - self.mean)
+
+  def variance(self):
+    if self.count == 0:
+      return np.zeros_like(self.mean)
+    return self.sumSquares / self.count
+
+  def standardDeviation(self):
+    return np.sqrt(self.variance())
+
+  @classmethod
+  def fromArray(cls, featureArray):
+    """Statistics of a subjects x points array, ready to be updated with further subjects."""
+    statistics = cls(featureArray.shape[1])
+    statistics.count = len(featureArray)
+    statistics.mean = featureArray.mean(axis=0)
+    statistics.sumSquares = featureArray.var(axis=0) * statistics.count
+    return statistics
+
+class FeatureSpill:
+  """
+  Subjects x points feature array backed by a .npy file on disk and filled one subject at a time.
+  Rows are flushed as they are written, so memory use does not grow with the number of subjects.
+  """
+  def __init__(self, path, subjectNumber, pointNumber, dtype=np.float64):
+    self.path = path
+    self.array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(subjectNumber, pointNumber))
+
+  def write(self, index, values):
+    self.array[index] = values
+    self.array.flush()
+
+  def close(self):
+    if self.array is not None:
+      self.array.flush()
+      self.array = None
+
+def readArrayHeader(arrayFile):
+  # version, shape, Fortran order and dtype of an open .npy file, leaving it at the start of the data
+  version = np.lib.format.read_magic(arrayFile)
+  if version == (1, 0):
+    shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(arrayFile)
+  else:
+    shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(arrayFile)
+  return version, shape, fortranOrder, dtype
+
+def writeArrayShape(arrayFile, path, version, dtype, shape, dataOffset):
+  # rewrite the header of an open C-ordered .npy file for a new shape, in the space of the old header
+  header = io.BytesIO()
+  headerFields = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape}
+  if version == (1, 0):
+    np.lib.format.write_array_header_1_0(header, headerFields)
+  else:
+    np.lib.format.write_array_header_2_0(header, headerFields)
+  if len(header.getvalue()) != dataOffset:
+    raise ValueError(f"The header of {path} has no room to grow")
+  arrayFile.seek(0)
+  arrayFile.write(header.getvalue())
+
+def appendArrayRows(path, rows):
+  """
+  Appends rows to the first axis of a C-ordered .npy file. NumPy pads the header so that the shape
+  can grow, so only the header is rewritten and the existing rows are left in place.
+  """
+  rows = np.asarray(rows)
+  with open(path, 'r+b') as arrayFile:
+    version, shape, fortranOrder, dtype = readArrayHeader(arrayFile)
+    if fortranOrder or rows.shape[1:] != shape[1:]:
+      raise ValueError(f"Cannot append {rows.shape} rows to {path} with shape {shape}")
+    dataOffset = arrayFile.tell()
+    arrayFile.seek(0, os.SEEK_END)
+    arrayFile.write(np.ascontiguousarray(rows, dtype=dtype).tobytes())
+    writeArrayShape(arrayFile, path, version, dtype, (shape[0] + len(rows),) + shape[1:], dataOffset)
+
+def truncateArrayRows(path, rowNumber):
+  """
+  Keeps the first rowNumber rows of a C-ordered .npy file, such as one appended to by an interrupted
+  run. Returns whether any rows were removed.
+  """
+  with open(path, 'r+b') as arrayFile:
+    version, shape, fortranOrder, dtype = readArrayHeader(arrayFile)
+    if fortranOrder or shape[0] < rowNumber:
+      raise ValueError(f"Cannot truncate {path} with shape {shape} to {rowNumber} rows")
+    if shape[0] == rowNumber:
+      return False
+    dataOffset = arrayFile.tell()
+    writeArrayShape(arrayFile, path, version, dtype, (rowNumber,) + shape[1:], dataOffset)
+    arrayFile.truncate(dataOffset + rowNumber * int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize)
+  return True
+
+def writeTextAtomic(path, text):
+  # written next to path and renamed, so an interrupted write leaves the earlier file
+  partialPath = path + '.partial'
+  with open(partialPath, 'w') as textFile:
+    textFile.write(text)
+  os.replace(partialPath, path)
+
+def correspondenceMetadataPath(path):
+  return os.path.splitext(path)[0] + '.json'
+
+def correspondencePolygonPath(path):
+  return os.path.splitext(path)[0] + 'Polygons.npy'
+
+class CorrespondenceTensor:
+  """
+  Subjects x base points x 3 float32 array of corresponding point coordinates, written to a .npy
+  file one subject at a time. The base mesh polygons are written once to a ...Polygons.npy file
+  in the VTK legacy cell layout, and a JSON sidecar with the same name holds the shape, the subject
+  IDs and the run parameters, so a result of any size can be opened lazily with
+  readCorrespondenceTensor and readCorrespondencePolygons.
+  """
+  def __init__(self, path, subjectIDs, baseMesh, parameters=None):
+    self.path = path
+    self.array = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(len(subjectIDs), baseMesh.GetNumberOfPoints(), 3))
+    legacyPolygons = vtk.vtkIdTypeArray()
+    baseMesh.GetPolys().ExportLegacyFormat(legacyPolygons)
+    np.save(correspondencePolygonPath(path), vtk_np.vtk_to_numpy(legacyPolygons).astype(np.int64))
+    metadata = {
+      'subjectIDs': list(subjectIDs),
+      'shape': list(self.array.shape),
+      'dtype': 'float32',
+      'polygons': os.path.basename(correspondencePolygonPath(path)),
+      'parameters': parameters or {},
+      }
+    with open(correspondenceMetadataPath(path), 'w') as metadataFile:
+      json.dump(metadata, metadataFile)
+
+  def write(self, index, points):
+    self.array[index] = points
+    self.array.flush()
+
+  def close(self):
+    if self.array is not None:
+      self.array.flush()
+      self.array = None
+
+def appendCorrespondenceTensor(path, subjectIDs, points):
+  """Adds subjects (S x base points x 3) to a tensor written by CorrespondenceTensor."""
+  appendArrayRows(path, np.asarray(points, dtype=np.float32))
+  with open(correspondenceMetadataPath(path)) as metadataFile:
+    metadata = json.load(metadataFile)
+  metadata['subjectIDs'] += list(subjectIDs)
+  metadata['shape'][0] = len(metadata['subjectIDs'])
+  writeTextAtomic(correspondenceMetadataPath(path), json.dumps(metadata))
+
+def truncateCorrespondenceTensor(path, subjectNumber):
+  """Keeps the first subjectNumber subjects of a tensor written by CorrespondenceTensor, returning whether any were removed."""
+  truncated = truncateArrayRows(path, subjectNumber)
+  with open(correspondenceMetadataPath(path)) as metadataFile:
+    metadata = json.load(metadataFile)
+  if len(metadata['subjectIDs']) > subjectNumber:
+    metadata['subjectIDs'] = metadata['subjectIDs'][:subjectNumber]
+    metadata['shape'][0] = subjectNumber
+    writeTextAtomic(correspondenceMetadataPath(path), json.dumps(metadata))
+    truncated = True
+  return truncated
+
+def readCorrespondenceTensor(path, mmapMode='r'):
+  """Returns the memory-mapped correspondence array written by CorrespondenceTensor and its metadata."""
+  with open(correspondenceMetadataPath(path)) as metadataFile:
+    metadata = json.load(metadataFile)
+  return np.load(path, mmap_mode=mmapMode), metadata
+
+def readCorrespondencePolygons(path):
+  """Returns the base mesh polygons of a tensor written by CorrespondenceTensor as a vtkCellArray."""
+  polygons = vtk.vtkCellArray()
+  polygonPath = correspondencePolygonPath(path)
+  if os.path.exists(polygonPath):
+    legacyPolygons = vtk_np.numpy_to_vtk(np.load(polygonPath), deep=True, array_type=vtk.VTK_ID_TYPE)
+    polygons.ImportLegacyFormat(legacyPolygons)
+  else:
+    # sidecars written before the polygons had a file of their own
+    with open(correspondenceMetadataPath(path)) as metadataFile:
+      metadata = json.load(metadataFile)
+    polygons.SetData(vtk_np.numpy_to_vtk(np.array(metadata['baseOffsets']), deep=True, array_type=vtk.VTK_ID_TYPE),
+      vtk_np.numpy_to_vtk(np.array(metadata['baseConnectivity']), deep=True, array_type=vtk.VTK_ID_TYPE))
+  return polygons
+
+#
+# Reading results on demand
+#
+
+def readResultModel(path, pointArrayNames=summaryArrayNames, coordinateSystem=None):
+  """
+  Reads a .vtp result model with only the named point arrays, skipping the per-subject arrays.
+  coordinateSystem converts the points as in readMesh.
+  """
+  reader = vtk.vtkXMLPolyDataReader()
+  reader.SetFileName(path)
+  reader.UpdateInformation()
+  for i in range(reader.GetNumberOfPointArrays()):
+    arrayName = reader.GetPointArrayName(i)
+    reader.SetPointArrayStatus(arrayName, arrayName in pointArrayNames)
+  reader.Update()
+  polydata = reader.GetOutput()
+  if coordinateSystem:
+    space = polydata.GetFieldData().GetAbstractArray('SPACE')
+    convertMeshCoordinateSystem(polydata, space.GetValue(0) if space else meshFileCoordinateSystem(path), coordinateSystem)
+  return polydata
+
+def readResultSubjectIDs(path):
+  """Subjects recorded in the SubjectIDs field data of a .vtp result model, read without its point arrays, or None."""
+  if not os.path.exists(path):
+    return None
+  reader = vtk.vtkXMLPolyDataReader()
+  reader.SetFileName(path)
+  reader.UpdateInformation()
+  for i in range(reader.GetNumberOfPointArrays()):
+    reader.SetPointArrayStatus(reader.GetPointArrayName(i), False)
+  reader.Update()
+  recordedIDs = reader.GetOutput().GetFieldData().GetAbstractArray(subjectIDArrayName)
+  if recordedIDs is None:
+    return None
+  return [recordedIDs.GetValue(i) for i in range(recordedIDs.GetNumberOfValues())]
+
+def appendedArrayIndex(path):
+  """
+  File offsets of the point arrays of a .vtp file written with raw, uncompressed appended data, as
+  {name: (dtype, offset, component number)}, or None when the arrays are compressed or encoded and
+  can only be read through VTK.
+  """
+  header = b''
+  with open(path, 'rb') as modelFile:
+    while b'<AppendedData' not in header:
+      chunk = modelFile.read(2**16)
+      if not chunk:
+        return None
+      header += chunk
+    appendedStart = header.index(b'<AppendedData')
+    while header.find(b'_', appendedStart) < 0:
+      chunk = modelFile.read(2**16)
+      if not chunk:
+        return None
+      header += chunk
+  dataStart = header.index(b'_', appendedStart) + 1
+  xml = header[:appendedStart].decode('utf-8', 'replace')
+  fileAttributes = dict(re.findall(r'(\w+)="([^"]*)"', xml[xml.index('<VTKFile'):xml.index('>', xml.index('<VTKFile'))]))
+  if 'compressor' in fileAttributes or b'encoding="raw"' not in header[appendedStart:dataStart]:
+    return None
+  byteOrder = '<' if fileAttributes.get('byte_order', 'LittleEndian') == 'LittleEndian' else '>'
+  headerSize = np.dtype(vtkDataTypes[fileAttributes.get('header_type', 'UInt32')]).itemsize
+  pointData = re.search(r'<PointData[^>]*>(.*?)</PointData>', xml, re.S)
+  index = {}
+  for tag in re.findall(r'<DataArray\s([^>]*)>', pointData.group(1) if pointData else ''):
+    attributes = dict(re.findall(r'(\w+)="([^"]*)"', tag))
+    if attributes.get('format') != 'appended' or attributes.get('type') not in vtkDataTypes:
+      continue
+    # each array is preceded by its size in bytes
+    index[attributes['Name']] = (np.dtype(byteOrder + vtkDataTypes[attributes['type']]),
+      dataStart + int(attributes['offset']) + headerSize, int(attributes.get('NumberOfComponents', 1)))
+  return index
+
+def writeResultModel(resultModel, path, subjectIDs, coordinateSystem=None):
+  """
+  Writes a result model with the subject IDs of the run in a SubjectIDs field data array. The
+  arrays are stored raw and uncompressed, so that SubjectFeatureStore maps them from the file.
+  """
+  subjectIDArray = vtk.vtkStringArray()
+  subjectIDArray.SetName(subjectIDArrayName)
+  for subjectID in subjectIDs:
+    subjectIDArray.InsertNextValue(subjectID)
+  # field data of a shallow copy, so that the caller's mesh is unchanged
+  copy = vtk.vtkPolyData()
+  copy.ShallowCopy(resultModel)
+  fieldData = vtk.vtkFieldData()
+  fieldData.ShallowCopy(resultModel.GetFieldData())
+  fieldData.AddArray(subjectIDArray)
+  copy.SetFieldData(fieldData)
+  writeMesh(copy, path, coordinateSystem, compress=False)
+
+class SubjectFeatureStore:
+  """
+  Per-subject values of a .vtp result model, read one subject at a time. The subjects are those
+  recorded by the run: the SubjectIDs field data of the model, or for results written before it
+  was recorded, decaSubjects.txt or decaState.npz next to it. Subjects stored as arrays of the
+  model are mapped from the file when it was written by writeResultModel, and read alone through
+  VTK otherwise; for streaming results, which keep only the summary arrays, they come from the
+  memory-mapped decaMagnitudes.npy. The cacheSize most recently read subjects are kept in memory.
+  """
+  def __init__(self, resultModelPath, cacheSize=16):
+    self.path = resultModelPath
+    self.cacheSize = cacheSize
+    self.cache = OrderedDict()
+    self.magnitudes = None
+    self.arrayIndex = None
+    self.reader = vtk.vtkXMLPolyDataReader()
+    self.reader.SetFileName(resultModelPath)
+    self.reader.UpdateInformation()
+    self.arrayNames = [self.reader.GetPointArrayName(i) for i in range(self.reader.GetNumberOfPointArrays())]
+    # the field data and the point number, without any point array
+    for arrayName in self.arrayNames:
+      self.reader.SetPointArrayStatus(arrayName, False)
+    self.reader.Update()
+    self.pointNumber = self.reader.GetOutput().GetNumberOfPoints()
+    resultDirectory = os.path.dirname(resultModelPath)
+    magnitudePath = os.path.join(resultDirectory, 'decaMagnitudes.npy')
+    subjectPath = os.path.join(resultDirectory, 'decaSubjects.txt')
+    statePath = os.path.join(resultDirectory, 'decaState.npz')
+    recordedIDs = self.reader.GetOutput().GetFieldData().GetAbstractArray(subjectIDArrayName)
+    if recordedIDs is not None:
+      self.subjectIDs = [recordedIDs.GetValue(i) for i in range(recordedIDs.GetNumberOfValues())]
+    elif os.path.exists(subjectPath):
+      with open(subjectPath) as subjectFile:
+        self.subjectIDs = [line.strip() for line in subjectFile if line.strip()]
+    elif os.path.basename(resultModelPath) == 'decaResultModel.vtp' and os.path.exists(statePath):
+      with np.load(statePath) as stateFile:
+        self.subjectIDs = stateFile['subjectIDs'].tolist()
+    else:
+      logger.warning("%s does not record its subjects, only the summary arrays can be shown", resultModelPath)
+      self.subjectIDs = []
+    if self.subjectIDs and self.subjectIDs[0] not in self.arrayNames:
+      self.magnitudes = np.load(magnitudePath, mmap_mode='r')
+      if len(self.magnitudes) != len(self.subjectIDs):
+        raise ValueError(f"{magnitudePath} has {len(self.magnitudes)} subjects, {resultModelPath} lists {len(self.subjectIDs)}")
+    elif self.subjectIDs:
+      self.arrayIndex = appendedArrayIndex(resultModelPath)
+    self.subjectIndex = {subjectID: i for i, subjectID in enumerate(self.subjectIDs)}
+
+  def values(self, subjectID):
+    """Returns the per-point values of subjectID as a float64 array."""
+    if subjectID in self.cache:
+      self.cache.move_to_end(subjectID)
+      return self.cache[subjectID]
+    if subjectID not in self.subjectIndex:
+      raise KeyError(subjectID)
+    if self.magnitudes is not None:
+      subjectValues = np.array(self.magnitudes[self.subjectIndex[subjectID]], dtype=np.float64)
+    elif self.arrayIndex is not None and subjectID in self.arrayIndex:
+      dtype, offset, componentNumber = self.arrayIndex[subjectID]
+      subjectValues = np.array(np.memmap(self.path, dtype, 'r', offset, (self.pointNumber * componentNumber,)), dtype=np.float64)
+    else:
+      for arrayName in self.arrayNames:
+        self.reader.SetPointArrayStatus(arrayName, arrayName == subjectID)
+      self.reader.Update()
+      subjectValues = vtk_np.vtk_to_numpy(self.reader.GetOutput().GetPointData().GetArray(subjectID)).astype(np.float64)
+    self.cache[subjectID] = subjectValues
+    if len(self.cache) > self.cacheSize:
+      self.cache.popitem(last=False)
+    return subjectValues
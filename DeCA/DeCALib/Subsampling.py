@@ -0,0 +1,138 @@
+import functools
+import os
+import numpy as np
+import vtk
+import vtk.util.numpy_support as vtk_np
+
+from .CPD import farthestPointSample
+from .MeshIO import convertMeshCoordinateSystem, readMesh
+
+#
+# Template point sampling of a base mesh for DeCAL
+#
+
+templateSamplingMethods = ('voxel', 'farthest')
+
+class TemplateSampler:
+  """
+  Chooses the base mesh points used as DeCAL landmarks, as base point indices. The mesh is
+  indexed once and every sample is kept, so point counts can be previewed again without reading or
+  filtering the mesh. The mesh, in coordinateSystem, is shared by every user of the sampler and must
+  not be modified; meshIn gives it in another coordinate system.
+  """
+  def __init__(self, mesh, coordinateSystem='LPS'):
+    self.mesh = mesh
+    self.coordinateSystem = coordinateSystem
+    self.points = vtk_np.vtk_to_numpy(mesh.GetPoints().GetData()).astype(np.float64)
+    self.offsets = self.points - self.points.min(axis=0)
+    self.diagonal = float(np.linalg.norm(self.offsets.max(axis=0)))
+    self.samples = {}
+    self.farthestOrder = np.zeros(0, dtype=np.int64)
+
+  def toleranceSample(self, spacingTolerance):
+    """
+    Points kept by vtkCleanPolyData merging within spacingTolerance percent of the mesh diagonal, in
+    the order of its output.
+    """
+    key = ('tolerance', spacingTolerance)
+    if key not in self.samples:
+      indexedMesh = vtk.vtkPolyData()
+      indexedMesh.ShallowCopy(self.mesh)
+      indexArray = vtk_np.numpy_to_vtk(np.arange(len(self.points), dtype=np.int32), deep=True, array_type=vtk.VTK_INT)
+      indexArray.SetName("indexArray")
+      indexedMesh.GetPointData().AddArray(indexArray)
+      cleanFilter = vtk.vtkCleanPolyData()
+      cleanFilter.SetToleranceIsAbsolute(False)
+      cleanFilter.SetTolerance(spacingTolerance/100)
+      cleanFilter.SetInputData(indexedMesh)
+      cleanFilter.Update()
+      self.samples[key] = vtk_np.vtk_to_numpy(cleanFilter.GetOutput().GetPointData().GetArray("indexArray")).astype(np.int64)
+    return self.samples[key]
+
+  def voxelCells(self, spacing):
+    # one integer per cubic cell of size spacing, so that cells are grouped by a 1D sort instead of unique rows
+    cells = np.floor(self.offsets / spacing).astype(np.int64)
+    cellCounts = cells.max(axis=0) + 1
+    return cells, (cells[:,0] * cellCounts[1] + cells[:,1]) * cellCounts[2] + cells[:,2]
+
+  def voxelCount(self, spacing):
+    """Number of points voxelSample gives for the cell size spacing."""
+    return len(np.unique(self.voxelCells(spacing)[1]))
+
+  def voxelSample(self, spacing):
+    """The point nearest the center of each occupied cubic cell of size spacing."""
+    key = ('voxel', spacing)
+    if key not in self.samples:
+      cells, cellIDs = self.voxelCells(spacing)
+      centerDistances = np.sum((self.offsets - (cells + 0.5) * spacing)**2, axis=1)
+      order = np.lexsort((centerDistances, cellIDs))
+      first = np.ones(len(order), dtype=bool)
+      first[1:] = cellIDs[order[1:]] != cellIDs[order[:-1]]
+      self.samples[key] = np.sort(order[first])
+    return self.samples[key]
+
+  def farthestSample(self, pointNumber):
+    """Exactly pointNumber points, each the farthest from those chosen before it."""
+    pointNumber = min(pointNumber, len(self.points))
+    # every shorter sample is a prefix of a longer one, so only the longest is computed
+    if pointNumber > len(self.farthestOrder):
+      self.farthestOrder = farthestPointSample(self.points, pointNumber)
+    return np.sort(self.farthestOrder[:pointNumber])
+
+  def targetSample(self, pointNumber, method='voxel', maxIterations=40):
+    """
+    About pointNumber points spread evenly over the mesh, as sorted base point indices. 'voxel'
+    bisects the cell size for the count nearest pointNumber, 'farthest' gives exactly pointNumber
+    points but takes time proportional to the mesh size times pointNumber.
+    """
+    if method not in templateSamplingMethods:
+      raise ValueError(f"Unknown template sampling method: {method}")
+    if pointNumber >= len(self.points):
+      return np.arange(len(self.points))
+    if method == 'farthest':
+      return self.farthestSample(pointNumber)
+    key = ('target', pointNumber)
+    if key not in self.samples:
+      # the count falls as the cells grow, from one point per cell to a single cell over the mesh
+      smallest, largest = self.diagonal * 1e-6, self.diagonal
+      bestSpacing, bestCount = largest, 1
+      for _ in range(maxIterations):
+        spacing = np.sqrt(smallest * largest)
+        count = self.voxelCount(spacing)
+        if abs(count - pointNumber) < abs(bestCount - pointNumber):
+          bestSpacing, bestCount = spacing, count
+        if count == pointNumber:
+          break
+        if count > pointNumber:
+          smallest = spacing
+        else:
+          largest = spacing
+      self.samples[key] = self.voxelSample(bestSpacing)
+    return self.samples[key]
+
+  def meshIn(self, coordinateSystem):
+    """The mesh in coordinateSystem, a converted copy unless it is the sampler's own."""
+    if coordinateSystem.upper() == self.coordinateSystem.upper():
+      return self.mesh
+    mesh = vtk.vtkPolyData()
+    mesh.DeepCopy(self.mesh)
+    return convertMeshCoordinateSystem(mesh, self.coordinateSystem, coordinateSystem)
+
+  def sample(self, spacingTolerance=None, pointNumber=None, method='voxel'):
+    """The sample for a target pointNumber when one is given, otherwise for the spacing tolerance."""
+    if pointNumber:
+      return self.targetSample(pointNumber, method)
+    return self.toleranceSample(spacingTolerance)
+
+@functools.lru_cache(maxsize=4)
+def _cachedTemplateSampler(path, modifiedTime, size):
+  return TemplateSampler(readMesh(path, 'LPS'), 'LPS')
+
+def loadTemplateSampler(path):
+  """
+  The TemplateSampler of a mesh file, read once and reused while the file is unchanged. The mesh is
+  always read and sampled in LPS, as the voxel grid follows the axes, so previews in the module's RAS
+  space and runs in LPS share one sampler and choose the same base point indices.
+  """
+  status = os.stat(path)
+  return _cachedTemplateSampler(os.path.abspath(path), status.st_mtime_ns, status.st_size)
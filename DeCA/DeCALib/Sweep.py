@@ -0,0 +1,116 @@
+import csv
+import itertools
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import vtk.util.numpy_support as vtk_np
+from scipy.spatial import cKDTree
+
+from . import Correspondence
+from .CPD import defaultCPDParameters, normalizedSize, registrationFromParameters
+from .Parallel import processContext
+
+#
+# Parameter sweeps over preprocessed cohort data
+#
+
+# settings a sweep can vary besides the CPD parameters, method is 'CPD' or 'closest point'
+defaultSweepSettings = {"method": 'CPD', "closestPointBackend": 'locator', "warpPrecision": 'float64'}
+
+def parameterGrid(grid):
+  """Every combination of a {name: list of values} grid, as a list of {name: value} dictionaries."""
+  names = list(grid)
+  return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+class SweepData:
+  """
+  Inputs shared by every combination of a sweep, prepared once and sent once to each worker: the
+  base mesh and landmarks, the Procrustes mean shape, and the subject meshes and landmarks
+  (S x K x 3). Landmark residuals are measured at the base vertices nearest the base landmarks.
+  """
+  def __init__(self, baseMesh, baseLandmarks, meanShape, subjectMeshes, subjectLandmarks):
+    self.base = [np.array(array) for array in Correspondence.polyDataToCellArrays(baseMesh)]
+    self.baseLandmarks = np.array(baseLandmarks, dtype=np.float64)
+    self.meanShape = np.array(meanShape, dtype=np.float64)
+    self.subjects = [[np.array(array) for array in Correspondence.polyDataToCellArrays(mesh)] for mesh in subjectMeshes]
+    self.subjectLandmarks = np.array(subjectLandmarks, dtype=np.float64)
+    self.landmarkVertices = cKDTree(self.base[0]).query(self.baseLandmarks)[1]
+
+def runCombination(data, combination):
+  """Finds the correspondences of every subject with one combination, returning its summary."""
+  parameters = dict(defaultCPDParameters)
+  parameters.update(defaultSweepSettings)
+  parameters.update(combination)
+  start = time.perf_counter()
+  iterations, variances, surfaceResiduals, landmarkResiduals = [], [], [], []
+  basePoints = data.base[0]
+  if parameters["method"] == 'CPD':
+    normalization = normalizedSize / np.max(np.ptp(basePoints, axis=0))
+  else:
+    context = Correspondence.CorrespondenceContext.fromBase(Correspondence.cellArraysToPolyData(*data.base),
+      data.baseLandmarks, Correspondence.numpyToVTKPoints(data.meanShape), parameters["closestPointBackend"], parameters["warpPrecision"])
+  for subject, subjectLandmarks in zip(data.subjects, data.subjectLandmarks):
+    if parameters["method"] == 'CPD':
+      registration = registrationFromParameters(basePoints * normalization, subject[0] * normalization, parameters)
+      correspondingPoints = registration.register() / normalization
+      iterations.append(sum(level.iteration for level in registration.levels))
+      variances.append(registration.levels[-1].sigma2)
+    else:
+      correspondingMesh, _ = Correspondence.denseSurfaceCorrespondence(Correspondence.cellArraysToPolyData(*subject),
+        Correspondence.numpyToVTKPoints(subjectLandmarks), context)
+      correspondingPoints = vtk_np.vtk_to_numpy(correspondingMesh.GetPoints().GetData())
+    surfaceResiduals.append(cKDTree(subject[0]).query(correspondingPoints)[0].mean())
+    landmarkResiduals.append(np.linalg.norm(correspondingPoints[data.landmarkVertices] - subjectLandmarks, axis=1))
+  landmarkResiduals = np.concatenate(landmarkResiduals)
+  summary = dict(combination)
+  summary.update({
+    'runtime': round(time.perf_counter() - start, 3),
+    'meanIterations': float(np.mean(iterations)) if iterations else None,
+    'maxIterations': max(iterations) if iterations else None,
+    'finalVariance': float(np.mean(variances)) if variances else None,
+    'surfaceResidual': float(np.mean(surfaceResiduals)),
+    'landmarkResidual': float(landmarkResiduals.mean()),
+    'maxLandmarkResidual': float(landmarkResiduals.max()),
+    })
+  return summary
+
+_sweepData = {}
+
+def _initializeSweepWorker(data):
+  _sweepData['data'] = data
+
+def _runCombination(combination):
+  return runCombination(_sweepData['data'], combination)
+
+def runSweep(data, combinations, workerNumber=1, resultCallback=None):
+  """
+  Runs runCombination for each combination, in a pool of workerNumber processes when it is above 1,
+  returning the summaries in the order of combinations. resultCallback(summary) is called as each
+  combination finishes.
+  """
+  summaries = [None] * len(combinations)
+  if workerNumber <= 1:
+    for i, combination in enumerate(combinations):
+      summaries[i] = runCombination(data, combination)
+      if resultCallback:
+        resultCallback(summaries[i])
+    return summaries
+  with ProcessPoolExecutor(max_workers=min(workerNumber, max(len(combinations), 1)), mp_context=processContext(),
+    initializer=_initializeSweepWorker, initargs=(data,)) as executor:
+    futures = {executor.submit(_runCombination, combination): i for i, combination in enumerate(combinations)}
+    for future in as_completed(futures):
+      summaries[futures[future]] = future.result()
+      if resultCallback:
+        resultCallback(summaries[futures[future]])
+  return summaries
+
+def writeSweepSummary(path, summaries):
+  """Writes one CSV row per combination, parameter columns first."""
+  fieldNames = []
+  for summary in summaries:
+    fieldNames += [name for name in summary if name not in fieldNames]
+  with open(path, 'w', newline='') as summaryFile:
+    writer = csv.DictWriter(summaryFile, fieldnames=fieldNames)
+    writer.writeheader()
+    for summary in summaries:
+      writer.writerow({name: '' if value is None else value for name, value in summary.items()})
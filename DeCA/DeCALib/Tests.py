@@ -0,0 +1,489 @@
+import importlib.util
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import vtk
+import vtk.util.numpy_support as vtk_np
+from scipy.spatial import cKDTree
+
+from .Alignment import generalizedProcrustes
+from .Batch import DeCABatchLogic
+from .Benchmark import writeSyntheticCohort
+from .Cache import ArtifactStore
+from .CPD import DeformableCPD, defaultCPDParameters, gaussianKernel, normalizedSize
+from .ClosestPoint import ClosestPointLocator, polyDataToArrays
+from .Correspondence import numpyToVTKPoints
+from .LandmarkIO import readLandmarks, writeLandmarkFiles, writeLandmarks
+from .Manifest import SubjectManifest
+from .MeshIO import readMesh, writeMesh
+from .Streaming import (SubjectFeatureStore, appendArrayRows, readCorrespondenceTensor, readResultModel,
+  readResultSubjectIDs, writeResultModel)
+from .ThinPlateSpline import ThinPlateSpline
+
+#
+# Regression tests of the NumPy paths against the VTK code they replace
+#
+
+def randomShapes(random, subjectNumber=12, landmarkNumber=20):
+  """Randomly rotated, scaled and translated noisy copies of one landmark configuration."""
+  template = random.normal(size=(landmarkNumber, 3)) * 30
+  shapes = []
+  for _ in range(subjectNumber):
+    rotation, _ = np.linalg.qr(random.normal(size=(3, 3)))
+    rotation *= np.sign(np.linalg.det(rotation))
+    noisy = template + random.normal(size=template.shape)
+    shapes.append(random.uniform(0.8, 1.2) * noisy @ rotation.T + random.uniform(-50, 50, 3))
+  return np.array(shapes)
+
+def vtkProcrustes(shapes, mode):
+  """Mean shape and aligned shapes of vtkProcrustesAlignmentFilter, as the module computed them before."""
+  landmarkGroup = vtk.vtkMultiBlockDataGroupFilter()
+  for shape in shapes:
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(numpyToVTKPoints(shape))
+    landmarkGroup.AddInputData(polydata)
+  landmarkGroup.Update()
+  procrustesFilter = vtk.vtkProcrustesAlignmentFilter()
+  if mode == 'rigid':
+    procrustesFilter.GetLandmarkTransform().SetModeToRigidBody()
+  procrustesFilter.SetInputData(landmarkGroup.GetOutput())
+  procrustesFilter.Update()
+  output = procrustesFilter.GetOutput()
+  alignedShapes = np.stack([vtk_np.vtk_to_numpy(output.GetBlock(i).GetPoints().GetData()) for i in range(len(shapes))])
+  return vtk_np.vtk_to_numpy(procrustesFilter.GetMeanPoints().GetData()), alignedShapes
+
+class AlignmentTest(unittest.TestCase):
+  def testProcrustesMatchesVTK(self):
+    random = np.random.default_rng(3)
+    for mode in ('similarity', 'rigid'):
+      for _ in range(3):
+        shapes = randomShapes(random)
+        meanShape, alignedShapes, _ = generalizedProcrustes(shapes, mode)
+        vtkMeanShape, vtkAlignedShapes = vtkProcrustes(shapes, mode)
+        # the filters stop at different iterations, which moves the mean by about 1e-8 of its size
+        size = np.abs(vtkMeanShape).max()
+        np.testing.assert_allclose(meanShape, vtkMeanShape, rtol=0, atol=3e-6 * size)
+        np.testing.assert_allclose(alignedShapes, vtkAlignedShapes, rtol=0, atol=1e-9 * size)
+
+class ThinPlateSplineTest(unittest.TestCase):
+  def testWarpMatchesVTK(self):
+    random = np.random.default_rng(4)
+    for _ in range(3):
+      sourceLandmarks = random.normal(size=(20, 3)) * 30
+      targetLandmarks = sourceLandmarks + random.normal(size=sourceLandmarks.shape) * 3
+      points = random.uniform(-60, 60, (5000, 3))
+      transform = vtk.vtkThinPlateSplineTransform()
+      transform.SetBasisToR()
+      transform.SetSourceLandmarks(numpyToVTKPoints(sourceLandmarks))
+      transform.SetTargetLandmarks(numpyToVTKPoints(targetLandmarks))
+      warpedPoints = vtk.vtkPoints()
+      warpedPoints.SetDataTypeToDouble()
+      transform.TransformPoints(numpyToVTKPoints(points), warpedPoints)
+      expected = vtk_np.vtk_to_numpy(warpedPoints.GetData())
+      extent = np.ptp(points, axis=0).max()
+      np.testing.assert_allclose(ThinPlateSpline(sourceLandmarks, targetLandmarks).transformPoints(points), expected,
+        rtol=0, atol=1e-9 * extent)
+      np.testing.assert_allclose(ThinPlateSpline(sourceLandmarks, targetLandmarks, np.float32).transformPoints(points), expected,
+        rtol=0, atol=2e-6 * extent)
+
+class RecordedRegistration:
+  """Stands in for the pycpd registration, keeping its inputs and returning the source unchanged."""
+  def __init__(self, targetArray, sourceArray):
+    self.targetArray = targetArray
+    self.sourceArray = sourceArray
+
+  def register(self):
+    return self.sourceArray.copy(), None
+
+class CPDNormalizationTest(unittest.TestCase):
+  def testNormalizationMatchesPointCloudScaling(self):
+    random = np.random.default_rng(5)
+    target = vtk.vtkPolyData()
+    target.SetPoints(numpyToVTKPoints(random.uniform(-40, 60, (500, 3))))
+    source = vtk.vtkPolyData()
+    source.SetPoints(numpyToVTKPoints(random.uniform(-45, 55, (400, 3))))
+    logic = DeCABatchLogic()
+    registrations = []
+    def recordRegistration(targetArray, sourceArray, *parameters):
+      registrations.append(RecordedRegistration(targetArray, sourceArray))
+      return registrations[-1]
+    logic.cpd_registration = recordRegistration
+    correspondingPoints = logic.runCPDRegistration(source, target, dict(defaultCPDParameters, CPDEngine='pycpd'))
+
+    # the open3d clouds were scaled about the origin so that the largest target extent was normalizedSize
+    targetPoints = vtk_np.vtk_to_numpy(target.GetPoints().GetData())
+    sourcePoints = vtk_np.vtk_to_numpy(source.GetPoints().GetData())
+    cloudSize = np.max(targetPoints.max(axis=0) - targetPoints.min(axis=0))
+    registration, = registrations
+    self.assertEqual(registration.targetArray.dtype, np.float32)
+    self.assertEqual(registration.sourceArray.dtype, np.float32)
+    np.testing.assert_allclose(registration.targetArray, (targetPoints * (normalizedSize / cloudSize)).astype(np.float32), rtol=1e-6)
+    np.testing.assert_allclose(registration.sourceArray, (sourcePoints * (normalizedSize / cloudSize)).astype(np.float32), rtol=1e-6)
+    np.testing.assert_allclose(correspondingPoints, sourcePoints, rtol=1e-6)
+    # the input meshes are left unscaled
+    np.testing.assert_array_equal(vtk_np.vtk_to_numpy(target.GetPoints().GetData()), targetPoints)
+
+def denseCPD(sourcePoints, targetPoints, alpha, beta, iterations):
+  """Deformable CPD with the full source x target probabilities and source x source kernel, as pycpd computes it."""
+  kernel = gaussianKernel(sourcePoints, sourcePoints, beta)
+  transformedPoints = sourcePoints.copy()
+  sigma2 = np.sum((targetPoints[np.newaxis] - sourcePoints[:,np.newaxis])**2) / (3 * len(sourcePoints) * len(targetPoints))
+  for _ in range(iterations):
+    probabilities = np.exp(-np.sum((targetPoints[np.newaxis] - transformedPoints[:,np.newaxis])**2, axis=2) / (2 * sigma2))
+    probabilities /= probabilities.sum(axis=0)
+    P1, Pt1, PX = probabilities.sum(axis=1), probabilities.sum(axis=0), probabilities @ targetPoints
+    coefficients = np.linalg.solve(P1[:,np.newaxis] * kernel + alpha * sigma2 * np.eye(len(sourcePoints)), PX - P1[:,np.newaxis] * sourcePoints)
+    transformedPoints = sourcePoints + kernel @ coefficients
+    sigma2 = (Pt1 @ np.sum(targetPoints**2, axis=1) - 2 * np.sum(PX * transformedPoints)
+      + P1 @ np.sum(transformedPoints**2, axis=1)) / (3 * P1.sum())
+  return transformedPoints
+
+def warpedPointSets(random, pointNumber):
+  """Points in a normalized size box and the same points smoothly warped and jittered, in another order."""
+  sourcePoints = random.uniform(-12, 12, (pointNumber, 3))
+  targetPoints = sourcePoints + 2 * np.sin(sourcePoints / 6) + random.normal(0, 0.2, sourcePoints.shape)
+  order = random.permutation(pointNumber)
+  return sourcePoints, targetPoints[order], order
+
+class LowRankCPDTest(unittest.TestCase):
+  def testFullRankMatchesDenseCPD(self):
+    # with every source point as a kernel center and as a neighbour, the low-rank solve is exact
+    sourcePoints, targetPoints, _ = warpedPointSets(np.random.default_rng(6), 60)
+    registration = DeformableCPD(sourcePoints, targetPoints, alpha=2, beta=2, maxIterations=20, tolerance=0,
+      rank=len(sourcePoints), neighbours=len(sourcePoints))
+    np.testing.assert_allclose(registration.register(), denseCPD(sourcePoints, targetPoints, 2, 2, 20), rtol=0, atol=1e-8)
+
+  @unittest.skipUnless(importlib.util.find_spec('pycpd'), "pycpd is not installed")
+  def testDenseCPDMatchesPycpd(self):
+    from pycpd import DeformableRegistration
+    sourcePoints, targetPoints, _ = warpedPointSets(np.random.default_rng(6), 60)
+    movedPoints, _ = DeformableRegistration(X=targetPoints, Y=sourcePoints, alpha=2, beta=2, max_iterations=20, tolerance=0).register()
+    np.testing.assert_allclose(denseCPD(sourcePoints, targetPoints, 2, 2, 20), movedPoints, rtol=0, atol=1e-8)
+
+  def testDefaultRankRegisters(self):
+    # the truncated probabilities follow another path than full CPD, but still reach the target
+    sourcePoints, targetPoints, order = warpedPointSets(np.random.default_rng(7), 400)
+    correspondingPoints = np.empty_like(targetPoints)
+    correspondingPoints[order] = targetPoints
+    movedPoints = DeformableCPD(sourcePoints, targetPoints, alpha=2, beta=2, maxIterations=30, tolerance=0).register()
+    initialError = np.linalg.norm(correspondingPoints - sourcePoints, axis=1).mean()
+    self.assertLess(np.linalg.norm(correspondingPoints - movedPoints, axis=1).mean(), 0.3 * initialError)
+
+class ArtifactStoreTest(unittest.TestCase):
+  def testEvictionKeepsTheRunInProgress(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+    store = ArtifactStore(directory)
+    artifact = np.zeros(1000)
+    store.startRun()
+    for modifiedTime, key in enumerate(('first', 'second')):
+      store.save(key, values=artifact)
+      os.utime(store.artifactPath(key), (1000 + modifiedTime, 1000 + modifiedTime))
+    store.maxBytes = 2.5 * os.path.getsize(store.artifactPath('first'))
+    store.size = None
+
+    # a new run evicts the least recently used artifacts of earlier runs first
+    store.startRun()
+    store.save('third', values=artifact)
+    self.assertEqual(sorted(os.listdir(directory)), ['second.npz', 'third.npz'])
+    # a run larger than the store keeps all of its artifacts and warns once
+    with self.assertLogs(ArtifactStore.__module__, 'WARNING') as logs:
+      store.save('fourth', values=artifact)
+      store.save('fifth', values=artifact)
+    self.assertEqual(sorted(os.listdir(directory)), ['fifth.npz', 'fourth.npz', 'third.npz'])
+    self.assertEqual(len(logs.records), 1)
+    np.testing.assert_array_equal(store.load('third')['values'], artifact)
+
+    # the next run may evict them
+    store.startRun()
+    store.save('sixth', values=artifact)
+    self.assertEqual(len(os.listdir(directory)), 2)
+    self.assertIn('sixth.npz', os.listdir(directory))
+
+class CoordinateSystemTest(unittest.TestCase):
+  def testWrittenFilesReadBackInEitherSystem(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+    normalFilter = vtk.vtkPolyDataNormals()
+    normalFilter.SetInputData(deformedSphere(12))
+    normalFilter.Update()
+    mesh = normalFilter.GetOutput()
+    points = vtk_np.vtk_to_numpy(mesh.GetPoints().GetData()).astype(np.float64)
+    normals = vtk_np.vtk_to_numpy(mesh.GetPointData().GetNormals()).astype(np.float64)
+    landmarks = points[:10]
+    flip = np.array([-1, -1, 1])
+    for coordinateSystem, otherSystem in (('LPS', 'RAS'), ('RAS', 'LPS')):
+      for extension in ('.ply', '.vtk', '.vtp', '.stl'):
+        with self.subTest(coordinateSystem=coordinateSystem, extension=extension):
+          path = os.path.join(directory, coordinateSystem + extension)
+          writeMesh(mesh, path, coordinateSystem)
+          samePoints = vtk_np.vtk_to_numpy(readMesh(path, coordinateSystem).GetPoints().GetData())
+          otherMesh = readMesh(path, otherSystem)
+          np.testing.assert_allclose(vtk_np.vtk_to_numpy(otherMesh.GetPoints().GetData()), samePoints * flip, atol=1e-6)
+          if extension == '.stl':
+            # STL stores triangles, whose corners are merged into points in another order
+            self.assertLess(cKDTree(points).query(samePoints)[0].max(), 1e-5)
+          else:
+            np.testing.assert_allclose(samePoints, points, atol=1e-5)
+            np.testing.assert_allclose(vtk_np.vtk_to_numpy(otherMesh.GetPointData().GetNormals()), normals * flip, atol=1e-5)
+      path = os.path.join(directory, coordinateSystem + '.mrk.json')
+      writeLandmarks(path, landmarks, coordinateSystem)
+      np.testing.assert_array_equal(readLandmarks(path, coordinateSystem), landmarks)
+      np.testing.assert_array_equal(readLandmarks(path, otherSystem), landmarks * flip)
+      # result models record their subjects and coordinate system
+      path = os.path.join(directory, coordinateSystem + 'Result.vtp')
+      writeResultModel(mesh, path, ['a', 'b'], coordinateSystem)
+      resultModel = readResultModel(path, coordinateSystem=otherSystem)
+      np.testing.assert_allclose(vtk_np.vtk_to_numpy(resultModel.GetPoints().GetData()), points * flip, atol=1e-6)
+      self.assertEqual(readResultSubjectIDs(path), ['a', 'b'])
+
+class LandmarkIOTest(unittest.TestCase):
+  def testNonFiniteCoordinatesAreRejected(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+    landmarks = np.random.default_rng(5).normal(size=(3, 4, 3))
+    writeLandmarks(os.path.join(directory, 'finite.mrk.json'), landmarks[0])
+    np.testing.assert_array_equal(readLandmarks(os.path.join(directory, 'finite.mrk.json')), landmarks[0])
+    landmarks[2, 1, 0] = np.nan
+    with self.assertRaisesRegex(ValueError, 'point 2'):
+      writeLandmarks(os.path.join(directory, 'nan.mrk.json'), landmarks[2])
+    # no file of the cohort is written
+    paths = [os.path.join(directory, f'subject{i}.mrk.json') for i in range(3)]
+    with self.assertRaisesRegex(ValueError, 'subject2'):
+      writeLandmarkFiles(paths, landmarks)
+    self.assertEqual(os.listdir(directory), ['finite.mrk.json'])
+
+def deformedSphere(resolution):
+  """A sphere source with a smooth radial bump pattern, so that its triangles vary in size and shape."""
+  sphereSource = vtk.vtkSphereSource()
+  sphereSource.SetThetaResolution(resolution)
+  sphereSource.SetPhiResolution(resolution)
+  sphereSource.Update()
+  sphere = sphereSource.GetOutput()
+  points = vtk_np.vtk_to_numpy(sphere.GetPoints().GetData())
+  points *= 1 + 0.3 * np.sin(5 * points[:,[0]]) * np.cos(3 * points[:,[1]])
+  sphere.GetPoints().Modified()
+  return sphere
+
+class ClosestPointTest(unittest.TestCase):
+  def testApproximateErrorIsBounded(self):
+    random = np.random.default_rng(4)
+    for resolution in (40, 80):
+      sphere = deformedSphere(resolution)
+      points, triangles = polyDataToArrays(sphere)
+      edgeLength = np.linalg.norm(points[triangles] - points[np.roll(triangles, 1, axis=1)], axis=2).max()
+      nearPoints = points[random.integers(0, len(points), 5000)] + random.normal(0, 0.02, (5000, 3))
+      farPoints = random.uniform(-1, 1, (5000, 3))
+      # away from the surface a nearly equidistant part of it may be returned instead
+      for queryPoints, displacementBound in ((nearPoints, 0.1 * edgeLength), (farPoints, np.inf)):
+        exactPoints = ClosestPointLocator(sphere, 'locator').findClosestPoints(queryPoints)
+        approximatePoints = ClosestPointLocator(sphere, 'approximate').findClosestPoints(queryPoints)
+        excess = np.linalg.norm(approximatePoints - queryPoints, axis=1) - np.linalg.norm(exactPoints - queryPoints, axis=1)
+        # the approximation lies on the mesh, so it is never closer than the exact point
+        self.assertGreater(excess.min(), -1e-12)
+        self.assertLess(excess.max(), 0.1 * edgeLength)
+        self.assertLess(np.mean(excess > 1e-12), 0.02)
+        self.assertLess(np.linalg.norm(approximatePoints - exactPoints, axis=1).max(), displacementBound)
+
+  def testFormerBackendNames(self):
+    sphere = deformedSphere(20)
+    self.assertEqual(ClosestPointLocator(sphere, 'kdtree').backend, 'locator')
+    self.assertEqual(ClosestPointLocator(sphere, 'numpy').backend, 'approximate')
+    with self.assertRaises(ValueError):
+      ClosestPointLocator(sphere, 'octree')
+
+class CohortTestCase(unittest.TestCase):
+  """Tests on a synthetic cohort written to a temporary directory, with subject0000 as the base."""
+  subjectNumber = 5
+  pointNumber = 2000
+
+  @classmethod
+  def setUpClass(cls):
+    cls.directory = tempfile.mkdtemp()
+    cls.meshDirectory, cls.landmarkDirectory, _, cls.mirrorOrder = writeSyntheticCohort(os.path.join(cls.directory, 'cohort'),
+      cls.subjectNumber, cls.pointNumber, seed=2)
+    cls.subjectIDs = [f'subject{i:04d}' for i in range(cls.subjectNumber)]
+    cls.baseMeshPath = os.path.join(cls.meshDirectory, 'subject0000.ply')
+    cls.baseLandmarkPath = os.path.join(cls.landmarkDirectory, 'subject0000.mrk.json')
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.directory, ignore_errors=True)
+
+  def createLogic(self):
+    logic = DeCABatchLogic()
+    logic.cacheDirectory = None
+    return logic
+
+  def outputDirectory(self, name):
+    outputDirectory = os.path.join(self.directory, name)
+    os.makedirs(outputDirectory)
+    return outputDirectory
+
+  def copyCohort(self, name, subjectNumber):
+    # mesh and landmark directories with the first subjectNumber subjects of the cohort
+    meshDirectory = self.outputDirectory(name + 'Meshes')
+    landmarkDirectory = self.outputDirectory(name + 'Landmarks')
+    for subjectID in self.subjectIDs[:subjectNumber]:
+      shutil.copy(os.path.join(self.meshDirectory, subjectID + '.ply'), meshDirectory)
+      shutil.copy(os.path.join(self.landmarkDirectory, subjectID + '.mrk.json'), landmarkDirectory)
+    return meshDirectory, landmarkDirectory
+
+  def runShapeAnalysis(self, name, workerNumber=1, streaming=False, baseMeshPath=None, meshDirectory=None, landmarkDirectory=None):
+    outputDirectory = self.outputDirectory(name)
+    arguments = (baseMeshPath or self.baseMeshPath, self.baseLandmarkPath, meshDirectory or self.meshDirectory,
+      landmarkDirectory or self.landmarkDirectory, outputDirectory)
+    if streaming:
+      self.createLogic().runDCAlignStreaming(*arguments, False, 'locator', True)
+    else:
+      self.createLogic().runDCAlign(*arguments, False, False, 'locator', workerNumber, True)
+    return outputDirectory
+
+class RunParityTest(CohortTestCase):
+  """Shape analysis of one synthetic cohort run serially, on a process pool and streaming."""
+  def runResults(self, name, **options):
+    outputDirectory = self.runShapeAnalysis(name, **options)
+    resultModelPath = os.path.join(outputDirectory, 'decaResultModel.vtp')
+    featureStore = SubjectFeatureStore(resultModelPath)
+    magnitudes = np.stack([featureStore.values(subjectID) for subjectID in featureStore.subjectIDs])
+    pointData = readResultModel(resultModelPath).GetPointData()
+    summary = np.stack([vtk_np.vtk_to_numpy(pointData.GetArray(name)) for name in ('Magnitude Mean', 'Magnitude SD')])
+    correspondences, metadata = readCorrespondenceTensor(os.path.join(outputDirectory, 'decaCorrespondences.npy'))
+    return featureStore.subjectIDs, magnitudes, summary, np.array(correspondences), metadata['subjectIDs']
+
+  def testRunsAgree(self):
+    subjectIDs, magnitudes, summary, correspondences, tensorSubjectIDs = self.runResults('serial')
+    self.assertEqual(subjectIDs, self.subjectIDs)
+    self.assertEqual(tensorSubjectIDs, subjectIDs)
+    for name, options in (('pool', {'workerNumber': 2}), ('streaming', {'streaming': True})):
+      with self.subTest(name):
+        otherSubjectIDs, otherMagnitudes, otherSummary, otherCorrespondences, otherTensorSubjectIDs = self.runResults(name, **options)
+        self.assertEqual(otherSubjectIDs, subjectIDs)
+        self.assertEqual(otherTensorSubjectIDs, subjectIDs)
+        np.testing.assert_allclose(otherMagnitudes, magnitudes, rtol=0, atol=1e-9)
+        np.testing.assert_allclose(otherSummary, summary, rtol=0, atol=1e-9)
+        np.testing.assert_allclose(otherCorrespondences, correspondences, rtol=0, atol=1e-6)
+
+class SubjectManifestTest(CohortTestCase):
+  def testSavedManifestIsInvalidated(self):
+    meshDirectory, landmarkDirectory = self.copyCohort('manifest', 3)
+    manifestDirectory = self.outputDirectory('manifests')
+    def savedManifest():
+      manifest = SubjectManifest(meshDirectory, landmarkDirectory, manifestDirectory=manifestDirectory)
+      return manifest if manifest.read() else None
+
+    self.assertIsNone(savedManifest())
+    self.assertEqual(SubjectManifest.load(meshDirectory, landmarkDirectory, manifestDirectory=manifestDirectory).subjectIDs(), self.subjectIDs[:3])
+    self.assertEqual(savedManifest().subjectIDs(), self.subjectIDs[:3])
+    # nothing is written to the dataset
+    self.assertEqual(len(os.listdir(meshDirectory)), 3)
+    self.assertEqual(len(os.listdir(manifestDirectory)), 1)
+
+    # a file rewritten in place does not change its directory
+    meshPath = os.path.join(meshDirectory, self.subjectIDs[1] + '.ply')
+    directoryTimes = os.stat(meshDirectory).st_atime_ns, os.stat(meshDirectory).st_mtime_ns
+    with open(meshPath, 'ab') as meshFile:
+      meshFile.write(b' ')
+    os.utime(meshDirectory, ns=directoryTimes)
+    self.assertIsNone(savedManifest())
+    SubjectManifest.load(meshDirectory, landmarkDirectory, manifestDirectory=manifestDirectory)
+    self.assertIsNotNone(savedManifest())
+    # nor does one with a new modification time and the same size
+    os.utime(meshPath, ns=(os.stat(meshPath).st_atime_ns, os.stat(meshPath).st_mtime_ns + 10**9))
+    self.assertIsNone(savedManifest())
+    SubjectManifest.load(meshDirectory, landmarkDirectory, manifestDirectory=manifestDirectory)
+
+    # an added mesh without landmarks is reported but not paired
+    shutil.copy(os.path.join(self.meshDirectory, self.subjectIDs[3] + '.ply'), meshDirectory)
+    self.assertIsNone(savedManifest())
+    manifest = SubjectManifest.load(meshDirectory, landmarkDirectory, manifestDirectory=manifestDirectory)
+    self.assertEqual(manifest.subjectIDs(), self.subjectIDs[:3])
+    self.assertEqual(manifest.unmatchedMeshes(), self.subjectIDs[3:4])
+
+class IncrementalRunTest(CohortTestCase):
+  def addedResults(self, outputDirectory):
+    resultModelPath = os.path.join(outputDirectory, 'decaResultModel.vtp')
+    featureStore = SubjectFeatureStore(resultModelPath)
+    magnitudes = np.stack([featureStore.values(subjectID) for subjectID in featureStore.subjectIDs])
+    pointData = readResultModel(resultModelPath).GetPointData()
+    summary = np.stack([vtk_np.vtk_to_numpy(pointData.GetArray(name)) for name in ('Magnitude Mean', 'Magnitude SD')])
+    correspondences, metadata = readCorrespondenceTensor(os.path.join(outputDirectory, 'decaCorrespondences.npy'))
+    with np.load(os.path.join(outputDirectory, 'decaState.npz')) as state:
+      stateSubjectIDs = state['subjectIDs'].tolist()
+    return featureStore.subjectIDs, magnitudes, summary, np.array(correspondences), metadata['subjectIDs'], stateSubjectIDs
+
+  def testAddAndRecover(self):
+    meshDirectory, landmarkDirectory = self.copyCohort('first', 3)
+    for streaming in (False, True):
+      with self.subTest(streaming=streaming):
+        name = 'streaming' if streaming else 'serial'
+        cleanDirectory = self.runShapeAnalysis(name + 'Clean', streaming=streaming, meshDirectory=meshDirectory, landmarkDirectory=landmarkDirectory)
+        interruptedDirectory = self.outputDirectory(name + 'Interrupted')
+        shutil.rmtree(interruptedDirectory)
+        shutil.copytree(cleanDirectory, interruptedDirectory)
+        self.createLogic().runDCAlignIncremental(self.meshDirectory, self.landmarkDirectory, cleanDirectory)
+        subjectIDs, magnitudes, summary, correspondences, tensorSubjectIDs, stateSubjectIDs = self.addedResults(cleanDirectory)
+        self.assertEqual(subjectIDs, self.subjectIDs)
+        self.assertEqual(tensorSubjectIDs, self.subjectIDs)
+        self.assertEqual(stateSubjectIDs, self.subjectIDs)
+        np.testing.assert_allclose(summary, [magnitudes.mean(axis=0), magnitudes.std(axis=0)], rtol=0, atol=1e-9)
+
+        # an addition interrupted after the per-subject appends, before the state listed its subjects
+        logic = self.createLogic()
+        def interrupt(*arguments):
+          raise InterruptedError()
+        logic.writeRunState = interrupt
+        with self.assertRaises(InterruptedError):
+          logic.runDCAlignIncremental(self.meshDirectory, self.landmarkDirectory, interruptedDirectory)
+        appendArrayRows(os.path.join(interruptedDirectory, 'decaMagnitudes.npy'), magnitudes[:1])
+        with self.assertLogs(DeCABatchLogic.__module__, 'WARNING'):
+          self.createLogic().runDCAlignIncremental(self.meshDirectory, self.landmarkDirectory, interruptedDirectory)
+        for recovered, clean in zip(self.addedResults(interruptedDirectory), (subjectIDs, magnitudes, summary, correspondences,
+          tensorSubjectIDs, stateSubjectIDs)):
+          np.testing.assert_array_equal(recovered, clean)
+
+class SubjectFeatureStoreTest(CohortTestCase):
+  def testSubjectsOfBaseWithNormals(self):
+    # the base mesh arrays, such as normals, are kept in the result model but are not subjects
+    normalFilter = vtk.vtkPolyDataNormals()
+    normalFilter.SetInputData(readMesh(self.baseMeshPath))
+    normalFilter.SplittingOff()
+    normalFilter.Update()
+    baseMeshPath = os.path.join(self.directory, 'baseWithNormals.ply')
+    writeMesh(normalFilter.GetOutput(), baseMeshPath)
+    results = {}
+    for name, options in (('serial', {}), ('streaming', {'streaming': True})):
+      with self.subTest(name):
+        resultModelPath = os.path.join(self.runShapeAnalysis('normals' + name, baseMeshPath=baseMeshPath, **options), 'decaResultModel.vtp')
+        self.assertIsNotNone(readResultModel(resultModelPath, ('Normals',)).GetPointData().GetArray('Normals'))
+        featureStore = SubjectFeatureStore(resultModelPath)
+        self.assertEqual(featureStore.subjectIDs, self.subjectIDs)
+        results[name] = np.stack([featureStore.values(subjectID) for subjectID in self.subjectIDs])
+    np.testing.assert_allclose(results['streaming'], results['serial'], rtol=0, atol=1e-9)
+
+  def testMappedValuesMatchVTK(self):
+    resultModelPath = os.path.join(self.runShapeAnalysis('mapped'), 'decaResultModel.vtp')
+    featureStore = SubjectFeatureStore(resultModelPath, cacheSize=2)
+    self.assertIsNotNone(featureStore.arrayIndex)
+    pointData = readMesh(resultModelPath).GetPointData()
+    for subjectID in self.subjectIDs + self.subjectIDs[::-1]:
+      np.testing.assert_array_equal(featureStore.values(subjectID), vtk_np.vtk_to_numpy(pointData.GetArray(subjectID)))
+    self.assertEqual(len(featureStore.cache), 2)
+    with self.assertRaises(KeyError):
+      featureStore.values('Magnitude Mean')
+
+  def testCompressedResultModel(self):
+    # result models written by other tools are compressed, so subjects are read through VTK
+    outputDirectory = self.runShapeAnalysis('compressed')
+    resultModelPath = os.path.join(outputDirectory, 'decaResultModel.vtp')
+    resultModel = readMesh(resultModelPath)
+    writeMesh(resultModel, resultModelPath)
+    featureStore = SubjectFeatureStore(resultModelPath)
+    self.assertIsNone(featureStore.arrayIndex)
+    self.assertEqual(featureStore.subjectIDs, self.subjectIDs)
+    np.testing.assert_array_equal(featureStore.values(self.subjectIDs[1]), vtk_np.vtk_to_numpy(resultModel.GetPointData().GetArray(self.subjectIDs[1])))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,17 @@
+from .Alignment import *
+from .Benchmark import *
+from .Cache import *
+from .ClosestPoint import *
+from .CPD import *
+from .ThinPlateSpline import *
+from .Correspondence import *
+from .Jobs import *
+from .Parallel import *
+from .Profiling import *
+from .Streaming import *
+from .Subsampling import *
+from .Sweep import *
+from .MeshIO import *
+from .LandmarkIO import *
+from .Manifest import *
+from .Batch import DeCABatchLogic